@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from habit_model import Habit, HabitManager
+from habit_storage import make_session, open_storage
+
+# Reproducible benchmarks for the model layer hot paths:
+#   python habit_bench.py --scale default --output results.json
+#   python habit_bench.py --save-baseline        # record bench_baseline_legacy.json
+#   python habit_bench.py                        # compare, exit 1 on regression
+
+SCALES = {
+    'smoke': {'sessions': [10, 1000], 'habits': [1, 100]},
+    'default': {'sessions': [10, 10000, 100000], 'habits': [1, 1000]},
+    'full': {'sessions': [10, 1000, 10000, 100000, 1000000], 'habits': [1, 10, 100, 1000, 10000]}
+}
+PARAMS = {'reps': 2.0, 'sets': 5.0, 'minutes': 0.5}
+DEFAULT_BASELINE = 'bench_baseline_{backend}.json'
+DEFAULT_TOLERANCE = 0.5
+STARTUP_REPEAT = 10
+# Most a CLI command may add to a bare interpreter's start-up, in ms
+STARTUP_BUDGET_MS = 50.0
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _summarize(latencies_ns):
+    latencies = sorted(latencies_ns)
+    total = sum(latencies)
+    return {
+        'n': len(latencies),
+        'ops_per_sec': len(latencies) / (total / 1e9) if total else float('inf'),
+        'p50_ms': _percentile(latencies, 0.50) / 1e6,
+        'p99_ms': _percentile(latencies, 0.99) / 1e6
+    }
+
+
+def _timed(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        fn()
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+
+def _synthetic_rows(count, rnd, rating=500.0):
+    rows = []
+    for session in range(1, count + 1):
+        values = {param: rnd.uniform(0, 10) for param in PARAMS}
+        total_score = sum(value * PARAMS[param] for param, value in values.items())
+        adv_score = rnd.uniform(0, 40)
+        delta = rnd.uniform(-10, 10)
+        rating += delta
+        rows.append(make_session(session, total_score, adv_score, delta, rating, values))
+    return rows
+
+
+def _populate(storage, habits, sessions, rnd):
+    habit_data = {}
+    with storage.transaction():
+        for i in range(habits):
+            name = f"habit{i:05d}"
+            rows = _synthetic_rows(sessions, rnd)
+            habit_data[name] = {'params': dict(PARAMS), 'rating': rows[-1]['rating'] if rows else 500,
+                                'k_factor': 20}
+            storage.save_habit(name, habit_data[name])
+            storage.append_sessions(name, rows)
+    storage.save_index(habit_data)
+    return list(habit_data)
+
+
+def bench_sessions(location, sessions, rnd, results):
+    storage = open_storage(location)
+    name, = _populate(storage, 1, sessions, rnd)
+    tag = f"sessions={sessions}"
+
+    checkpoint_path = getattr(storage, 'checkpoint_path', None)
+    repeat = 50 if sessions <= 100000 else 10
+
+    def load_cold():
+        if checkpoint_path is not None and os.path.exists(checkpoint_path(name)):
+            os.remove(checkpoint_path(name))
+        Habit(name, dict(PARAMS), storage=storage)
+    results[f"load_history[tail,{tag}]"] = _summarize(_timed(load_cold, repeat))
+
+    habit = Habit(name, dict(PARAMS), storage=storage)
+    habit.save_session({param: 1.0 for param in PARAMS}, 4.0, 4.0, 0.0)  # writes a checkpoint
+    results[f"load_history[{tag}]"] = _summarize(
+        _timed(lambda: Habit(name, dict(PARAMS), storage=storage), repeat))
+
+    results[f"scan_ratings[{tag}]"] = _summarize(
+        _timed(lambda: _scan_ratings(storage, name), 20 if sessions <= 10000 else 3))
+
+    results[f"generate_adversary[{tag}]"] = _summarize(
+        _timed(lambda: habit.generate_adversary(rnd.choice(('easy', 'normal', 'hard'))), 20000))
+
+    def session():
+        values = {param: rnd.uniform(0, 10) for param in PARAMS}
+        user_score = habit.calculate_score(values)
+        _, _, adv_score = habit.generate_adversary('normal')
+        delta = habit.update_rating(user_score, adv_score)
+        habit.scores.append(user_score)
+        habit.save_session(values, user_score, adv_score, delta)
+    results[f"update_rating+save_session[{tag}]"] = _summarize(_timed(session, 500))
+    storage.close()
+
+
+def _scan_ratings(storage, name):
+    # Every rating in the history, the fastest way the backend offers
+    session_table = getattr(storage, 'session_table', None)
+    if session_table is not None:
+        return float(session_table(name)[1][:, 4].sum())
+    return sum(row['rating'] for row in storage.iter_sessions(name))
+
+
+def bench_habits(location, habits, rnd, results):
+    storage = open_storage(location)
+    _populate(storage, habits, 30, rnd)
+    tag = f"habits={habits}"
+    repeat = 20 if habits <= 1000 else 5
+
+    results[f"HabitManager.load_habits[{tag}]"] = _summarize(
+        _timed(lambda: HabitManager(storage=storage), repeat))
+    manager = HabitManager(storage=storage)
+    results[f"HabitManager.save_habits[{tag}]"] = _summarize(_timed(manager.save_habits, repeat))
+    results[f"memory[{tag}]"] = _measure_memory(storage, manager.habits)
+    storage.close()
+
+
+def bench_startup(location, rnd, results):
+    # Cold start of the CLI, a fresh interpreter per run: printing a rating
+    # and logging a session, with a bare interpreter as the reference
+    storage = open_storage(location)
+    name, = _populate(storage, 1, 1000, rnd)
+    storage.close()
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        'python': [sys.executable, '-c', 'pass'],
+        'habit_cli rating': [sys.executable, '-m', 'habit_cli', '--data', location, 'rating', name],
+        'habit_cli log': [sys.executable, '-m', 'habit_cli', '--data', location, 'log', name] +
+                         [f"{param}=1" for param in PARAMS],
+    }
+    for command, argv in commands.items():
+        results[f"startup[{command}]"] = _summarize(_timed(
+            lambda: subprocess.run(argv, cwd=here, check=True, stdout=subprocess.DEVNULL), STARTUP_REPEAT))
+
+
+def startup_overruns(report, budget_ms=STARTUP_BUDGET_MS):
+    # (command, ms over the bare interpreter) for commands over the budget
+    results = report['results']
+    bare = results.get('startup[python]')
+    if bare is None:
+        return []
+    overruns = []
+    for name, stats in results.items():
+        if name.startswith('startup[') and name != 'startup[python]':
+            extra = stats['p50_ms'] - bare['p50_ms']
+            if extra > budget_ms:
+                overruns.append((name, extra))
+    return overruns
+
+
+def _measure_memory(storage, habits):
+    # Bytes held per in-use habit (history window loaded, an adversary
+    # generated), params included as they come out of the index
+    tracemalloc.start()
+    try:
+        measured = [Habit(name, dict(habit.params), storage=storage) for name, habit in habits.items()]
+        for habit in measured:
+            habit.generate_adversary('normal')
+        used = tracemalloc.get_traced_memory()[0] - sys.getsizeof(measured)
+    finally:
+        tracemalloc.stop()
+    return {'bytes_per_habit': used / len(measured)}
+
+
+def run(scale, backend, seed):
+    rnd = random.Random(seed)
+    results = {}
+    for sessions in SCALES[scale]['sessions']:
+        workdir = tempfile.mkdtemp(prefix='elohabits_bench_')
+        try:
+            bench_sessions(_location(workdir, backend), sessions, rnd, results)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    for habits in SCALES[scale]['habits']:
+        workdir = tempfile.mkdtemp(prefix='elohabits_bench_')
+        try:
+            bench_habits(_location(workdir, backend), habits, rnd, results)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    workdir = tempfile.mkdtemp(prefix='elohabits_bench_')
+    try:
+        bench_startup(_location(workdir, backend), rnd, results)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'meta': {
+            'scale': scale,
+            'backend': backend,
+            'seed': seed,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+
+
+def _location(workdir, backend):
+    if backend == 'sqlite':
+        return os.path.join(workdir, 'habits.db')
+    if backend == 'columnar':
+        return os.path.join(workdir, 'habits.columnar')
+    return workdir
+
+
+def compare(report, baseline, tolerance):
+    # A benchmark regresses when its median latency exceeds the baseline's
+    # by more than the tolerance (0.5 = 50% slower); memory benchmarks
+    # compare bytes per habit the same way. Returns the regressions and the
+    # benchmarks only one side has, which can't be compared at all.
+    regressions = []
+    unmatched = sorted(set(report['results']) ^ set(baseline['results']))
+    for name, current in report['results'].items():
+        base = baseline['results'].get(name)
+        key = 'p50_ms' if 'p50_ms' in current else 'bytes_per_habit'
+        if base is None:
+            continue
+        if not base.get(key):
+            unmatched.append(name)
+            continue
+        ratio = current[key] / base[key]
+        if ratio > 1 + tolerance:
+            regressions.append((name, key, base[key], current[key], ratio))
+    return regressions, unmatched
+
+
+def _print_report(report):
+    width = max(len(name) for name in report['results'])
+    print(f"{'benchmark':<{width}}  {'ops/s':>12}  {'p50 ms':>10}  {'p99 ms':>10}")
+    for name, stats in report['results'].items():
+        if 'bytes_per_habit' in stats:
+            print(f"{name:<{width}}  {stats['bytes_per_habit']:>12.0f}  bytes/habit")
+            continue
+        print(f"{name:<{width}}  {stats['ops_per_sec']:>12.1f}  {stats['p50_ms']:>10.4f}  {stats['p99_ms']:>10.4f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the habit_model hot paths")
+    parser.add_argument('--scale', default='smoke', choices=sorted(SCALES))
+    parser.add_argument('--backend', default='legacy', choices=['legacy', 'sqlite', 'columnar'])
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', default=None, help="Write the JSON report here")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline JSON to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET_MS,
+                        help="Most ms a CLI command may add to a bare interpreter's start-up")
+    args = parser.parse_args(argv)
+    args.baseline = args.baseline.format(backend=args.backend)
+
+    # A baseline from another backend or scale can't be compared: say so
+    # before spending minutes on the run
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        for option in ('backend', 'scale'):
+            if baseline['meta'].get(option) != getattr(args, option):
+                print(f"Baseline {args.baseline} was recorded with --{option} {baseline['meta'].get(option)}, "
+                      f"not {getattr(args, option)}", file=sys.stderr)
+                return 2
+
+    report = run(args.scale, args.backend, args.seed)
+    _print_report(report)
+    overruns = startup_overruns(report, args.startup_budget)
+    for name, extra in overruns:
+        print(f"SLOW STARTUP {name}: {extra:.1f} ms over a bare interpreter "
+              f"(budget {args.startup_budget:g} ms)", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return 1 if overruns else 0
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 1 if overruns else 0
+    regressions, unmatched = compare(report, baseline, args.tolerance)
+    for name, key, base, current, ratio in regressions:
+        print(f"REGRESSION {name}: {key} {base:.4f} -> {current:.4f} ({ratio:.2f}x)", file=sys.stderr)
+    for name in unmatched:
+        side = 'the baseline' if name in report['results'] else 'this run'
+        print(f"UNCOMPARED {name}: missing from {side}; record a new baseline with --save-baseline",
+              file=sys.stderr)
+    return 1 if regressions or unmatched or overruns else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
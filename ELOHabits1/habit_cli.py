@@ -0,0 +1,288 @@
+import sys
+
+# Headless entry point: python -m habit_cli <command>. Nothing beyond the
+# model and storage layers is imported, and those (like argparse) only once
+# a command runs, so the CLI starts fast enough for scripts, cron jobs and
+# pipelines; habit_bench times a `rating` and a `log` from a cold start.
+
+
+def _manager(args):
+    from habit_model import HabitManager
+    from habit_storage import open_storage
+    return HabitManager(storage=open_storage(args.data))
+
+
+def _habit(manager, name):
+    habit = manager.habits.get(name)
+    if habit is None:
+        sys.exit(f"Unknown habit: {name}")
+    return habit.ensure_loaded()
+
+
+def _print_json(data):
+    import json
+    print(json.dumps(data))
+
+
+def _parse_values(habit, pairs):
+    values = {}
+    for pair in pairs:
+        param, sep, value = pair.partition('=')
+        param = param.strip().lower()
+        if not sep:
+            sys.exit(f"Expected param=value, got '{pair}'")
+        if param not in habit.params:
+            sys.exit(f"Unknown parameter for {habit.name}: {param}")
+        try:
+            values[param] = float(value)
+        except ValueError:
+            sys.exit(f"Invalid value for {param}: {value}")
+    # Parameters left out count as 0, like an untouched field in the GUI
+    return {param: values.get(param, 0.0) for param in habit.params}
+
+
+def cmd_list(args):
+    manager = _manager(args)
+    rows = []
+    for name, habit in manager.habits.items():
+        habit.ensure_loaded()
+        rows.append({'habit': name, 'rating': habit.rating, 'sessions': habit.session_count,
+                     'params': habit.params})
+    manager.save_changes()  # ratings a stale index had wrong, in one write
+    if args.json:
+        _print_json(rows)
+        return
+    for row in rows:
+        params = ' '.join(f"{param}={weight:g}" for param, weight in row['params'].items())
+        print(f"{row['habit']}\t{row['rating']:.1f}\t{row['sessions']}\t{params}")
+
+
+def cmd_rating(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    manager.save_changes()
+    if args.json:
+        _print_json({'habit': habit.name, 'rating': habit.rating, 'sessions': habit.session_count})
+    else:
+        print(f"{habit.rating:.1f}")
+
+
+def cmd_adversary(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    manager.save_changes()
+    low, high, actual = habit.generate_adversary(args.difficulty)
+    if args.json:
+        _print_json({'habit': habit.name, 'difficulty': args.difficulty,
+                     'low': low, 'high': high, 'actual': actual})
+    else:
+        print(f"{low:.1f}\t{high:.1f}\t{actual:.1f}")
+
+
+def cmd_log(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    values = _parse_values(habit, args.values)
+    result = manager.record_session(habit.name, values, args.difficulty, args.adv_score)
+    manager.save_changes()
+    if args.json:
+        _print_json(result)
+        return
+    score, adv_score = result['score'], result['adv_score']
+    outcome = 'Victory' if score > adv_score else 'Draw' if score == adv_score else 'Defeat'
+    print(f"{outcome}\t{score:.1f}\t{adv_score:.1f}\t{result['delta']:+.1f}\t{result['rating']:.1f}")
+
+
+def cmd_trend(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    series = manager.trend(habit.name, args.column, args.period, args.stat, args.start, args.end)
+    manager.save_changes()  # keeps what a first query had to build
+    if args.json:
+        _print_json([{'bucket': bucket, args.stat: value} for bucket, value in series])
+        return
+    for bucket, value in series:
+        print(f"{bucket}\t{value:g}")
+
+
+def cmd_stats(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    win_rates = manager.win_rates(habit.name, args.period, args.start, args.end)
+    streaks = manager.streaks(habit.name)
+    manager.save_changes()
+    if args.json:
+        _print_json({'habit': habit.name, 'win_rates': win_rates, 'streaks': streaks})
+        return
+    for difficulty, games in sorted(win_rates.items()):
+        print(f"{difficulty}\t{games['games']}\t{games['win_rate']:.3f}")
+    print(f"streak\t{streaks['current']}\t{streaks['longest']}")
+
+
+def cmd_summary(args):
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    summary = manager.summary(habit.name, args.column, args.first, args.last)
+    manager.save_changes()
+    if args.json:
+        _print_json(dict(summary, habit=habit.name, column=args.column))
+        return
+    for key, value in summary.items():
+        print(f"{key}\t{'' if value is None else format(value, 'g')}")
+
+
+def cmd_compact(args):
+    manager = _manager(args)
+    names = [_habit(manager, name).name for name in args.habits] if args.habits else None
+    try:
+        moved = manager.compact(names, args.segment_size, args.codec)
+    except ValueError as exc:
+        sys.exit(f"Compaction failed: {exc}")
+    if args.json:
+        _print_json(moved)
+        return
+    for name, count in moved.items():
+        print(f"{name}\t{count}")
+
+
+def cmd_sync(args):
+    from habit_sync import sync_with
+    try:
+        report = sync_with(_manager(args), args.target)
+    except (OSError, RuntimeError, ValueError) as exc:
+        sys.exit(f"Sync failed: {exc}")
+    if args.json:
+        _print_json(report)
+        return
+    for name, counts in report.items():
+        print(f"{name}\t{counts['pulled']}\t{counts['pushed']}")
+
+
+def cmd_export(args):
+    import csv
+    manager = _manager(args)
+    habit = _habit(manager, args.habit)
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        sessions = manager.storage.iter_sessions(habit.name)
+        if args.format == 'jsonl':
+            import json
+            for row in sessions:
+                out.write(json.dumps(row) + '\n')
+            return
+        from habit_storage import BASE_COLUMNS, SESSION_COLUMNS
+        params = list(habit.params)
+        writer = csv.writer(out)
+        writer.writerow(BASE_COLUMNS + SESSION_COLUMNS + params)
+        for row in sessions:
+            values = row['values']
+            writer.writerow([row[column] for column in BASE_COLUMNS] +
+                            ['' if row[column] is None else row[column] for column in SESSION_COLUMNS] +
+                            [values.get(param, '') for param in params])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def cmd_import(args):
+    from habit_import import import_sessions
+    counts = import_sessions(args.files, args.data, args.workers, args.difficulty, args.seed)
+    print(f"Imported {sum(counts.values())} sessions into {len(counts)} habits")
+
+
+def cmd_migrate(args):
+    from habit_storage import migrate, open_storage
+    habits, sessions = migrate(open_storage(args.data), open_storage(args.target))
+    print(f"Migrated {habits} habits and {sessions} sessions")
+
+
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='habit_cli', description="Headless ELOHabits commands")
+    parser.add_argument('--data', default=None,
+                        help="Data directory or .db file (default: ELOHABITS_DB or the working directory)")
+    parser.add_argument('--json', action='store_true', help="Print JSON instead of tab-separated text")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sub = commands.add_parser('list', help="List habits with rating and session count")
+    sub.set_defaults(func=cmd_list)
+
+    sub = commands.add_parser('rating', help="Print a habit's current rating")
+    sub.add_argument('habit')
+    sub.set_defaults(func=cmd_rating)
+
+    sub = commands.add_parser('adversary', help="Draw an adversary: low, high, actual")
+    sub.add_argument('habit')
+    sub.add_argument('--difficulty', default='normal', choices=['easy', 'normal', 'hard'])
+    sub.set_defaults(func=cmd_adversary)
+
+    sub = commands.add_parser('log', help="Log a session: outcome, score, adversary, delta, rating")
+    sub.add_argument('habit')
+    sub.add_argument('values', nargs='*', metavar='param=value')
+    sub.add_argument('--difficulty', default='normal', choices=['easy', 'normal', 'hard'])
+    sub.add_argument('--adv-score', type=float, default=None, help="Use this adversary score instead of drawing one")
+    sub.set_defaults(func=cmd_log)
+
+    sub = commands.add_parser('trend', help="Per day/week/month statistic of the score or one parameter")
+    sub.add_argument('habit')
+    sub.add_argument('--column', default='total_score', help="total_score or a parameter name")
+    sub.add_argument('--period', default='week', choices=['day', 'week', 'month', 'all'])
+    sub.add_argument('--stat', default='mean', choices=['count', 'sum', 'mean', 'min', 'max'])
+    sub.add_argument('--start', default=None, help="First bucket, e.g. 2024-01-01, 2024-W05 or 2024-01")
+    sub.add_argument('--end', default=None, help="Last bucket")
+    sub.set_defaults(func=cmd_trend)
+
+    sub = commands.add_parser('stats', help="Win rate per difficulty (games, rate) and streak (current, longest)")
+    sub.add_argument('habit')
+    sub.add_argument('--period', default='all', choices=['day', 'week', 'month', 'all'])
+    sub.add_argument('--start', default=None)
+    sub.add_argument('--end', default=None)
+    sub.set_defaults(func=cmd_stats)
+
+    sub = commands.add_parser('summary', help="Count, sum, mean, stdev, min and max of a column over sessions")
+    sub.add_argument('habit')
+    sub.add_argument('--column', default='total_score', help="total_score, adv_score, delta, rating or a parameter")
+    sub.add_argument('--first', type=int, default=None, help="First session (default: the first)")
+    sub.add_argument('--last', type=int, default=None, help="Last session (default: the latest)")
+    sub.set_defaults(func=cmd_summary)
+
+    sub = commands.add_parser('compact', help="Move old sessions into compressed segments: sessions moved per habit")
+    sub.add_argument('habits', nargs='*', help="Habits to compact (default: all)")
+    sub.add_argument('--segment-size', type=int, default=4096, help="Sessions per segment")
+    sub.add_argument('--codec', default='gzip', choices=['gzip', 'lzma'])
+    sub.set_defaults(func=cmd_compact)
+
+    sub = commands.add_parser('sync', help="Two-way sync with a shared directory or a habit_server: pulled, pushed")
+    sub.add_argument('target', help="Shared data directory, .db file or http://host:port")
+    sub.set_defaults(func=cmd_sync)
+
+    sub = commands.add_parser('export', help="Write a habit's full history")
+    sub.add_argument('habit')
+    sub.add_argument('--format', default='csv', choices=['csv', 'jsonl'])
+    sub.add_argument('-o', '--output', default=None, help="Output file (default: stdout)")
+    sub.set_defaults(func=cmd_export)
+
+    sub = commands.add_parser('import', help="Bulk import sessions from CSV/JSONL files")
+    sub.add_argument('files', nargs='+')
+    sub.add_argument('--workers', type=int, default=None)
+    sub.add_argument('--difficulty', default='normal')
+    sub.add_argument('--seed', default=None)
+    sub.set_defaults(func=cmd_import)
+
+    sub = commands.add_parser('migrate', help="Copy all data from --data into another backend")
+    sub.add_argument('target', help="Data directory or .db file to write")
+    sub.set_defaults(func=cmd_migrate)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args)
+    except BrokenPipeError:
+        # e.g. `habit_cli export x | head`; silence the flush at exit too
+        sys.stdout = None
+
+
+if __name__ == "__main__":
+    main()
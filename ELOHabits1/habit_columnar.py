@@ -0,0 +1,361 @@
+import contextlib
+import csv
+import json
+import math
+import os
+import struct
+import sys
+from array import array
+
+import habit_metrics as metrics
+from habit_storage import (BASE_COLUMNS, SESSION_COLUMNS, LegacyStorage, make_session, param_columns,
+                           parse_row, session_header)
+
+# Binary session files: one habit_{name}.f64 per habit, an 8-byte magic and
+# a small JSON header naming the columns, then fixed-width records of
+# little-endian float64: BASE_COLUMNS, the session columns, then one column
+# per parameter. Difficulty is stored as its position in the header's
+# difficulty list, and NaN marks a blank cell. Records are append-only, so
+# a reader can mmap the file and take any column as a zero-copy NumPy view
+# with a stride of one record, without parsing a single row.
+
+MAGIC = b'EHCOL1\r\n'
+_LENGTH = struct.Struct('<I')
+READ_BLOCK_RECORDS = 8192
+
+
+def _encode_header(columns, difficulties):
+    # Padded with spaces so records start 8-byte aligned
+    header = json.dumps({'columns': list(columns), 'difficulties': list(difficulties)}).encode()
+    header += b' ' * (-(len(MAGIC) + _LENGTH.size + len(header)) % 8)
+    return MAGIC + _LENGTH.pack(len(header)) + header
+
+
+def read_header(f):
+    # (columns, offset of the first record, difficulties) of an open file
+    start = f.read(len(MAGIC) + _LENGTH.size)
+    if len(start) < len(MAGIC) + _LENGTH.size or start[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not a binary session file")
+    length, = _LENGTH.unpack(start[len(MAGIC):])
+    header = json.loads(f.read(length))
+    return header['columns'], len(start) + length, header.get('difficulties', [])
+
+
+def _to_bytes(records):
+    if sys.byteorder == 'big':
+        records = array('d', records)
+        records.byteswap()
+    return records.tobytes()
+
+
+def _from_bytes(data):
+    records = array('d')
+    records.frombytes(data)
+    if sys.byteorder == 'big':
+        records.byteswap()
+    return records
+
+
+def _has_session_columns(columns):
+    return columns[len(BASE_COLUMNS):len(BASE_COLUMNS) + len(SESSION_COLUMNS)] == SESSION_COLUMNS
+
+
+def _difficulties(rows, difficulties=()):
+    # difficulties plus any new ones the rows bring, in order of appearance
+    difficulties = list(difficulties)
+    for row in rows:
+        difficulty = row.get('difficulty')
+        if difficulty is not None and difficulty not in difficulties:
+            difficulties.append(difficulty)
+    return difficulties
+
+
+def _records(columns, difficulties, rows):
+    # Flattened float64 records for session dicts
+    params = param_columns(columns)
+    timed = _has_session_columns(columns)
+    codes = {difficulty: float(i) for i, difficulty in enumerate(difficulties)}
+    records = array('d')
+    for row in rows:
+        values = row['values']
+        records.extend([row['session'], row['total_score'], row['adv_score'], row['delta'], row['rating']])
+        if timed:
+            timestamp = row.get('timestamp')
+            records.extend([math.nan if timestamp is None else timestamp, codes.get(row.get('difficulty'), math.nan)])
+        records.extend([values.get(param, math.nan) for param in params])
+    return records
+
+
+def _session(columns, difficulties, record):
+    first = len(BASE_COLUMNS)
+    timestamp = difficulty = None
+    if _has_session_columns(columns):
+        timestamp, code = record[first:first + 2]
+        timestamp = timestamp if timestamp == timestamp else None
+        difficulty = difficulties[int(code)] if code == code else None
+        first += len(SESSION_COLUMNS)
+    session = make_session(int(record[0]), record[1], record[2], record[3], record[4], {}, timestamp, difficulty)
+    values = session['values']
+    for param, value in zip(columns[first:], record[first:]):
+        if value == value:  # NaN marks a parameter the session did not have
+            values[param] = value
+    return session
+
+
+def write_file(path, columns, difficulties, records):
+    # Whole file through a temp file and a rename, like the CSV rewrites
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(_encode_header(columns, difficulties))
+        f.write(_to_bytes(records))
+        metrics.count('storage.bytes_written', f.tell())
+    os.replace(tmp_file, path)
+    metrics.count('storage.file_opens')
+
+
+def session_table(path):
+    # (columns, table): a read-only (sessions x columns) float64 array mapped
+    # straight onto the file, so table[:, i] costs nothing to take. Sessions
+    # appended later are not part of an existing table.
+    import numpy as np
+    with open(path, 'rb') as f:
+        columns, offset, _ = read_header(f)
+        size = f.seek(0, os.SEEK_END)
+    metrics.count('storage.file_opens')
+    count = (size - offset) // (8 * len(columns))
+    if count == 0:
+        return columns, np.zeros((0, len(columns)))
+    return columns, np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(count, len(columns)))
+
+
+def export_csv(path, csv_path):
+    # The binary file as a habit_{name}.csv that LegacyStorage can read
+    with open(path, 'rb') as f:
+        _, _, difficulties = read_header(f)
+    columns, table = session_table(path)
+    params = param_columns(columns)
+    count = 0
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for start in range(0, len(table), READ_BLOCK_RECORDS):
+            for record in table[start:start + READ_BLOCK_RECORDS].tolist():
+                row = _session(columns, difficulties, record)
+                cells = [row[column] for column in BASE_COLUMNS]
+                if len(params) < len(columns) - len(BASE_COLUMNS):
+                    cells += ['' if row[column] is None else row[column] for column in SESSION_COLUMNS]
+                values = row['values']
+                cells += [values.get(param, '') for param in params]
+                writer.writerow(cells)
+                count += 1
+    return count
+
+
+def import_csv(csv_path, path):
+    # A habit_{name}.csv history as a binary session file; unparsable rows
+    # are skipped, as LegacyStorage does
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        header = reader.fieldnames or []
+        if any(column not in header for column in BASE_COLUMNS):
+            raise ValueError(f"{csv_path}: missing one of the columns {', '.join(BASE_COLUMNS)}")
+        params = param_columns(header)
+        rows = []
+        for row in reader:
+            try:
+                rows.append(parse_row(row, params))
+            except (KeyError, TypeError, ValueError):
+                continue
+    columns = session_header(rows, BASE_COLUMNS + [column for column in SESSION_COLUMNS if column in header] + params)
+    difficulties = _difficulties(rows)
+    write_file(path, columns, difficulties, _records(columns, difficulties, rows))
+    return len(rows)
+
+
+class ColumnarStorage:
+    # habits.json index (kept by LegacyStorage) plus one binary session file
+    # per habit. Loading a habit reads only the last window_size records, so
+    # no checkpoint sidecar is needed.
+    def __init__(self, data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+        self.location = data_dir
+        self.data_dir = data_dir
+        self._index = LegacyStorage(data_dir)
+        self._headers = {}  # name -> read_header() of its session file
+        self._unsynced = set()
+
+    def session_path(self, name):
+        return os.path.join(self.data_dir, f"habit_{name}.f64")
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def sync(self):
+        while self._unsynced:
+            path = self._unsynced.pop()
+            if os.path.exists(path):
+                with open(path, 'ab') as f:
+                    os.fsync(f.fileno())
+                metrics.count('storage.fsyncs')
+
+    def close(self):
+        pass
+
+    # Index
+
+    def load_index(self):
+        return self._index.load_index()
+
+    def save_index(self, habit_data):
+        self._index.save_index(habit_data)
+
+    def save_habit(self, name, meta):
+        self._index.save_habit(name, meta)
+
+    def delete_habit(self, name):
+        self._headers.pop(name, None)
+        if os.path.exists(self.session_path(name)):
+            os.remove(self.session_path(name))
+        self._index.delete_habit(name)
+
+    # Sessions
+
+    def _header(self, name):
+        header = self._headers.get(name)
+        if header is None and os.path.exists(self.session_path(name)):
+            with open(self.session_path(name), 'rb') as f:
+                header = self._headers[name] = read_header(f)
+            metrics.count('storage.file_opens')
+        return header
+
+    def _read(self, name, first, count):
+        # (header, flat records from position first, up to count of them,
+        # records in the file); a negative first counts from the end
+        header = self._header(name)
+        if header is None:
+            return None, array('d'), 0
+        columns, offset, _ = header
+        width = 8 * len(columns)
+        with open(self.session_path(name), 'rb') as f:
+            total = (f.seek(0, os.SEEK_END) - offset) // width
+            if first < 0:
+                first += total
+            first = min(max(first, 0), total)
+            f.seek(offset + first * width)
+            data = f.read(min(count, total - first) * width)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', len(data))
+        return header, _from_bytes(data), total
+
+    def _sessions(self, header, records):
+        columns, _, difficulties = header
+        width = len(columns)
+        records = records.tolist()
+        return [_session(columns, difficulties, records[start:start + width])
+                for start in range(0, len(records), width)]
+
+    def load_window(self, name, window_size):
+        # The last record is read even for an empty window: it holds the
+        # rating and session count
+        count = max(window_size, 1)
+        header, records, _ = self._read(name, -count, count)
+        if not records:
+            return [], None, 0
+        width = len(header[0])
+        scores = records[1::width].tolist()[-window_size:] if window_size else []
+        return scores, records[-width + 4], int(records[-width])
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        if not rows:
+            return
+        path = self.session_path(name)
+        header = self._header(name)
+        if header is None:
+            self.replace_sessions(name, rows)
+            return
+        columns, offset, difficulties = header
+        wider = session_header(rows, columns)
+        more_difficulties = _difficulties(rows, difficulties)
+        if wider != columns or more_difficulties != difficulties:
+            # A new parameter (or difficulty) rewrites every record
+            self.replace_sessions(name, list(self.iter_sessions(name)) + list(rows),
+                                  header=wider, difficulties=more_difficulties)
+            return
+        width = 8 * len(columns)
+        with open(path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            end -= (end - offset) % width  # drop a record torn by a crash
+            f.truncate(end)
+            f.seek(end)
+            data = _to_bytes(_records(columns, difficulties, rows))
+            f.write(data)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_written', len(data))
+        self._unsynced.add(path)
+
+    def replace_sessions(self, name, rows, checkpoint=None, header=None, difficulties=None):
+        if header is None:
+            header = session_header(rows)
+        if difficulties is None:
+            difficulties = _difficulties(rows)
+        path = self.session_path(name)
+        write_file(path, header, difficulties, _records(header, difficulties, rows))
+        self._headers.pop(name, None)
+        self._unsynced.add(path)
+
+    def iter_sessions(self, name):
+        first = 0
+        while True:
+            header, records, _ = self._read(name, first, READ_BLOCK_RECORDS)
+            if not records:
+                return
+            sessions = self._sessions(header, records)
+            yield from sessions
+            first += len(sessions)
+
+    def read_sessions(self, name, first_session, count):
+        # Up to count sessions from first_session on, oldest first; the
+        # position is found by bisecting the mapped session column
+        if self._header(name) is None:
+            return []
+        import numpy as np
+        _, table = session_table(self.session_path(name))
+        first = int(np.searchsorted(table[:, 0], first_session, side='left'))
+        header, records, _ = self._read(name, first, count)
+        return self._sessions(header, records)
+
+    def read_ratings(self, name, after_session=0):
+        if self._header(name) is None:
+            return []
+        import numpy as np
+        _, table = session_table(self.session_path(name))
+        first = int(np.searchsorted(table[:, 0], after_session, side='right'))
+        metrics.count('storage.rows_read', len(table) - first)
+        return list(zip(table[first:, 0].astype(np.int64).tolist(), table[first:, 4].tolist()))
+
+    def load_rollups(self, name):
+        return self._index.load_rollups(name)
+
+    def save_rollups(self, name, text):
+        self._index.save_rollups(name, text)
+
+    def session_table(self, name):
+        # Zero-copy view of every recorded session; see session_table()
+        if self._header(name) is None:
+            import numpy as np
+            return list(BASE_COLUMNS), np.zeros((0, len(BASE_COLUMNS)))
+        return session_table(self.session_path(name))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a habit history between CSV and binary session files")
+    parser.add_argument('command', choices=['import', 'export'],
+                        help="import: CSV -> .f64, export: .f64 -> CSV")
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+    if args.command == 'import':
+        print(f"Imported {import_csv(args.source, args.target)} sessions")
+    else:
+        print(f"Exported {export_csv(args.source, args.target)} sessions")
@@ -0,0 +1,304 @@
+import csv
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import habit_metrics as metrics
+from habit_storage import BASE_COLUMNS, make_session, param_columns
+
+# Paged, read-only access to one habit's session history for the GUI. A
+# CSV history gets a sparse byte-offset index (where every page of rows
+# starts) built in one pass, so reading a page is a single seek and read
+# however long the file is. Pages are cached and their neighbours loaded
+# ahead of time on a background thread.
+
+PAGE_SIZE = 256
+CACHE_PAGES = 32
+PREFETCH_PAGES = 2
+SCAN_BLOCK_SIZE = 1 << 20
+
+
+class _CsvSource:
+    # Byte-offset page index over an append-only history CSV. refresh()
+    # only scans what was appended since the last call, and starts over
+    # when the file was rewritten (replaced or truncated).
+    def __init__(self, path_fn, page_size):
+        self.path_fn = path_fn
+        self.page_size = page_size
+        self._reset(None)
+
+    def _reset(self, identity):
+        self.identity = identity
+        self.header = None
+        self.param_names = []
+        self.offsets = array('q')  # byte offset of the first row of each page
+        self.ratings = array('d')
+        self.count = 0
+        self.end = 0  # bytes indexed so far, always at a line boundary
+        self._rating_column = BASE_COLUMNS.index('rating')
+
+    def refresh(self):
+        path = self.path_fn()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._reset(None)
+            return 0
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity or stat.st_size < self.end:
+            self._reset(identity)
+        if stat.st_size == self.end:
+            return self.count
+        with open(path, 'rb') as f:
+            if self.header is None:
+                line = f.readline()
+                self.header = next(csv.reader([line.decode('utf-8', 'replace')]), [])
+                self.param_names = param_columns(self.header)
+                if 'rating' in self.header:
+                    self._rating_column = self.header.index('rating')
+                self.end = f.tell()
+            f.seek(self.end)
+            self._scan(f, stat.st_size)
+        metrics.count('storage.file_opens')
+        return self.count
+
+    def _scan(self, f, size):
+        position = self.end
+        column = self._rating_column
+        page_size = self.page_size
+        offsets = self.offsets
+        ratings = self.ratings
+        count = self.count
+        rating = ratings[-1] if ratings else 0.0
+        carry = b''
+        while position + len(carry) < size:
+            block = f.read(min(SCAN_BLOCK_SIZE, size - position - len(carry)))
+            if not block:
+                break
+            metrics.count('storage.bytes_read', len(block))
+            lines = (carry + block).split(b'\n')
+            carry = lines.pop()  # incomplete last line, if any
+            for line in lines:
+                if line.strip():
+                    if count % page_size == 0:
+                        offsets.append(position)
+                    try:
+                        rating = float(line.split(b',', column + 1)[column])
+                    except (IndexError, ValueError):
+                        pass  # unparsable rows keep the previous rating on the chart
+                    ratings.append(rating)
+                    count += 1
+                position += len(line) + 1
+        self.count = count
+        self.end = position
+
+    def read_page(self, page):
+        start = self.offsets[page]
+        end = self.offsets[page + 1] if page + 1 < len(self.offsets) else self.end
+        with open(self.path_fn(), 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', len(data))
+        header = self.header
+        param_names = self.param_names
+        rows = []
+        for cells in csv.reader(data.decode('utf-8', 'replace').splitlines()):
+            if not cells:
+                continue
+            row = dict(zip(header, cells))
+            try:
+                timestamp = row.get('timestamp')
+                session = make_session(int(float(row['session'])), float(row['total_score']),
+                                       float(row['adv_score']), float(row['delta']), float(row['rating']), {},
+                                       float(timestamp) if timestamp else None, row.get('difficulty') or None)
+            except (KeyError, TypeError, ValueError):
+                session = None  # keeps positions stable; shown as a blank row
+            else:
+                for param in param_names:
+                    cell = row.get(param)
+                    if cell not in (None, ''):
+                        session['values'][param] = float(cell)
+            rows.append(session)
+        return rows
+
+
+class _StorageSource:
+    # Backends that page by session number themselves (SQLite). The index
+    # holds the first session of every page; refresh() fetches only newer
+    # ratings unless the last indexed session changed underneath it.
+    def __init__(self, storage, name, page_size):
+        self.storage = storage
+        self.name = name
+        self.page_size = page_size
+        self._reset()
+
+    def _reset(self):
+        self.page_starts = array('q')
+        self.ratings = array('d')
+        self.count = 0
+        self.last_session = None
+
+    def refresh(self):
+        if self.last_session is None:
+            fresh = self.storage.read_ratings(self.name)
+        else:
+            fresh = self.storage.read_ratings(self.name, self.last_session - 1)
+            if fresh and tuple(fresh[0]) == (self.last_session, self.ratings[-1]):
+                fresh = fresh[1:]
+            else:
+                self._reset()  # rewritten, e.g. by a replay
+                fresh = self.storage.read_ratings(self.name)
+        count = self.count
+        for session, rating in fresh:
+            if count % self.page_size == 0:
+                self.page_starts.append(session)
+            self.ratings.append(rating)
+            count += 1
+        if fresh:
+            self.last_session = fresh[-1][0]
+        self.count = count
+        return count
+
+    def read_page(self, page):
+        return self.storage.read_sessions(self.name, self.page_starts[page], self.page_size)
+
+
+class HistoryPager:
+    # Every read of the history (indexing and page loads, and the first
+    # look at where the history is kept) runs on one background thread, so
+    # they never overlap and never block the caller; building a pager
+    # touches no storage. The lock only guards the page cache.
+    def __init__(self, storage, name, page_size=PAGE_SIZE, cache_pages=CACHE_PAGES, prefetch=PREFETCH_PAGES):
+        self.name = name
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.prefetch = prefetch
+        self._storage = storage
+        self._source = None  # chosen by the first refresh
+        self._pages = OrderedDict()  # page number -> rows, least recently used first
+        self._loading = {}  # page number -> Future
+        self._generation = 0
+        self._envelope = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='habit-history')
+
+    def __len__(self):
+        return self._source.count if self._source is not None else 0
+
+    @property
+    def param_names(self):
+        return list(getattr(self._source, 'param_names', ()))
+
+    def refresh_async(self):
+        # Index whatever was written since the last refresh. Cached pages
+        # are dropped, since the last one may have grown.
+        return self._executor.submit(self._refresh)
+
+    def refresh(self):
+        return self.refresh_async().result()
+
+    @metrics.timed('history.refresh')
+    def _refresh(self):
+        if self._source is None:
+            self._source = self._open_source()
+        count = self._source.refresh()
+        with self._lock:
+            self._pages.clear()
+            self._loading.clear()
+            self._generation += 1
+        return count
+
+    def _open_source(self):
+        # Waits for the habit's pending writes on a write-behind storage
+        storage = self._storage
+        if hasattr(storage, 'history_path') and not (hasattr(storage, 'segments') and storage.segments(self.name)):
+            return _CsvSource(lambda: storage.history_path(self.name), self.page_size)
+        # Also a compacted CSV history, whose older pages are in segments
+        return _StorageSource(storage, self.name, self.page_size)
+
+    def close(self, wait=True):
+        # Drops queued loads; with wait, also lets the one in flight finish
+        # so the storage can be closed right after
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _load(self, page, generation):
+        if generation != self._generation:
+            return None  # queued before a refresh; the page is requested again
+        rows = self._source.read_page(page)
+        with self._lock:
+            self._pages[page] = rows
+            self._loading.pop(page, None)
+            while len(self._pages) > self.cache_pages:
+                self._pages.popitem(last=False)
+        return rows
+
+    def _request(self, page):
+        # Cached rows, or None after queueing the page; called with the lock held
+        rows = self._pages.get(page)
+        if rows is not None:
+            self._pages.move_to_end(page)
+            return rows
+        if page not in self._loading:
+            self._loading[page] = self._executor.submit(self._load, page, self._generation)
+        return None
+
+    def rows(self, first, count, wait=True):
+        # Sessions first .. first+count-1 (0-based, oldest first). With
+        # wait=False, rows whose page is not cached yet come back as None
+        # and load in the background. Neighbouring pages are prefetched.
+        total = len(self)
+        first = max(0, min(first, total))
+        last = min(total, first + count)
+        if first >= last:
+            return []
+        first_page = first // self.page_size
+        last_page = (last - 1) // self.page_size
+        pages = {}
+        while True:
+            with self._lock:
+                for page in range(first_page, last_page + 1):
+                    if pages.get(page) is None:
+                        pages[page] = self._request(page)
+                for page in range(max(0, first_page - self.prefetch), last_page + self.prefetch + 1):
+                    if page * self.page_size < total:
+                        self._request(page)
+                missing = [self._loading[page] for page, rows in pages.items() if rows is None]
+            if not wait or not missing:
+                break
+            for future in missing:
+                future.result()
+        result = []
+        for position in range(first, last):
+            rows = pages[position // self.page_size]
+            index = position % self.page_size
+            result.append(rows[index] if rows is not None and index < len(rows) else None)
+        return result
+
+    def rating_envelope(self, columns):
+        # Min/max rating per pixel column over the whole history, kept until
+        # the history or the width changes
+        if self._source is None:
+            return []
+        key = (self._generation, columns)
+        if self._envelope is None or self._envelope[0] != key:
+            self._envelope = (key, minmax_decimate(self._source.ratings[:len(self)], columns))
+        return self._envelope[1]
+
+
+def minmax_decimate(values, columns):
+    # Split values into `columns` equal buckets and keep each bucket's
+    # (min, max): drawing a vertical line per column then shows every peak
+    # and dip a plain every-nth sample would skip.
+    n = len(values)
+    if n == 0 or columns <= 0:
+        return []
+    if n <= columns:
+        return [(value, value) for value in values]
+    envelope = []
+    for column in range(columns):
+        bucket = values[column * n // columns:(column + 1) * n // columns]
+        envelope.append((min(bucket), max(bucket)))
+    return envelope
@@ -0,0 +1,302 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import gc
+import hashlib
+import io
+import itertools
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+import numpy as np
+
+from habit_model import Habit
+from habit_replay import elo_trajectory
+from habit_storage import make_session, open_storage
+
+CHUNK_SIZE = 8 * 1024 * 1024
+IMPORT_BUSY_TIMEOUT = 120000
+
+# Columns with a meaning of their own; every other column is a parameter
+RESERVED_COLUMNS = ('habit', 'adv_score', 'difficulty', 'timestamp')
+
+
+def _timestamp(value):
+    # Unix seconds or an ISO 8601 date/time (local time unless it has an offset)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _file_chunks(path, data_start, chunk_size):
+    size = os.path.getsize(path)
+    start = data_start
+    while start < size:
+        end = min(start + chunk_size, size)
+        yield start, end
+        start = end
+
+
+def _read_lines(path, start, end):
+    # Lines belonging to [start, end): those that begin inside the range.
+    # One seek and one read per chunk, then the last line finished off.
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        first = f.tell()
+        data = f.read(max(end - first, 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    return io.StringIO(data.decode('utf-8'), newline='')
+
+
+def _parse_csv_chunk(path, header, start, end):
+    params = [column for column in header if column not in RESERVED_COLUMNS]
+    positions = {column: i for i, column in enumerate(header)}
+    habit_col = positions['habit']
+    adv_col = positions.get('adv_score')
+    difficulty_col = positions.get('difficulty')
+    timestamp_col = positions.get('timestamp')
+    param_cols = [(param, positions[param]) for param in params]
+    groups = {}
+    for row in csv.reader(_read_lines(path, start, end)):
+        if not row or len(row) <= habit_col:
+            continue
+        values = {}
+        for param, i in param_cols:
+            if i < len(row) and row[i] != '':
+                values[param] = float(row[i])
+        adv = row[adv_col] if adv_col is not None and adv_col < len(row) else ''
+        difficulty = row[difficulty_col] if difficulty_col is not None and difficulty_col < len(row) else ''
+        timestamp = row[timestamp_col] if timestamp_col is not None and timestamp_col < len(row) else ''
+        groups.setdefault(row[habit_col], []).append(
+            (values, float(adv) if adv != '' else None, difficulty or None, _timestamp(timestamp)))
+    return groups
+
+
+def _parse_jsonl_chunk(path, start, end):
+    groups = {}
+    for line in _read_lines(path, start, end):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        values = record.get('values')
+        if values is None:
+            values = {key: value for key, value in record.items() if key not in RESERVED_COLUMNS}
+        adv = record.get('adv_score')
+        groups.setdefault(record['habit'], []).append(
+            ({param: float(value) for param, value in values.items()},
+             None if adv is None else float(adv),
+             record.get('difficulty'),
+             _timestamp(record.get('timestamp'))))
+    return groups
+
+
+@contextlib.contextmanager
+def _no_gc():
+    # Both phases build millions of small objects that all stay alive until
+    # the task ends, so collection passes only cost time (about a sixth of
+    # the import); everything is freed by reference counting regardless
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _spool_chunk(path, kind, header, start, end, spool_dir, chunk_id):
+    with _no_gc():
+        return _spool(path, kind, header, start, end, spool_dir, chunk_id)
+
+
+def _spool(path, kind, header, start, end, spool_dir, chunk_id):
+    # Phase 1: parse one byte range and spool its rows per habit, keeping
+    # file order so every habit's sessions stay in sequence.
+    if kind == 'csv':
+        groups = _parse_csv_chunk(path, header, start, end)
+    else:
+        groups = _parse_jsonl_chunk(path, start, end)
+    spooled = {}
+    for i, (name, rows) in enumerate(groups.items()):
+        spool_file = os.path.join(spool_dir, f"{chunk_id:06d}_{i:06d}.pkl")
+        with open(spool_file, 'wb') as f:
+            pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        spooled[name] = (spool_file, len(rows), sorted(set().union(*map(itemgetter(0), rows))))
+    return chunk_id, spooled
+
+
+def _import_habit(location, name, meta, spool_files, params, difficulty, seed):
+    with _no_gc():
+        return _import(location, name, meta, spool_files, params, difficulty, seed)
+
+
+def _import(location, name, meta, spool_files, params, difficulty, seed):
+    # Phase 2: score and rate one habit's new sessions, then write them with
+    # a single append. Scores never depend on ratings, so they are one
+    # matrix product; every generated adversary is drawn at once from the
+    # score window before its row; the Elo recurrence is the replay engine's.
+    storage = open_storage(location, busy_timeout=IMPORT_BUSY_TIMEOUT)
+    habit = Habit(name, meta['params'], initial_rating=meta.get('rating', 500),
+                  k_factor=meta.get('k_factor', 20), storage=storage)
+    records = []
+    for spool_file in spool_files:
+        with open(spool_file, 'rb') as f:
+            records.extend(pickle.load(f))
+    if not records:
+        return name, habit.rating, 0
+    weights = habit.params
+    totals = _value_matrix(records, params) @ np.array([weights.get(param, 0) for param in params], dtype=np.float64)
+    adv_scores = np.array([np.nan if row[1] is None else row[1] for row in records])
+    difficulties = [row[2] for row in records]
+    generated = np.flatnonzero(np.isnan(adv_scores))
+    if len(generated):
+        for i in generated.tolist():
+            difficulties[i] = difficulties[i] or difficulty
+        if seed is not None:
+            seed = int.from_bytes(hashlib.blake2b(f"{seed}:{name}".encode('utf-8'), digest_size=8).digest(), 'little')
+        low, high = _adversary_bounds(habit, list(habit.scores), totals, generated,
+                                      [difficulties[i] for i in generated.tolist()])
+        adv_scores[generated] = np.random.default_rng(seed).uniform(low, high)
+    deltas, ratings = elo_trajectory(totals, adv_scores, habit.rating, habit.k_factor)
+    session = habit.session_count
+    rows = [make_session(session + i, total, adv_score, delta, rating, row[0], row[3], row_difficulty)
+            for i, (total, adv_score, delta, rating, row, row_difficulty) in enumerate(
+                zip(totals.tolist(), adv_scores.tolist(), deltas.tolist(), ratings.tolist(), records, difficulties), 1)]
+    habit.rating = rows[-1]['rating']
+    habit.session_count = session + len(rows)
+    if habit.window_size:
+        window = list(habit.scores) + totals[-habit.window_size:].tolist()
+        habit.scores.clear()
+        habit.scores.extend(window[-habit.window_size:])
+    with storage.transaction():
+        storage.append_sessions(name, rows, habit.checkpoint())
+    storage.close()
+    return name, habit.rating, len(rows)
+
+
+def _value_matrix(records, params):
+    # Sessions by parameters, 0 where a session lacks one
+    if not params:
+        return np.zeros((len(records), 0))
+    values = map(itemgetter(0), records)
+    try:
+        if len(params) == 1:
+            cells = map(itemgetter(params[0]), values)
+        else:
+            cells = itertools.chain.from_iterable(map(itemgetter(*params), values))
+        matrix = np.fromiter(cells, np.float64, len(records) * len(params))
+    except KeyError:
+        matrix = np.array([[row[0].get(param, 0.0) for param in params] for row in records])
+    return matrix.reshape(len(records), len(params))
+
+
+def _adversary_bounds(habit, prior, totals, positions, difficulties):
+    # Habit.adversary_bounds for the rows at the given positions, from the statistics
+    # of the window_size scores before it: the habit's window, then the
+    # imported totals. Windows come from running sums, shifted by the mean
+    # so that the variance does not cancel out.
+    scores = np.concatenate([np.array(prior, dtype=np.float64), totals])
+    shift = scores.mean()
+    sums = np.concatenate([[0.0], np.cumsum(scores - shift)])
+    squares = np.concatenate([[0.0], np.cumsum((scores - shift) ** 2)])
+    end = positions + len(prior)
+    start = np.maximum(end - habit.window_size, 0)
+    count = end - start
+    total = sums[end] - sums[start]
+    filled = np.maximum(count, 1)
+    mu = total / filled + shift
+    variance = (squares[end] - squares[start] - total * total / filled) / np.maximum(count - 1, 1)
+    sigma = np.where(count > 1, np.sqrt(np.maximum(variance, 0.0)), mu * 0.2)
+    bands = habit.difficulty_bands
+    low_k, high_k = np.array([bands.get(difficulty, bands['normal']) for difficulty in difficulties],
+                             dtype=np.float64).reshape(-1, 2).T
+    low = mu + low_k * sigma
+    low = np.where(low_k < 0, np.maximum(low, 0.0), low)
+    high = mu + high_k * sigma
+    # No scores yet: around the sum of the weights
+    base = sum(habit.params.values())
+    low = np.where(count > 0, low, base * 0.8)
+    high = np.where(count > 0, high, base * 1.2)
+    return low, high
+
+
+def _input_kind(path):
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl', None, 0
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]), [])
+        data_start = f.tell()
+    if 'habit' not in header:
+        raise ValueError(f"{path}: CSV input needs a 'habit' column")
+    return 'csv', header, data_start
+
+
+def import_sessions(paths, location=None, workers=None, difficulty='normal', seed=None,
+                    chunk_size=CHUNK_SIZE):
+    storage = open_storage(location)
+    location = storage.location
+    workers = workers or os.cpu_count() or 1
+    spool_dir = tempfile.mkdtemp(prefix='elohabits_import_')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = []
+            for path in paths:
+                kind, header, data_start = _input_kind(path)
+                for start, end in _file_chunks(path, data_start, chunk_size):
+                    jobs.append(pool.submit(_spool_chunk, path, kind, header, start, end,
+                                            spool_dir, len(jobs)))
+            spooled = sorted(job.result() for job in jobs)
+
+            habit_spools = {}
+            for _, chunk in spooled:
+                for name, (spool_file, count, params) in chunk.items():
+                    files, seen = habit_spools.setdefault(name, ([], set()))
+                    files.append(spool_file)
+                    seen.update(params)
+
+            # Habits that only exist in the input get every parameter at weight 1
+            habit_data = storage.load_index()
+            new_habits = [name for name in habit_spools if name not in habit_data]
+            for name in new_habits:
+                params = habit_spools[name][1]
+                habit_data[name] = {'params': {param: 1.0 for param in sorted(params)},
+                                    'rating': 500, 'k_factor': 20}
+            if new_habits:
+                storage.save_index(habit_data)
+
+            jobs = [pool.submit(_import_habit, location, name, habit_data[name], files, sorted(params),
+                                difficulty, seed)
+                    for name, (files, params) in habit_spools.items()]
+            results = [job.result() for job in jobs]
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    for name, rating, _ in results:
+        habit_data[name]['rating'] = rating
+    storage.save_index(habit_data)
+    storage.close()
+    return {name: count for name, _, count in results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import historical sessions from CSV or JSONL files")
+    parser.add_argument('files', nargs='+', help="CSV with a 'habit' column, or JSONL with a 'habit' key")
+    parser.add_argument('--data', default=None, help="Data directory or .db file (default: ELOHABITS_DB or .)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--difficulty', default='normal', help="Difficulty for rows without an adv_score")
+    parser.add_argument('--seed', default=None, help="Seed for generated adversaries")
+    args = parser.parse_args()
+    counts = import_sessions(args.files, args.data, args.workers, args.difficulty, args.seed)
+    print(f"Imported {sum(counts.values())} sessions into {len(counts)} habits")
@@ -0,0 +1,251 @@
+import random
+
+# Cross-habit rank index. Habits are kept in an indexable skip list ordered
+# by rating (highest first, ties by name), so an update, rank lookup or
+# top-k costs O(log n) (+k) instead of a scan and sort over every habit.
+
+MAX_LEVEL = 24
+LEVEL_P = 0.25
+
+# League-style tiers: (name, lowest rating in the tier), highest first.
+# The tiers below Master are split into divisions IV (bottom) to I; anything
+# under Iron's floor is still Iron IV.
+TIERS = (
+    ('Challenger', 1450),
+    ('Grandmaster', 1300),
+    ('Master', 1150),
+    ('Diamond', 1000),
+    ('Platinum', 850),
+    ('Gold', 700),
+    ('Silver', 550),
+    ('Bronze', 400),
+    ('Iron', 250)
+)
+APEX_TIERS = 3
+DIVISIONS = ('IV', 'III', 'II', 'I')
+TIER_SPAN = 150
+
+
+def tier(rating):
+    # e.g. 512 -> 'Bronze II', 1320 -> 'Grandmaster'
+    for i, (name, floor) in enumerate(TIERS):
+        if rating >= floor or i == len(TIERS) - 1:
+            if i < APEX_TIERS:
+                return name
+            division = int((rating - floor) * len(DIVISIONS) // TIER_SPAN)
+            return f"{name} {DIVISIONS[min(max(division, 0), len(DIVISIONS) - 1)]}"
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        self.width = [1] * level  # positions skipped by each forward link
+
+
+class SkipList:
+    # Ordered set of unique keys with positional access. Each forward link
+    # records how many positions it skips, so rank and index lookups are
+    # O(log n) expected.
+    def __init__(self, keys=(), seed=None):
+        self._head = _Node(None, MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+        self._random = random.Random(seed)  # leaves the global generator alone
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        node = self._head.next[0]
+        while node is not None:
+            yield node.key
+            node = node.next[0]
+
+    def _random_level(self):
+        level = 1
+        while level < MAX_LEVEL and self._random.random() < LEVEL_P:
+            level += 1
+        return level
+
+    def _path(self, key):
+        # Last node before `key` on every level, and its position
+        update = [self._head] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node = self._head
+        position = 0
+        for level in range(self._level - 1, -1, -1):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            update[level] = node
+            positions[level] = position
+        return update, positions
+
+    def add(self, key):
+        update, positions = self._path(key)
+        found = update[0].next[0]
+        if found is not None and found.key == key:
+            return False
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                update[i] = self._head
+                positions[i] = 0
+                self._head.width[i] = self._size + 1
+            self._level = level
+        node = _Node(key, level)
+        position = positions[0] + 1  # 1-based position of the new node
+        for i in range(level):
+            before = update[i]
+            node.next[i] = before.next[i]
+            before.next[i] = node
+            skipped = position - positions[i]
+            node.width[i] = before.width[i] - skipped + 1
+            before.width[i] = skipped
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+        return True
+
+    def remove(self, key):
+        update, _ = self._path(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(self._level):
+            before = update[i]
+            if before.next[i] is node:
+                before.width[i] += node.width[i] - 1
+                before.next[i] = node.next[i]
+            else:
+                before.width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+
+    def index(self, key):
+        # 0-based position of key
+        node = self._head
+        position = 0
+        for level in range(self._level - 1, -1, -1):
+            while node.next[level] is not None and node.next[level].key <= key:
+                position += node.width[level]
+                node = node.next[level]
+            if node is not self._head and node.key == key:
+                return position - 1
+        raise KeyError(key)
+
+    def bisect_left(self, key):
+        # Number of keys smaller than key
+        return self._path(key)[1][0]
+
+    def _node_at(self, index):
+        node = self._head
+        remaining = index + 1
+        for level in range(self._level - 1, -1, -1):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("skip list index out of range")
+        return self._node_at(index).key
+
+    def islice(self, start=0, stop=None):
+        # Keys from position start up to stop, walking the bottom level
+        stop = self._size if stop is None else min(stop, self._size)
+        if start >= stop:
+            return
+        node = self._node_at(start)
+        for _ in range(stop - start):
+            yield node.key
+            node = node.next[0]
+
+
+class Leaderboard:
+    # Habit names ordered by rating. HabitManager keeps it in step through
+    # Habit's rating callback; every query reads the index, nothing rescans.
+    def __init__(self, ratings=None):
+        self._ratings = {}
+        self._index = SkipList()
+        for name, rating in (ratings or {}).items():
+            self.update(name, rating)
+
+    def __len__(self):
+        return len(self._ratings)
+
+    def __contains__(self, name):
+        return name in self._ratings
+
+    def rating(self, name):
+        return self._ratings[name]
+
+    def update(self, name, rating):
+        # Adds the habit or moves it to its new rating
+        old = self._ratings.get(name)
+        if old is not None:
+            if old == rating:
+                return
+            self._index.remove((-old, name))
+        self._ratings[name] = rating
+        self._index.add((-rating, name))
+
+    def remove(self, name):
+        rating = self._ratings.pop(name, None)
+        if rating is not None:
+            self._index.remove((-rating, name))
+
+    def rank_of(self, name):
+        # 1 is the highest rated habit
+        return self._index.index((-self._ratings[name], name)) + 1
+
+    def percentile(self, name):
+        # Share of the other habits this one outranks, 0-100
+        others = len(self._ratings) - 1
+        if others <= 0:
+            return 100.0
+        return 100.0 * (others - (self.rank_of(name) - 1)) / others
+
+    def tier_of(self, name):
+        return tier(self._ratings[name])
+
+    def standings(self, start=0, count=10):
+        # (rank, name, rating) rows for ranks start+1 .. start+count
+        return [(start + i + 1, name, -negative)
+                for i, (negative, name) in enumerate(self._index.islice(start, start + count))]
+
+    def top(self, k=10):
+        return self.standings(0, k)
+
+    def between(self, low, high):
+        # (rank, name, rating) for every habit rated within [low, high]
+        start = self._index.bisect_left((-high, ''))
+        rows = []
+        for negative, name in self._index.islice(start):
+            if -negative < low:
+                break
+            start += 1
+            rows.append((start, name, -negative))
+        return rows
+
+    def tier_counts(self):
+        # Habits per tier, top tier first: one O(log n) lookup per boundary
+        counts = []
+        above = 0
+        for i, (name, floor) in enumerate(TIERS):
+            if i == len(TIERS) - 1:
+                at_or_above = len(self._ratings)
+            else:
+                at_or_above = self._index.bisect_left((-floor, chr(0x10FFFF)))
+            counts.append((name, at_or_above - above))
+            above = at_or_above
+        return counts
@@ -0,0 +1,163 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Opt-in instrumentation. Nothing is recorded unless enabled, either with
+# enable() or through the environment:
+#   ELOHABITS_METRICS=metrics.json   (or metrics.prom for Prometheus text)
+#   ELOHABITS_PROFILE=profile.prof   (cProfile of the main thread)
+# Both files are written when the process exits.
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# inspect.CO_COROUTINE; inspect itself takes longer to import than the CLI
+# has to start
+CO_COROUTINE = 0x80
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {
+                    'count': 0, 'total': 0.0, 'min': seconds, 'max': seconds, 'buckets': [0] * len(BUCKETS)
+                }
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['min'] = min(timer['min'], seconds)
+            timer['max'] = max(timer['max'], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer['buckets'][i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                timers[name] = dict(timer, buckets=list(timer['buckets']),
+                                    mean=timer['total'] / timer['count'])
+            return {'timers': timers, 'counters': dict(self.counters)}
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, timer in sorted(snapshot['timers'].items()):
+            metric = f"elohabits_{_metric_name(name)}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, hits in zip(BUCKETS, timer['buckets']):
+                cumulative += hits
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {timer["count"]}')
+            lines.append(f"{metric}_sum {timer['total']:.9f}")
+            lines.append(f"{metric}_count {timer['count']}")
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = f"elohabits_{_metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            if path.endswith(('.prom', '.txt')):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp_file, path)
+
+
+def _metric_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name).lower()
+
+
+REGISTRY = MetricsRegistry()
+_profiler = None
+
+
+def timed(name):
+    # Decorator: records the call duration under `name` while enabled; when
+    # disabled the only cost is one attribute check. Coroutine functions are
+    # timed until they finish, not until they return their coroutine.
+    def decorate(fn):
+        code = getattr(fn, '__code__', None)
+        if code is not None and code.co_flags & CO_COROUTINE:
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not REGISTRY.enabled:
+                    return await fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    REGISTRY.observe(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                REGISTRY.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    if REGISTRY.enabled:
+        REGISTRY.count(name, value)
+
+
+def enable(dump_path=None, profile_path=None):
+    global _profiler
+    REGISTRY.enabled = True
+    if dump_path:
+        atexit.register(REGISTRY.dump, dump_path)
+    if profile_path and _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        atexit.register(_dump_profile, profile_path)
+
+
+def disable():
+    REGISTRY.enabled = False
+
+
+def _dump_profile(path):
+    _profiler.disable()
+    _profiler.dump_stats(path)
+
+
+def configure_from_env():
+    dump_path = os.environ.get('ELOHABITS_METRICS')
+    profile_path = os.environ.get('ELOHABITS_PROFILE')
+    if dump_path or profile_path:
+        enable(dump_path, profile_path)
+
+
+configure_from_env()
@@ -1,185 +1,638 @@
-import csv
-import os
+import math
 import random
-import statistics
-import json
-from collections import deque
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from itertools import islice, repeat
+from operator import mul
+import habit_metrics as metrics
+from habit_storage import LegacyStorage, make_session, open_storage
+
+MAX_RESIDENT_HABITS = 64
+
+# Adversary range around the window mean, in standard deviations
+DIFFICULTY_BANDS = {
+    'easy': (-1.5, 0.0),
+    'normal': (-1.0, 1.0),
+    'hard': (0.0, 1.5)
+}
+
+# Layout of Habit._state, one packed array of doubles per habit:
+#   [rating, sessions, window mean, window M2, cached low, cached high,
+#    weights (one per param) ..., score window ring (window_size, loaded only)]
+_RATING, _SESSIONS, _MEAN, _M2, _LOW, _HIGH = range(6)
+_WEIGHTS = 6
+
+# Param name tuples are shared by every habit with the same parameters
+_PARAM_NAMES = {}
+
+
+def _intern_names(params):
+    names = tuple(params)
+    shared = _PARAM_NAMES.get(names)
+    if shared is None:
+        shared = tuple(sys.intern(str(param)) for param in names)
+        shared = _PARAM_NAMES.setdefault(shared, shared)
+        _PARAM_NAMES[names] = shared
+    return shared
+
+
+class ScoreWindow:
+    # Live view of a habit's score window, oldest score first. The scores
+    # themselves sit in the habit's packed state as a ring buffer with a
+    # running mean and sum of squared deviations (Welford), so mean/stdev
+    # cost O(1) instead of a pass over the window.
+    __slots__ = ('_habit',)
+
+    def __init__(self, habit):
+        self._habit = habit
+
+    @property
+    def maxlen(self):
+        return self._habit.window_size
+
+    @property
+    def mean(self):
+        return self._habit.ensure_loaded()._state[_MEAN]
+
+    def __len__(self):
+        return self._habit.ensure_loaded()._count
+
+    def __iter__(self):
+        return iter(self._habit.ensure_loaded()._window())
+
+    def __getitem__(self, index):
+        return self._habit.ensure_loaded()._window()[index]
+
+    def __repr__(self):
+        return f"ScoreWindow({list(self)!r}, maxlen={self.maxlen})"
+
+    def append(self, value):
+        self._habit.ensure_loaded()._push_score(float(value))
+
+    def extend(self, values):
+        habit = self._habit.ensure_loaded()
+        for value in values:
+            habit._push_score(float(value))
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def clear(self):
+        self._habit.ensure_loaded()._reset_window()
+
+    def variance(self):
+        habit = self._habit.ensure_loaded()
+        if habit._count < 2:
+            return 0.0
+        return max(habit._state[_M2], 0.0) / (habit._count - 1)
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
 
 class Habit:
-    def __init__(self, name, parameters, weights, difficulty='Normal'):
-        self.name = name
-        self.parameters = parameters  # List of parameter names
-        self.weights = weights  # Dict: {parameter_name: weight}
-        self.difficulty = difficulty
-        self.history_file = f"{name}_history.csv"
-        self.elo = 1000  # Default ELO
-        self.load_elo()
-
-    def load_elo(self):
-        if os.path.exists(self.history_file):
-            with open(self.history_file, 'r') as f:
-                lines = f.readlines()
-                if len(lines) > 1:
-                    last_line = lines[-1].strip().split(',')
-                    self.elo = float(last_line[-1])
-
-    def save_session(self, user_score, adversary_score, result):
-        if not os.path.exists(self.history_file):
-            with open(self.history_file, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(['User Score', 'Adversary Score', 'Result', 'New ELO'])
-
-        with open(self.history_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([user_score, adversary_score, result, self.elo])
-
-    def calculate_score(self, performance):
-        return sum(performance[param] * self.weights.get(param, 1) for param in self.parameters)
-
-    def generate_adversary_score(self):
-        recent_scores = []
-        if os.path.exists(self.history_file):
-            with open(self.history_file, 'r') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        recent_scores.append(float(row['User Score']))
-                    except:
-                        pass
-        avg = sum(recent_scores[-5:]) / min(len(recent_scores[-5:]), 5) if recent_scores else 10
-
-        if self.difficulty == 'Easy':
-            return random.uniform(0.7, 0.9) * avg
-        elif self.difficulty == 'Hard':
-            return random.uniform(1.1, 1.3) * avg
-        return random.uniform(0.9, 1.1) * avg
-
-    def update_elo(self, user_score, adversary_score):
-        result = 1 if user_score > adversary_score else 0 if user_score < adversary_score else 0.5
-        expected_score = 1 / (1 + 10 ** ((adversary_score - user_score) / 400))
-        k = 32
-        self.elo += k * (result - expected_score)
-        self.elo = round(self.elo, 2)
-        self.save_session(user_score, adversary_score, result)
-        return result
+    # Slotted, with all numeric state in one array('d'); a loaded habit with
+    # a 30-score window takes about 500 bytes.
+    __slots__ = ('name', 'window_size', 'k_factor', 'storage', 'on_load', 'on_rating', 'on_session',
+                 '_param_names', '_state', '_head', '_count', '_bounds_difficulty')
+
+    difficulty_bands = DIFFICULTY_BANDS
 
-    def __init__(self, name, params, initial_rating=500, window_size=30, k_factor=20):
+    def __init__(self, name, params, initial_rating=500, window_size=30, k_factor=20, storage=None,
+                 lazy=False, on_load=None, on_rating=None, on_session=None):
         self.name = name
-        self.params = params
-        self.rating = initial_rating
-        self.scores = deque(maxlen=window_size)
+        self.window_size = window_size
         self.k_factor = k_factor
-        self.history_file = f"habit_{name}.csv"
-        self.load_history()
-
-    def load_history(self):
-        if os.path.exists(self.history_file):
-            with open(self.history_file, 'r', newline='') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        self.scores.append(float(row['total_score']))
-                        self.rating = float(row['rating'])
-                    except (KeyError, ValueError):
-                        continue
-
-    def save_session(self, values, total_score, adv_score, delta):
-        file_exists = os.path.exists(self.history_file)
-        with open(self.history_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                headers = ['session', 'total_score', 'adv_score', 'delta', 'rating'] + list(values.keys())
-                writer.writerow(headers)
-
-            session_num = len(self.scores)
-            row = [session_num, total_score, adv_score, delta, self.rating] + list(values.values())
-            writer.writerow(row)
+        self.storage = storage if storage is not None else LegacyStorage()
+        self.on_load = on_load
+        self.on_rating = on_rating  # called as on_rating(habit) after every rating change
+        self.on_session = on_session  # called as on_session(habit, row) after every saved session
+        self._param_names = _intern_names(params)
+        self._state = array('d', (initial_rating, 0.0, 0.0, 0.0, 0.0, 0.0, *params.values()))
+        self._head = 0
+        self._count = None  # None until the history window is loaded
+        self._bounds_difficulty = None
+        # A lazy habit is just a handle (name, params, rating from the index)
+        # until something needs its history window.
+        if not lazy:
+            self.load_history()
+
+    @property
+    def params(self):
+        end = _WEIGHTS + len(self._param_names)
+        return dict(zip(self._param_names, self._state[_WEIGHTS:end]))
+
+    @params.setter
+    def params(self, params):
+        # Rebuild the state around the new weights, keeping the window
+        end = _WEIGHTS + len(self._param_names)
+        self._param_names = _intern_names(params)
+        self._state = self._state[:_WEIGHTS] + array('d', params.values()) + self._state[end:]
+
+    @property
+    def rating(self):
+        return self._state[_RATING]
+
+    @rating.setter
+    def rating(self, value):
+        self._state[_RATING] = value
+        if self.on_rating is not None:
+            self.on_rating(self)
+
+    @property
+    def loaded(self):
+        return self._count is not None
+
+    @property
+    def scores(self):
+        self.ensure_loaded()
+        return ScoreWindow(self)
+
+    @property
+    def session_count(self):
+        self.ensure_loaded()
+        return int(self._state[_SESSIONS])
+
+    @session_count.setter
+    def session_count(self, value):
+        self._state[_SESSIONS] = value
+
+    def ensure_loaded(self):
+        if self._count is None:
+            self.load_history()
+        return self
+
+    @metrics.timed('habit.load_history')
+    def load_history(self, window=None):
+        # window: a (scores, rating, session_count) tuple already read from
+        # storage.load_window, e.g. on another thread
+        if window is None:
+            window = self.storage.load_window(self.name, self.window_size)
+        scores, rating, session_count = window
+        offset = _WEIGHTS + len(self._param_names)
+        # Concatenation sizes the array exactly; nothing is over-allocated
+        self._state = self._state[:offset] + array('d', bytes(8 * self.window_size))
+        self._reset_window()
+        for score in scores[-self.window_size:]:
+            self._push_score(float(score))
+        if rating is not None:
+            self.rating = rating
+        self._state[_SESSIONS] = session_count
+        if self.on_load is not None:
+            self.on_load(self)
+
+    def unload(self):
+        # Everything in the window is already persisted
+        self._state = self._state[:_WEIGHTS + len(self._param_names)]
+        self._count = None
+        self._head = 0
+        self._bounds_difficulty = None
+
+    # Score window ring buffer
+
+    def _window(self):
+        # Scores oldest first, as a list
+        state = self._state
+        offset = _WEIGHTS + len(self._param_names)
+        if self._count < self.window_size:
+            return state[offset:offset + self._count].tolist()
+        head = offset + self._head
+        return state[head:].tolist() + state[offset:head].tolist()
+
+    def _reset_window(self):
+        state = self._state
+        state[_MEAN] = 0.0
+        state[_M2] = 0.0
+        self._head = 0
+        self._count = 0
+        self._bounds_difficulty = None
+
+    def _push_score(self, value):
+        state = self._state
+        size = self.window_size
+        if not size:
+            return
+        slot = _WEIGHTS + len(self._param_names) + self._head
+        mean = state[_MEAN]
+        m2 = state[_M2]
+        if self._count == size:
+            # Evict the oldest score, which sits where the new one goes
+            if size == 1:
+                mean = m2 = 0.0
+            else:
+                evicted = state[slot]
+                delta = evicted - mean
+                mean -= delta / (size - 1)
+                m2 -= delta * (evicted - mean)
+        else:
+            self._count += 1
+        state[slot] = value
+        delta = value - mean
+        mean += delta / self._count
+        m2 += delta * (value - mean)
+        state[_MEAN] = mean
+        state[_M2] = m2
+        self._head = (self._head + 1) % size
+        self._bounds_difficulty = None
+        if self._head == 0:
+            # Add/evict accumulates rounding error; resync once per lap
+            window = self._window()
+            mean = math.fsum(window) / self._count
+            state[_MEAN] = mean
+            state[_M2] = math.fsum((score - mean) ** 2 for score in window)
+
+    def checkpoint(self):
+        self.ensure_loaded()
+        return {
+            'rating': self._state[_RATING],
+            'sessions': int(self._state[_SESSIONS]),
+            'scores': self._window()
+        }
 
+    @metrics.timed('habit.save_session')
+    def save_session(self, values, total_score, adv_score, delta, difficulty=None, timestamp=None):
+        self.session_count += 1
+        row = make_session(self.session_count, total_score, adv_score, delta, self.rating, dict(values),
+                           time.time() if timestamp is None else timestamp, difficulty)
+        self.storage.append_sessions(self.name, [row], self.checkpoint())
+        if self.on_session is not None:
+            self.on_session(self, row)
+
+    @metrics.timed('habit.generate_adversary')
     def generate_adversary(self, difficulty):
-        if not self.scores:
-            base = sum(weight * 1 for weight in self.params.values())
-            actual = random.uniform(base * 0.8, base * 1.2)
-            return (base * 0.8, base * 1.2, actual)
+        low, high = self.adversary_bounds(difficulty)
+        # Generate actual score within defined range
+        actual = random.uniform(low, high)
+        return (low, high, actual)
+
+    def adversary_bounds(self, difficulty):
+        if self._count is None:
+            self.load_history()
+        state = self._state
+        count = self._count
+        if not count:
+            base = sum(state[_WEIGHTS:_WEIGHTS + len(self._param_names)])
+            return (base * 0.8, base * 1.2)
+
+        # Bounds only change when a score lands in the window
+        if self._bounds_difficulty == difficulty:
+            return (state[_LOW], state[_HIGH])
+
+        mu = state[_MEAN]
 
-        mu = statistics.mean(self.scores)
-        
         # Calculate standard deviation with fallback
-        if len(self.scores) > 1:
-            sigma = statistics.stdev(self.scores)
+        if count > 1:
+            sigma = math.sqrt(max(state[_M2], 0.0) / (count - 1))
         else:
             sigma = mu * 0.2  # Default to 20% of mean for new habits
 
         # Define ranges based on difficulty
-        if difficulty == "easy":
-            low = max(0, mu - 1.5 * sigma)
-            high = mu
-        elif difficulty == "hard":
-            low = mu
-            high = mu + 1.5 * sigma
-        else:  # normal
-            low = max(0, mu - sigma)
-            high = mu + sigma
+        low_k, high_k = self.difficulty_bands.get(difficulty, self.difficulty_bands['normal'])
+        low = mu + low_k * sigma
+        if low_k < 0:
+            low = max(0, low)
+        high = mu + high_k * sigma
 
-        # Generate actual score within defined range
-        actual = random.uniform(low, high)
-        return (low, high, actual)
+        state[_LOW] = low
+        state[_HIGH] = high
+        self._bounds_difficulty = difficulty
+        return (low, high)
 
     def calculate_score(self, values):
-        return sum(value * self.params.get(param, 0) for param, value in values.items())
+        # Params missing from values score 0, values without a param are ignored
+        names = self._param_names
+        weights = self._state[_WEIGHTS:_WEIGHTS + len(names)]
+        return sum(map(mul, map(values.get, names, repeat(0)), weights))
 
     def update_rating(self, user_score, adv_score):
-        expected = 1 / (1 + 10 ** ((adv_score - self.rating) / 400))
+        if self._count is None:
+            self.load_history()  # the index rating may predate the last sessions
+        rating = self._state[_RATING]
+        expected = 1 / (1 + 10 ** ((adv_score - rating) / 400))
         actual = 1 if user_score > adv_score else 0.5 if user_score == adv_score else 0
         delta = self.k_factor * (actual - expected)
-        self.rating += delta
+        self._state[_RATING] = rating + delta
+        if self.on_rating is not None:
+            self.on_rating(self)
         return delta
 
 class HabitManager:
-    def __init__(self):
+    def __init__(self, storage=None, max_resident=MAX_RESIDENT_HABITS):
+        self.storage = storage if storage is not None else open_storage()
+        self.max_resident = max(1, max_resident)
         self.habits = {}
         self.current_habit = None
+        self._resident = OrderedDict()
+        self._index_ratings = {}  # name -> index rating, until the habit's history is first loaded
+        self._unsaved_index = set()  # habits whose index entry lags, e.g. the rating after a session
+        # Leaderboard, rollups and segment helpers are imported where they
+        # are used, to keep them out of a CLI command's start-up time
+        from habit_leaderboard import Leaderboard
+        self.leaderboard = Leaderboard()
+        self._rollups = {}  # name -> Rollups, for resident habits analysed this run (None: stale)
+        self._unsaved_rollups = set()
+        # One bound method of each shared by every habit
+        self._on_load = self._habit_loaded
+        self._on_rating = self._rating_changed
+        self._on_session = self._session_saved
         self.load_habits()
 
-    def create_habit(self, name, params):
-        self.habits[name] = Habit(name, params, initial_rating=500, k_factor=20)
-        self.save_habits()
+    def create_habit(self, name, params, k_factor=20):
+        self.habits[name] = Habit(name, params, initial_rating=500, k_factor=k_factor, storage=self.storage,
+                                  on_load=self._on_load, on_rating=self._on_rating, on_session=self._on_session)
+        self.leaderboard.update(name, self.habits[name].rating)
+        self.storage.save_habit(name, self.habit_meta(self.habits[name]))
+
+    def _rating_changed(self, habit):
+        # Keeps the leaderboard in step, O(log n) per change
+        if self.habits.get(habit.name) is habit:
+            self.leaderboard.update(habit.name, habit.rating)
+
+    def _habit_loaded(self, habit):
+        # An index saved before the last sessions lags the history; the
+        # rating just loaded replaces it in memory, and save_changes writes
+        # every repair in one go, so the next run ranks the habit right
+        index_rating = self._index_ratings.pop(habit.name, None)
+        if index_rating is not None and index_rating != habit.rating:
+            self._unsaved_index.add(habit.name)
+        # LRU over habits whose history window is in memory; the habit just
+        # loaded and the current habit are never evicted. An evicted habit's
+        # rollups go with it, saved first if sessions changed them.
+        self._resident[habit.name] = habit
+        self._resident.move_to_end(habit.name)
+        for name, oldest in list(self._resident.items()):
+            if len(self._resident) <= self.max_resident:
+                break
+            if oldest is habit or oldest is self.current_habit:
+                continue
+            del self._resident[name]
+            oldest.unload()
+            self._drop_rollups(name)
 
     def delete_habit(self, name):
         if name in self.habits:
             del self.habits[name]
-            history_file = f"habit_{name}.csv"
-            if os.path.exists(history_file):
-                os.remove(history_file)
-            self.save_habits()
+            self._resident.pop(name, None)
+            self._index_ratings.pop(name, None)
+            self._unsaved_index.discard(name)
+            self._rollups.pop(name, None)
+            self._unsaved_rollups.discard(name)
+            self.leaderboard.remove(name)
+            self.storage.delete_habit(name)
 
     def set_current_habit(self, name):
         self.current_habit = self.habits.get(name)
+        if self.current_habit is not None:
+            self.current_habit.ensure_loaded()
+
+    def record_session(self, name, values, difficulty='normal', adv_score=None):
+        # One complete session: score it, face a fresh adversary (or the
+        # given adversary score), update the rating and persist it.
+        habit = self.habits[name].ensure_loaded()
+        user_score = habit.calculate_score(values)
+        low, high, actual = habit.generate_adversary(difficulty)
+        if adv_score is None:
+            adv_score = actual
+        delta = habit.update_rating(user_score, adv_score)
+        habit.scores.append(user_score)
+        habit.save_session(values, user_score, adv_score, delta, difficulty)
+        return {
+            'habit': name,
+            'session': habit.session_count,
+            'score': user_score,
+            'adv_low': low,
+            'adv_high': high,
+            'adv_score': adv_score,
+            'delta': delta,
+            'rating': habit.rating
+        }
 
-    def update_habit_params(self, name, new_params):
+    def update_habit_params(self, name, new_params, recompute=False):
         if name in self.habits:
-            self.habits[name].params = new_params
-            self.save_habits()
+            if recompute:
+                self.replay_habit(name, params=new_params, apply=True)
+            else:
+                self.habits[name].params = new_params
+                self.storage.save_habit(name, self.habit_meta(self.habits[name]))
 
-    def save_habits(self):
-        habit_data = {
-            name: {
-                'params': habit.params,
-                'rating': habit.rating,
-                'k_factor': habit.k_factor
-            }
-            for name, habit in self.habits.items()
+    def replay_habit(self, name, params=None, k_factor=None, apply=False):
+        # Rescore the whole history under other weights / k_factor. With
+        # apply=True the stored history and rating are rewritten to match.
+        from habit_replay import replay_habit
+        habit = self.habits[name]
+        result = replay_habit(habit, params, k_factor, apply)
+        if apply:
+            self.storage.save_habit(name, self.habit_meta(habit))
+            self._forget_rollups(name)  # outcomes changed with the scores
+        return result
+
+    def merge_sessions(self, name, start, rows, params=None, k_factor=None):
+        # Sync: folds sessions from another device into the history after its
+        # first `start` sessions, in timestamp order (see habit_sync). Ratings
+        # are recomputed from the first session that moved; a habit only the
+        # other device had is created with its params. Returns how many
+        # sessions were new.
+        if name not in self.habits:
+            self.create_habit(name, params, 20 if k_factor is None else k_factor)
+        habit = self.habits[name].ensure_loaded()
+        return self.apply_merge(habit, self.write_merge(habit, start, rows))
+
+    def write_merge(self, habit, start, rows):
+        # The storage half of merge_sessions, which touches no model state and
+        # so may run on a worker thread (the server does). Returns the history
+        # window as written, or None when nothing changed, and the sessions added.
+        from habit_sync import merge_tail
+        name = habit.name
+        tail = self.sessions_from(name, start + 1)
+        initial_rating = tail[0]['rating'] - tail[0]['delta'] if tail else habit.rating
+        merged, first, added = merge_tail(tail, rows, start + 1, initial_rating, habit.k_factor)
+        if first == len(merged):
+            return None, 0  # nothing new and nothing moved
+        if first == len(tail):
+            self.storage.append_sessions(name, merged[first:])
+        else:
+            self.storage.replace_sessions(name, self.sessions_from(name, 1, start) + merged)
+        return self.storage.load_window(name, habit.window_size), added
+
+    def apply_merge(self, habit, merge):
+        # The model half, on the thread that owns the manager
+        window, added = merge
+        if window is None:
+            return 0
+        self._forget_rollups(habit.name)
+        habit.load_history(window)  # rating, score window and session count as written
+        self.storage.save_habit(habit.name, self.habit_meta(habit))
+        return added
+
+    def read_habit(self, habit):
+        # What loading a habit reads from storage, for a caller that reads it
+        # on a worker thread and hands it to load_habit on the manager's
+        # thread (the server does): the history window
+        return self.storage.load_window(habit.name, habit.window_size)
+
+    def load_habit(self, habit, window):
+        habit.load_history(window)
+
+    def habit_meta(self, habit):
+        return {
+            'params': habit.params,
+            'rating': habit.rating,
+            'k_factor': habit.k_factor
         }
-        with open('habits.json', 'w') as f:
-            json.dump(habit_data, f, indent=4)
 
+    @metrics.timed('manager.save_habits')
+    def save_habits(self):
+        habit_data = {name: self.habit_meta(habit) for name, habit in self.habits.items()}
+        self.storage.save_index(habit_data)
+        self._unsaved_index.clear()
+        self.save_rollups()
+
+    def save_changes(self):
+        # What sessions left unsaved: the index, in one write however many
+        # ratings changed, and the rollups. Called at exit and periodically.
+        if self._unsaved_index:
+            self.save_habits()
+        else:
+            self.save_rollups()
+
+    # Analytics
+
+    def _session_saved(self, habit, row):
+        # The index rating is saved with the next save_changes (a whole
+        # index rewrite per session would cost more than the session); an
+        # index that missed it is repaired when the habit next loads. The
+        # session is folded into the habit's rollups if a query has them in
+        # memory; otherwise it is only in the history, which the next query
+        # catches the stored rollups up from. No storage read either way.
+        self._unsaved_index.add(habit.name)
+        rollups = self._rollups.get(habit.name)
+        if rollups is not None:
+            rollups.add(row)
+            self._unsaved_rollups.add(habit.name)
+
+    @metrics.timed('manager.rollups')
+    def rollups(self, name):
+        # The habit's Rollups, in step with its history: kept in memory once
+        # loaded, caught up from the sessions saved after them, or rebuilt
+        # with one scan when the history no longer matches (e.g. replayed)
+        rollups = self._rollups.get(name)
+        if rollups is not None:
+            return rollups
+        from habit_rollups import Rollups
+        habit = self.habits[name].ensure_loaded()
+        text = self.storage.load_rollups(name)
+        rollups = Rollups.loads(text) if text else None
+        current = [habit.session_count, habit.rating] if habit.session_count else None
+        if rollups is not None and rollups.last != current:
+            rows = self.sessions_since(name, rollups.last)
+            if rows is None:
+                rollups = None
+            else:
+                for row in rows:
+                    rollups.add(row)
+                self._unsaved_rollups.add(name)
+        if rollups is None:
+            rollups = Rollups.from_sessions(self.storage.iter_sessions(name))
+            self._unsaved_rollups.add(name)
+        self._rollups[name] = rollups
+        return rollups
+
+    def sessions_from(self, name, first_session, count=sys.maxsize):
+        # Up to count sessions from first_session on, oldest first
+        read_sessions = getattr(self.storage, 'read_sessions', None)
+        if read_sessions is not None:
+            return read_sessions(name, first_session, count)
+        rows = (row for row in self.storage.iter_sessions(name) if row['session'] >= first_session)
+        return list(islice(rows, count))
+
+    def sessions_since(self, name, last):
+        # Sessions after last = [session, rating], or None when the history
+        # no longer has that session with that rating
+        if last is None:
+            return None
+        rows = self.sessions_from(name, last[0])
+        if not rows or [rows[0]['session'], rows[0]['rating']] != last:
+            return None
+        return rows[1:]
+
+    def _forget_rollups(self, name):
+        # After a rewritten history; no sessions are folded in until the
+        # next query catches the stored rollups up or rebuilds them
+        self._rollups[name] = None
+        self._unsaved_rollups.discard(name)
+
+    def _drop_rollups(self, name):
+        rollups = self._rollups.pop(name, None)
+        if name in self._unsaved_rollups:
+            self._unsaved_rollups.discard(name)
+            if rollups is not None:
+                self.storage.save_rollups(name, rollups.dumps())
+
+    def save_rollups(self):
+        while self._unsaved_rollups:
+            name = self._unsaved_rollups.pop()
+            if self._rollups.get(name) is not None:
+                self.storage.save_rollups(name, self._rollups[name].dumps())
+
+    def trend(self, name, column='total_score', period='week', stat='mean', start=None, end=None):
+        # [(bucket, value)] oldest first, e.g. the weekly mean of one
+        # parameter: trend(name, 'pushups', 'week', 'mean')
+        return self.rollups(name).trend(column, period, stat, start, end)
+
+    def win_rates(self, name, period='all', start=None, end=None):
+        return self.rollups(name).win_rates(period, start, end)
+
+    def streaks(self, name, today=None):
+        return self.rollups(name).streaks(today)
+
+    def summary(self, name, column='total_score', first_session=None, last_session=None):
+        # count/sum/mean/stdev/min/max of one column over a range of
+        # sessions; compacted history answers from its segment footers
+        from habit_segments import add_value, describe, session_value
+        aggregate = getattr(self.storage, 'aggregate', None)
+        if aggregate is not None:
+            return describe(aggregate(name, column, first_session, last_session))
+        entry = None
+        for row in self.storage.iter_sessions(name):
+            if first_session is not None and row['session'] < first_session:
+                continue
+            if last_session is not None and row['session'] > last_session:
+                break
+            value = session_value(row, column)
+            if value is not None:
+                entry = add_value(entry, value)
+        return describe(entry)
+
+    def compact(self, names=None, segment_size=None, codec=None):
+        # Moves old sessions into compressed segments, keeping each habit's
+        # score window in the hot CSV tail; {name: sessions moved}. Backends
+        # without segments (SQLite, columnar) have nothing to compact.
+        from habit_segments import DEFAULT_CODEC, SEGMENT_SESSIONS
+        compact = getattr(self.storage, 'compact', None)
+        if compact is None:
+            return {}
+        segment_size = segment_size or SEGMENT_SESSIONS
+        codec = codec or DEFAULT_CODEC
+        return {name: compact(name, self.habits[name].window_size, segment_size, codec)
+                for name in (names if names is not None else list(self.habits))}
+
+    @metrics.timed('manager.load_habits')
     def load_habits(self):
-        if os.path.exists('habits.json'):
-            with open('habits.json', 'r') as f:
-                habit_data = json.load(f)
-                for name, data in habit_data.items():
-                    self.habits[name] = Habit(
-                        name=name,
-                        params=data['params'],
-                        initial_rating=data.get('rating', 500),
-                        k_factor=data.get('k_factor', 20)
-                    )
+        habit_data = self.storage.load_index()
+        for name, data in habit_data.items():
+            self.habits[name] = Habit(
+                name=name,
+                params=data['params'],
+                initial_rating=data.get('rating', 500),
+                k_factor=data.get('k_factor', 20),
+                storage=self.storage,
+                lazy=True,
+                on_load=self._on_load,
+                on_rating=self._on_rating,
+                on_session=self._on_session
+            )
+            self.leaderboard.update(name, self.habits[name].rating)
+            self._index_ratings[name] = self.habits[name].rating
@@ -0,0 +1,203 @@
+import csv
+import os
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from habit_segments import read_lines
+from habit_storage import BASE_COLUMNS, SESSION_COLUMNS, param_columns
+
+ReplayResult = namedtuple('ReplayResult', ['totals', 'deltas', 'ratings'])
+
+
+def _elo_loop(totals, adv_scores, initial_rating, k_factor, deltas, ratings):
+    rating = initial_rating
+    for i in range(totals.shape[0]):
+        expected = 1.0 / (1.0 + 10.0 ** ((adv_scores[i] - rating) / 400.0))
+        if totals[i] > adv_scores[i]:
+            actual = 1.0
+        elif totals[i] == adv_scores[i]:
+            actual = 0.5
+        else:
+            actual = 0.0
+        delta = k_factor * (actual - expected)
+        rating += delta
+        deltas[i] = delta
+        ratings[i] = rating
+
+
+if njit is not None:
+    _elo_loop = njit(cache=True)(_elo_loop)
+
+
+def elo_trajectory(totals, adv_scores, initial_rating, k_factor):
+    # Same recurrence as Habit.update_rating, applied to a whole history
+    totals = np.ascontiguousarray(totals, dtype=np.float64)
+    adv_scores = np.ascontiguousarray(adv_scores, dtype=np.float64)
+    deltas = np.empty_like(totals)
+    ratings = np.empty_like(totals)
+    if njit is not None:
+        _elo_loop(totals, adv_scores, float(initial_rating), float(k_factor), deltas, ratings)
+        return deltas, ratings
+
+    # Without numba, walk plain floats: far cheaper than indexing arrays
+    expected_base = (10.0 ** (adv_scores / 400.0)).tolist()
+    outcome = np.where(totals > adv_scores, 1.0, np.where(totals == adv_scores, 0.5, 0.0)).tolist()
+    rating = float(initial_rating)
+    k = float(k_factor)
+    delta_list = [0.0] * len(outcome)
+    rating_list = [0.0] * len(outcome)
+    for i, actual in enumerate(outcome):
+        delta = k * (actual - 1.0 / (1.0 + expected_base[i] / 10.0 ** (rating / 400.0)))
+        rating += delta
+        delta_list[i] = delta
+        rating_list[i] = rating
+    deltas[:] = delta_list
+    ratings[:] = rating_list
+    return deltas, ratings
+
+
+class HistoryReplay:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.param_names = []
+        self.values = np.zeros((0, 0))
+        self.adv_scores = np.zeros(0)
+        self.initial_rating = 500.0
+        self.load()
+
+    def load(self):
+        table = None
+        history_path = getattr(self.storage, 'history_path', None)
+        session_table = getattr(self.storage, 'session_table', None)
+        if history_path is not None:
+            segments = self.storage.segments(self.name) if hasattr(self.storage, 'segments') else []
+            table = self._read_csv(history_path(self.name), segments)
+        elif session_table is not None:
+            table = self._read_table(session_table(self.name))
+        if table is None:
+            table = self._read_sessions()
+        # Parameters are always the trailing columns
+        self.values = table[:, table.shape[1] - len(self.param_names):]
+        self.adv_scores = np.ascontiguousarray(table[:, 2])
+        if len(table):
+            # Rating the habit had before its first recorded session
+            self.initial_rating = float(table[0, 4] - table[0, 3])
+
+    def _read_csv(self, history_file, segments=()):
+        # Fast path for well-formed CSV histories, compacted segments first
+        # as long as they share the CSV's columns
+        if not os.path.exists(history_file):
+            return None
+        with open(history_file, 'r', newline='') as f:
+            header = next(csv.reader(f), [])
+        if header[:len(BASE_COLUMNS)] != BASE_COLUMNS or any(footer['header'] != header for footer in segments):
+            return None
+        columns = [i for i, column in enumerate(header) if column not in SESSION_COLUMNS]
+        try:
+            parts = [np.loadtxt(read_lines(footer), delimiter=',', ndmin=2, usecols=columns) for footer in segments]
+            parts.append(np.loadtxt(history_file, delimiter=',', skiprows=1, ndmin=2, usecols=columns))
+            table = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        except ValueError:
+            return None
+        if table.shape[1] != len(columns):
+            return None
+        self.param_names = param_columns(header)
+        return table
+
+    def _read_table(self, session_table):
+        # Binary session files map straight into the array; only a table
+        # with missing parameter values is copied, to turn them into 0
+        columns, table = session_table
+        if columns[:len(BASE_COLUMNS)] != BASE_COLUMNS:
+            return None
+        self.param_names = param_columns(columns)
+        if np.isnan(table[:, len(columns) - len(self.param_names):]).any():
+            table = np.nan_to_num(table)
+        return table
+
+    def _read_sessions(self):
+        # Generic path: any backend, blank parameter cells count as 0
+        rows = list(self.storage.iter_sessions(self.name))
+        self.param_names = []
+        for row in rows:
+            self.param_names.extend(param for param in row['values'] if param not in self.param_names)
+        table = np.zeros((len(rows), len(BASE_COLUMNS) + len(self.param_names)))
+        for i, row in enumerate(rows):
+            table[i, :len(BASE_COLUMNS)] = [row[column] for column in BASE_COLUMNS]
+            values = row['values']
+            table[i, len(BASE_COLUMNS):] = [values.get(param, 0) for param in self.param_names]
+        return table
+
+    def __len__(self):
+        return len(self.adv_scores)
+
+    def weight_vector(self, params):
+        return np.array([params.get(name, 0) for name in self.param_names], dtype=np.float64)
+
+    def scores(self, params):
+        return self.values @ self.weight_vector(params)
+
+    def replay(self, params, k_factor, initial_rating=None):
+        if initial_rating is None:
+            initial_rating = self.initial_rating
+        totals = self.scores(params)
+        deltas, ratings = elo_trajectory(totals, self.adv_scores, initial_rating, k_factor)
+        return ReplayResult(totals, deltas, ratings)
+
+    def sweep(self, param_sets, k_factors, initial_rating=None):
+        # All weight settings are scored in a single matrix product
+        if initial_rating is None:
+            initial_rating = self.initial_rating
+        weights = np.column_stack([self.weight_vector(params) for params in param_sets])
+        all_totals = self.values @ weights
+        results = []
+        for j in range(weights.shape[1]):
+            totals = np.ascontiguousarray(all_totals[:, j])
+            for k_factor in k_factors:
+                deltas, ratings = elo_trajectory(totals, self.adv_scores, initial_rating, k_factor)
+                results.append((param_sets[j], k_factor, ReplayResult(totals, deltas, ratings)))
+        return results
+
+    def release(self):
+        # Drops the history arrays, which for a binary session file are
+        # mapped onto it: Windows cannot replace a file that is still mapped
+        self.values = np.zeros((0, len(self.param_names)))
+        self.adv_scores = np.zeros(0)
+
+    def rewrite(self, result, checkpoint=None):
+        # Write the replayed score, delta and rating back into the history;
+        # the history is released first, so load() it again to replay more
+        rows = list(self.storage.iter_sessions(self.name))
+        if len(rows) != len(result.totals):
+            raise ValueError(f"History of {self.name} changed during replay")
+        for i, row in enumerate(rows):
+            row['total_score'] = float(result.totals[i])
+            row['delta'] = float(result.deltas[i])
+            row['rating'] = float(result.ratings[i])
+        self.release()
+        self.storage.replace_sessions(self.name, rows, checkpoint)
+
+
+def replay_habit(habit, params=None, k_factor=None, apply=False):
+    if params is None:
+        params = habit.params
+    if k_factor is None:
+        k_factor = habit.k_factor
+    history = HistoryReplay(habit.storage, habit.name)
+    result = history.replay(params, k_factor)
+    if apply:
+        habit.params = params
+        habit.k_factor = k_factor
+    if apply and len(history):
+        habit.rating = float(result.ratings[-1])
+        habit.scores.clear()
+        habit.scores.extend(result.totals[-habit.scores.maxlen:].tolist())
+        history.rewrite(result, habit.checkpoint())
+    return result
@@ -0,0 +1,197 @@
+import datetime
+import json
+
+# Materialized analytics for one habit. Each saved session is folded into
+# its day, week and month bucket (local time) and into a single 'all'
+# bucket. Each bucket keeps two tables:
+# - per column (total_score and every parameter): count, sum, min and max.
+# - per difficulty: games, wins and draws.
+# Trend queries then read one value per bucket instead of scanning the
+# history. Sessions recorded before timestamps existed only count in 'all'.
+
+PERIODS = ('day', 'week', 'month', 'all')
+STATS = ('count', 'sum', 'mean', 'min', 'max')
+SCORE_COLUMN = 'total_score'
+UNKNOWN_DIFFICULTY = 'unknown'
+ROLLUPS_VERSION = 1
+
+
+def _date(when):
+    if isinstance(when, datetime.datetime):
+        return when.date()
+    if isinstance(when, datetime.date):
+        return when
+    return datetime.date.fromtimestamp(when)
+
+
+def bucket_key(period, when):
+    # Key of the bucket holding `when` (Unix seconds, a date or a datetime):
+    # '2024-03-09', '2024-W10', '2024-03' or 'all'. Keys sort by time.
+    if period == 'all':
+        return 'all'
+    date = _date(when)
+    if period == 'day':
+        return date.isoformat()
+    if period == 'week':
+        year, week, _ = date.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == 'month':
+        return f"{date.year}-{date.month:02d}"
+    raise ValueError(f"Unknown period: {period}")
+
+
+def _bound(period, bound):
+    # A range bound as a bucket key; ISO dates are mapped into the period
+    if bound is None or period == 'all':
+        return None
+    if isinstance(bound, str):
+        try:
+            bound = datetime.date.fromisoformat(bound)
+        except ValueError:
+            return bound  # already a bucket key
+    return bucket_key(period, bound)
+
+
+class Rollups:
+    def __init__(self, data=None):
+        data = data or {}
+        self.sessions = data.get('sessions', 0)
+        self.last = data.get('last')  # [session, rating] of the newest session folded in
+        self.periods = data.get('periods') or {period: {} for period in PERIODS}
+        self.streak = data.get('streak') or {'last_day': None, 'current': 0, 'longest': 0}
+
+    @classmethod
+    def from_sessions(cls, rows):
+        rollups = cls()
+        for row in rows:
+            rollups.add(row)
+        return rollups
+
+    @classmethod
+    def loads(cls, text):
+        # None for rollups written in another format; they are rebuilt
+        data = json.loads(text)
+        if data.get('version') != ROLLUPS_VERSION:
+            return None
+        return cls(data)
+
+    def dumps(self):
+        return json.dumps({'version': ROLLUPS_VERSION, 'sessions': self.sessions, 'last': self.last,
+                           'periods': self.periods, 'streak': self.streak})
+
+    def add(self, row):
+        total_score = row['total_score']
+        adv_score = row['adv_score']
+        won = total_score > adv_score
+        drawn = total_score == adv_score
+        difficulty = row.get('difficulty') or UNKNOWN_DIFFICULTY
+        columns = [(SCORE_COLUMN, total_score)]
+        columns.extend(row['values'].items())
+        timestamp = row.get('timestamp')
+        keys = [('all', 'all')]
+        if timestamp is not None:
+            day = _date(timestamp)
+            year, week, _ = day.isocalendar()
+            keys += [('day', day.isoformat()), ('week', f"{year}-W{week:02d}"),
+                     ('month', f"{day.year}-{day.month:02d}")]
+        for period, key in keys:
+            bucket = self.periods[period].get(key)
+            if bucket is None:
+                bucket = self.periods[period][key] = {'stats': {}, 'games': {}}
+            stats = bucket['stats']
+            for column, value in columns:
+                entry = stats.get(column)
+                if entry is None:
+                    stats[column] = [1, value, value, value]
+                    continue
+                entry[0] += 1
+                entry[1] += value
+                if value < entry[2]:
+                    entry[2] = value
+                if value > entry[3]:
+                    entry[3] = value
+            games = bucket['games'].get(difficulty)
+            if games is None:
+                games = bucket['games'][difficulty] = [0, 0, 0]
+            games[0] += 1
+            games[1] += won
+            games[2] += drawn
+        self.sessions += 1
+        self.last = [row['session'], row['rating']]
+        if timestamp is not None:
+            self._extend_streak(keys[1][1])
+
+    def _extend_streak(self, day):
+        # Daily streaks move forward with each session; a session dated
+        # before the newest one recounts them from the day buckets
+        streak = self.streak
+        last_day = streak['last_day']
+        if last_day is None or day > last_day:
+            consecutive = last_day is not None and (
+                datetime.date.fromisoformat(day) - datetime.date.fromisoformat(last_day)).days == 1
+            streak['current'] = streak['current'] + 1 if consecutive else 1
+            streak['longest'] = max(streak['longest'], streak['current'])
+            streak['last_day'] = day
+        elif day < last_day:
+            self._recount_streak()
+
+    def _recount_streak(self):
+        current = longest = 0
+        previous = None
+        for day in sorted(self.periods['day']):
+            date = datetime.date.fromisoformat(day)
+            current = current + 1 if previous is not None and (date - previous).days == 1 else 1
+            longest = max(longest, current)
+            previous = date
+        self.streak = {'last_day': previous.isoformat() if previous else None, 'current': current,
+                       'longest': longest}
+
+    def _buckets(self, period, start=None, end=None):
+        # (key, bucket) oldest first, within [start, end] when given (bucket
+        # keys or anything bucket_key accepts)
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period: {period}")
+        buckets = self.periods[period]
+        low = _bound(period, start)
+        high = _bound(period, end)
+        for key in sorted(buckets):
+            if (low is None or key >= low) and (high is None or key <= high):
+                yield key, buckets[key]
+
+    def trend(self, column=SCORE_COLUMN, period='week', stat='mean', start=None, end=None):
+        # [(bucket key, value)] for every bucket with the column, oldest first
+        if stat not in STATS:
+            raise ValueError(f"Unknown statistic: {stat}")
+        series = []
+        for key, bucket in self._buckets(period, start, end):
+            entry = bucket['stats'].get(column)
+            if entry is None:
+                continue
+            count, total, low, high = entry
+            value = {'count': count, 'sum': total, 'mean': total / count, 'min': low, 'max': high}[stat]
+            series.append((key, value))
+        return series
+
+    def win_rates(self, period='all', start=None, end=None):
+        # {difficulty: {'games', 'wins', 'draws', 'win_rate'}} over the
+        # buckets in range; a draw counts as half a win
+        totals = {}
+        for _, bucket in self._buckets(period, start, end):
+            for difficulty, games in bucket['games'].items():
+                total = totals.setdefault(difficulty, [0, 0, 0])
+                for i in range(3):
+                    total[i] += games[i]
+        return {difficulty: {'games': games, 'wins': wins, 'draws': draws,
+                             'win_rate': (wins + 0.5 * draws) / games}
+                for difficulty, (games, wins, draws) in totals.items()}
+
+    def streaks(self, today=None):
+        # Consecutive days with at least one session: the current run (0 once
+        # a whole day has been missed) and the longest ever
+        streak = self.streak
+        current = 0
+        if streak['last_day'] is not None:
+            today = _date(today) if today is not None else datetime.date.today()
+            if (today - datetime.date.fromisoformat(streak['last_day'])).days <= 1:
+                current = streak['current']
+        return {'current': current, 'longest': streak['longest'], 'last_day': streak['last_day']}
@@ -0,0 +1,149 @@
+import importlib
+import json
+import math
+import os
+import struct
+
+import habit_metrics as metrics
+
+# Immutable compressed segments of old history. A segment file is
+#   [compressed CSV rows][footer JSON][trailer: footer length, magic]
+# so its footer (session range, ratings, per-column statistics) is read
+# with two small reads and never needs the rows decompressed.
+
+SEGMENT_SESSIONS = 4096
+DEFAULT_CODEC = 'gzip'
+# (compress, decompress); the codec modules are imported on first use
+CODECS = {
+    'gzip': (lambda data: importlib.import_module('gzip').compress(data, compresslevel=6),
+             lambda data: importlib.import_module('gzip').decompress(data)),
+    'lzma': (lambda data: importlib.import_module('lzma').compress(data),
+             lambda data: importlib.import_module('lzma').decompress(data)),
+}
+SEGMENT_VERSION = 1
+MAGIC = b'ELOSEG01'
+TRAILER = struct.Struct('<Q8s')
+# Columns besides the parameters that get footer statistics
+STAT_COLUMNS = ('total_score', 'adv_score', 'delta', 'rating')
+
+
+def session_value(row, column):
+    # A base column or a parameter of a session row, None when missing
+    if column in STAT_COLUMNS:
+        return row[column]
+    return row['values'].get(column)
+
+
+def add_value(entry, value):
+    # entry is [count, sum, sum of squares, min, max], or None before the first value
+    if entry is None:
+        return [1, value, value * value, value, value]
+    entry[0] += 1
+    entry[1] += value
+    entry[2] += value * value
+    if value < entry[3]:
+        entry[3] = value
+    if value > entry[4]:
+        entry[4] = value
+    return entry
+
+
+def merge_stats(entry, other):
+    if other is None:
+        return entry
+    if entry is None:
+        return list(other)
+    entry[0] += other[0]
+    entry[1] += other[1]
+    entry[2] += other[2]
+    entry[3] = min(entry[3], other[3])
+    entry[4] = max(entry[4], other[4])
+    return entry
+
+
+def row_stats(rows):
+    # {column: [count, sum, sumsq, min, max]} over every numeric column
+    stats = {}
+    for row in rows:
+        for column in STAT_COLUMNS:
+            stats[column] = add_value(stats.get(column), row[column])
+        for param, value in row['values'].items():
+            stats[param] = add_value(stats.get(param), value)
+    return stats
+
+
+def describe(entry):
+    # Summary of one stats entry; the variance is the population variance
+    if entry is None:
+        return {'count': 0, 'sum': 0.0, 'mean': None, 'stdev': None, 'min': None, 'max': None}
+    count, total, squares, low, high = entry
+    mean = total / count
+    variance = max(0.0, squares / count - mean * mean)
+    return {'count': count, 'sum': total, 'mean': mean, 'stdev': math.sqrt(variance), 'min': low, 'max': high}
+
+
+def write_segment(path, header, lines, rows, codec=DEFAULT_CODEC):
+    # lines: the rows as CSV text (no header); rows: the same sessions
+    # parsed, for the footer. Written to a temp file, synced and renamed.
+    compress = CODECS[codec][0]
+    payload = compress(''.join(lines).encode('utf-8'))
+    footer = {
+        'version': SEGMENT_VERSION,
+        'codec': codec,
+        'header': header,
+        'first': rows[0]['session'],
+        'last': rows[-1]['session'],
+        'count': len(rows),
+        'rating_start': rows[0]['rating'] - rows[0]['delta'],
+        'rating_end': rows[-1]['rating'],
+        'first_timestamp': rows[0].get('timestamp'),
+        'last_timestamp': rows[-1].get('timestamp'),
+        'payload': len(payload),
+        'stats': row_stats(rows),
+    }
+    footer_bytes = json.dumps(footer).encode('utf-8')
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        f.write(footer_bytes)
+        f.write(TRAILER.pack(len(footer_bytes), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+        metrics.count('storage.bytes_written', f.tell())
+    os.replace(tmp_file, path)
+    metrics.count('storage.file_opens')
+    metrics.count('storage.fsyncs')
+    footer['path'] = path
+    return footer
+
+
+def read_footer(path):
+    # The footer dict (plus 'path'), or None for a torn or foreign file
+    try:
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size < TRAILER.size:
+                return None
+            f.seek(size - TRAILER.size)
+            length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC or length > size - TRAILER.size:
+                return None
+            f.seek(size - TRAILER.size - length)
+            footer = json.loads(f.read(length))
+    except (OSError, ValueError):
+        return None
+    metrics.count('storage.file_opens')
+    metrics.count('storage.bytes_read', TRAILER.size + length)
+    if footer.get('version') != SEGMENT_VERSION or footer.get('codec') not in CODECS:
+        return None
+    footer['path'] = path
+    return footer
+
+
+def read_lines(footer):
+    # The segment's rows as CSV lines (no header)
+    with open(footer['path'], 'rb') as f:
+        payload = f.read(footer['payload'])
+    metrics.count('storage.file_opens')
+    metrics.count('storage.bytes_read', len(payload))
+    return CODECS[footer['codec']][1](payload).decode('utf-8').splitlines()
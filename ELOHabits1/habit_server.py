@@ -0,0 +1,491 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import habit_metrics as metrics
+from habit_leaderboard import tier
+from habit_model import DIFFICULTY_BANDS, HabitManager
+from habit_storage import make_session, open_storage
+from habit_writer import WriteBehindStorage
+
+# Local HTTP service that owns the one HabitManager for a data directory
+# (or .db), so the GUI, scripts and other devices on the LAN share a store
+# instead of each rewriting habits.json on their own:
+#   python habit_server.py serve --host 0.0.0.0 --port 8765
+#
+#   GET  /habits                              list with rating, rank and tier
+#   POST /habits                              {"name": ..., "params": {...}}
+#   GET  /habits/<name>/adversary?difficulty=normal
+#   POST /habits/<name>/sessions              {"values": {...}, "difficulty": ..., "adv_score": ...}
+#   GET  /habits/<name>/history?start=&count=
+#   GET  /leaderboard?count=10
+#   GET  /sync                                digests per habit, for habit_sync
+#   GET  /habits/<name>/chunks                chunk digests of one history
+#   GET  /habits/<name>/sync?start=&count=    sessions after the first `start`
+#   POST /habits/<name>/sync                  {"start": ..., "rows": [...], "params": ..., "k_factor": ...}
+#
+# All model state lives on the event loop thread. Storage reads (and the
+# writes of a sync merge) run in worker threads, under a per-habit lock, so a
+# habit never sees two writes at once while other habits carry on. Sessions are persisted through the
+# write-behind writer, which groups them into batched commits.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BODY = 1 << 20
+INDEX_SAVE_SECONDS = 5.0
+HISTORY_PAGERS = 8
+HISTORY_MAX_COUNT = 1000
+# Every habit stays resident once loaded, which keeps the hot state in memory
+SERVER_MAX_RESIDENT = 1 << 20
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class HabitServer:
+    def __init__(self, storage, max_resident=SERVER_MAX_RESIDENT):
+        self.manager = HabitManager(storage=storage, max_resident=max_resident)
+        self.storage = self.manager.storage
+        self._locks = {}
+        self._pagers = OrderedDict()
+        self._dirty = False
+        self._server = None
+        self._saver = None
+        self._sync_peer = None
+
+    # Lifecycle
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self._server = await asyncio.start_server(self._serve_connection, host, port)
+        self._saver = asyncio.ensure_future(self._save_periodically())
+        return self._server
+
+    async def close(self):
+        if self._saver is not None:
+            self._saver.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for pager in self._pagers.values():
+            pager.close()
+        self._pagers.clear()
+        self.manager.save_habits()
+        if self._sync_peer is not None:
+            self._sync_peer.save_state()
+        await asyncio.get_running_loop().run_in_executor(None, self.storage.close)
+
+    async def _save_periodically(self):
+        # Rollups and sync state are saved every few seconds instead of per submit
+        while True:
+            await asyncio.sleep(INDEX_SAVE_SECONDS)
+            if self._dirty:
+                self._dirty = False
+                self.manager.save_habits()
+                if self._sync_peer is not None:
+                    self._sync_peer.save_state()
+            for error in self.storage.drain_completed():
+                print(f"Write failed: {error}")
+
+    # HTTP
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status, payload, keep_alive = 400, {'error': "Invalid Content-Length"}, False
+                elif length > MAX_BODY:
+                    status, payload, keep_alive = 413, {'error': "Request body too large"}, False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.dispatch(method, target, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        metrics.count('server.requests')
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    raise HTTPError(400, "Body is not valid JSON")
+                if not isinstance(body, dict):
+                    raise HTTPError(400, "Body must be a JSON object")
+            else:
+                body = {}
+            if len(parts) == 1 and parts[0] in ROUTES:
+                handlers, args = ROUTES[parts[0]], ()
+            elif len(parts) == 3 and parts[0] == 'habits' and parts[2] in HABIT_ROUTES:
+                handlers, args = HABIT_ROUTES[parts[2]], (parts[1],)
+            else:
+                raise HTTPError(404, f"No route for {url.path}")
+            if method not in handlers:
+                raise HTTPError(405, f"{method} is not allowed on {url.path}")
+            status, handler = handlers[method]
+            result = handler(self, *args, body if method == 'POST' else query)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return status, result
+        except HTTPError as exc:
+            return exc.status, {'error': str(exc)}
+        except Exception as exc:
+            return 500, {'error': f"{type(exc).__name__}: {exc}"}
+
+    # Endpoints
+
+    def list_habits(self, query):
+        leaderboard = self.manager.leaderboard
+        return [{'habit': name, 'rating': habit.rating, 'rank': leaderboard.rank_of(name),
+                 'tier': tier(habit.rating), 'params': habit.params}
+                for name, habit in self.manager.habits.items()]
+
+    def create_habit(self, body):
+        name = body.get('name')
+        params = body.get('params')
+        if not isinstance(name, str) or not name.strip():
+            raise HTTPError(400, "name is required")
+        if not isinstance(params, dict) or not params:
+            raise HTTPError(400, "params must map at least one parameter to its weight")
+        name = name.strip()
+        if name in self.manager.habits:
+            raise HTTPError(409, f"Habit already exists: {name}")
+        try:
+            params = {str(param).strip().lower(): float(weight) for param, weight in params.items()}
+        except (TypeError, ValueError):
+            raise HTTPError(400, "Weights must be numbers")
+        self.manager.create_habit(name, params)
+        self._dirty = True
+        return {'habit': name, 'params': params, 'rating': self.manager.habits[name].rating}
+
+    def leaderboard(self, query):
+        count = _int_arg(query, 'count', 10)
+        return [{'rank': rank, 'habit': name, 'rating': rating, 'tier': tier(rating)}
+                for rank, name, rating in self.manager.leaderboard.top(count)]
+
+    def _lock(self, name):
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    async def _loaded(self, name):
+        # The history window is read on a worker thread and applied here, on
+        # the loop; call with the habit's lock held
+        habit = self.manager.habits.get(name)
+        if habit is None:
+            raise HTTPError(404, f"Unknown habit: {name}")
+        if not habit.loaded:
+            data = await asyncio.get_running_loop().run_in_executor(None, self.manager.read_habit, habit)
+            if self.manager.habits.get(name) is not habit:
+                raise HTTPError(404, f"Unknown habit: {name}")
+            if not habit.loaded:
+                self.manager.load_habit(habit, data)
+        return habit
+
+    async def adversary(self, name, query):
+        difficulty = _difficulty(query)
+        async with self._lock(name):
+            habit = await self._loaded(name)
+            low, high, actual = habit.generate_adversary(difficulty)
+        return {'habit': name, 'difficulty': difficulty, 'low': low, 'high': high, 'actual': actual}
+
+    @metrics.timed('server.submit')
+    async def submit(self, name, body):
+        values = body.get('values')
+        if not isinstance(values, dict):
+            raise HTTPError(400, "values must map parameters to numbers")
+        difficulty = _difficulty(body)
+        adv_score = body.get('adv_score')
+        async with self._lock(name):
+            habit = await self._loaded(name)
+            unknown = [param for param in values if param not in habit.params]
+            if unknown:
+                raise HTTPError(400, f"Unknown parameters for {name}: {', '.join(unknown)}")
+            try:
+                values = {param: float(values.get(param, 0.0)) for param in habit.params}
+                adv_score = None if adv_score is None else float(adv_score)
+            except (TypeError, ValueError):
+                raise HTTPError(400, "values and adv_score must be numbers")
+            result = self.manager.record_session(name, values, difficulty, adv_score)
+        self._dirty = True
+        return result
+
+    async def history(self, name, query):
+        if name not in self.manager.habits:
+            raise HTTPError(404, f"Unknown habit: {name}")
+        count = min(_int_arg(query, 'count', 50), HISTORY_MAX_COUNT)
+        pager = self._pager(name)
+        loop = asyncio.get_running_loop()
+        total = await loop.run_in_executor(None, pager.refresh)
+        start = _int_arg(query, 'start', max(0, total - count))
+        sessions = await loop.run_in_executor(None, pager.rows, start, count)
+        return {'habit': name, 'total': total, 'start': start, 'sessions': sessions}
+
+    def _peer(self):
+        if self._sync_peer is None:
+            from habit_sync import LocalPeer
+            self._sync_peer = LocalPeer(self.manager)
+        return self._sync_peer
+
+    async def _digests(self, name):
+        # A habit's sync digests at its current stamp. The habit is loaded
+        # like any other and its new sessions are hashed on a worker thread,
+        # under its lock so no submit moves the stamp meanwhile.
+        peer = self._peer()
+        async with self._lock(name):
+            habit = await self._loaded(name)
+            stamp = [habit.session_count, habit.rating]
+            entry = peer.cached(name, stamp)
+            if entry is None:
+                entry = peer.store(name, await asyncio.get_running_loop().run_in_executor(
+                    None, peer.extend, name, stamp))
+        return habit, entry
+
+    async def sync_manifest(self, query):
+        from habit_sync import manifest_entry
+        manifest = {}
+        for name in list(self.manager.habits):
+            try:
+                habit, entry = await self._digests(name)
+            except HTTPError:
+                continue  # deleted while the others were hashed
+            manifest[name] = manifest_entry(habit, entry)
+        return manifest
+
+    async def sync_chunks(self, name, query):
+        from habit_sync import entry_chunks
+        habit, entry = await self._digests(name)
+        return entry_chunks(entry)
+
+    async def sync_rows(self, name, query):
+        from habit_sync import SYNC_BATCH
+        if name not in self.manager.habits:
+            raise HTTPError(404, f"Unknown habit: {name}")
+        start = _int_arg(query, 'start', 0)
+        count = min(_int_arg(query, 'count', SYNC_BATCH), SYNC_BATCH)
+        return await asyncio.get_running_loop().run_in_executor(None, self._peer().rows, name, start, count)
+
+    async def sync_merge(self, name, body):
+        start = body.get('start')
+        rows = body.get('rows')
+        params = body.get('params')
+        if not isinstance(start, int) or start < 0:
+            raise HTTPError(400, "start must be a non-negative integer")
+        if not isinstance(rows, list):
+            raise HTTPError(400, "rows must be a list of sessions")
+        k_factor = body.get('k_factor')
+        if name not in self.manager.habits and (not isinstance(params, dict) or not params):
+            raise HTTPError(400, "params are required for a new habit")
+        if k_factor is not None and not isinstance(k_factor, (int, float)):
+            raise HTTPError(400, "k_factor must be a number")
+        try:
+            rows = [make_session(int(row['session']), float(row['total_score']), float(row['adv_score']),
+                                 float(row['delta']), float(row['rating']),
+                                 {str(param): float(value) for param, value in row['values'].items()},
+                                 None if row.get('timestamp') is None else float(row['timestamp']),
+                                 row.get('difficulty'))
+                    for row in rows]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise HTTPError(400, "Malformed session in rows")
+        async with self._lock(name):
+            if name not in self.manager.habits:
+                self.manager.create_habit(name, params, 20 if k_factor is None else k_factor)
+            habit = await self._loaded(name)
+            merge = await asyncio.get_running_loop().run_in_executor(
+                None, self.manager.write_merge, habit, start, rows)
+            added = self.manager.apply_merge(habit, merge)
+        self._dirty = True
+        return {'habit': name, 'added': added, 'rating': self.manager.habits[name].rating}
+
+    def _pager(self, name):
+        # A few habits' history indexes stay open, least recently used out.
+        # Building one reads nothing; its first refresh does, on its thread.
+        from habit_history import HistoryPager
+        pager = self._pagers.pop(name, None)
+        if pager is None:
+            pager = HistoryPager(self.storage, name)
+        self._pagers[name] = pager
+        while len(self._pagers) > HISTORY_PAGERS:
+            self._pagers.popitem(last=False)[1].close(wait=False)
+        return pager
+
+
+# path -> method -> (success status, handler)
+ROUTES = {
+    'habits': {'GET': (200, HabitServer.list_habits), 'POST': (201, HabitServer.create_habit)},
+    'leaderboard': {'GET': (200, HabitServer.leaderboard)},
+    'sync': {'GET': (200, HabitServer.sync_manifest)}
+}
+HABIT_ROUTES = {
+    'adversary': {'GET': (200, HabitServer.adversary)},
+    'sessions': {'POST': (201, HabitServer.submit)},
+    'history': {'GET': (200, HabitServer.history)},
+    'chunks': {'GET': (200, HabitServer.sync_chunks)},
+    'sync': {'GET': (200, HabitServer.sync_rows), 'POST': (200, HabitServer.sync_merge)}
+}
+
+
+def _difficulty(args):
+    difficulty = args.get('difficulty', 'normal')
+    if not isinstance(difficulty, str) or difficulty not in DIFFICULTY_BANDS:
+        raise HTTPError(400, "difficulty must be easy, normal or hard")
+    return difficulty
+
+
+def _int_arg(query, key, default):
+    if key not in query:
+        return default
+    try:
+        value = int(query[key])
+    except ValueError:
+        raise HTTPError(400, f"{key} must be an integer")
+    if value < 0:
+        raise HTTPError(400, f"{key} must not be negative")
+    return value
+
+
+async def serve(location, host, port):
+    if location and not location.endswith(('.db', '.sqlite', '.sqlite3')):
+        os.makedirs(location, exist_ok=True)
+    server = HabitServer(WriteBehindStorage(open_storage(location)))
+    listener = await server.start(host, port)
+    addresses = ', '.join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in listener.sockets)
+    print(f"Serving {len(server.manager.habits)} habits on {addresses}")
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signum, stopped.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: Ctrl+C still ends the loop through KeyboardInterrupt
+    try:
+        await stopped.wait()
+    finally:
+        await server.close()
+
+
+# Load test: many keep-alive clients submitting concurrently, then a check
+# that every submit landed exactly once.
+
+async def _request(reader, writer, method, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n\r\n"
+                 .encode('latin-1') + data)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def load_test(host, port, clients, submits, habits):
+    names = [f"loadtest-{i}" for i in range(habits)]
+    reader, writer = await asyncio.open_connection(host, port)
+    for name in names:
+        await _request(reader, writer, 'POST', '/habits', {'name': name, 'params': {'reps': 1.0, 'sets': 2.0}})
+    status, listing = await _request(reader, writer, 'GET', '/habits')
+    before = {}
+    for name in names:
+        status, history = await _request(reader, writer, 'GET', f"/habits/{quote(name)}/history?count=0")
+        before[name] = history['total']
+
+    sent = {name: 0 for name in names}
+    latencies = []
+
+    async def client(index):
+        client_reader, client_writer = await asyncio.open_connection(host, port)
+        for i in range(index, submits, clients):
+            name = names[i % habits]
+            start = time.perf_counter()
+            status, result = await _request(client_reader, client_writer, 'POST', f"/habits/{quote(name)}/sessions",
+                                            {'values': {'reps': i % 10, 'sets': 3}})
+            latencies.append(time.perf_counter() - start)
+            if status != 201:
+                raise RuntimeError(f"Submit failed ({status}): {result}")
+            sent[name] += 1
+        client_writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    lost = 0
+    for name in names:
+        status, history = await _request(reader, writer, 'GET', f"/habits/{quote(name)}/history?count=1")
+        lost += before[name] + sent[name] - history['total']
+    writer.close()
+    latencies.sort()
+    print(f"{submits} submits from {clients} clients over {habits} habits in {elapsed:.2f} s: "
+          f"{submits / elapsed:.0f} submits/s, p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms, lost updates: {lost}")
+    return lost
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve habits over HTTP on the local network")
+    parser.add_argument('--data', default=None, help="Data directory or .db file (default: ELOHABITS_DB)")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="Run the server (default)")
+    loadtest = commands.add_parser('loadtest', help="Hammer a running server with concurrent submits")
+    loadtest.add_argument('--clients', type=int, default=50)
+    loadtest.add_argument('--submits', type=int, default=10000)
+    loadtest.add_argument('--habits', type=int, default=10)
+    args = parser.parse_args()
+    try:
+        if args.command == 'loadtest':
+            raise SystemExit(1 if asyncio.run(load_test(args.host, args.port, args.clients, args.submits,
+                                                        args.habits)) else 0)
+        asyncio.run(serve(args.data, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
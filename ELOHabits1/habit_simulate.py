@@ -0,0 +1,270 @@
+import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from habit_model import DIFFICULTY_BANDS, Habit
+
+# Monte Carlo tuning of difficulty bands and k_factor. Every trajectory
+# replays the model's session loop: draw an adversary from the rolling score
+# window, face it with a user score drawn from the habit's score
+# distribution, apply the Elo update and push the score into the window.
+# Trajectories advance together as NumPy vectors; simulate_reference runs
+# the same draws through Habit itself, so both agree for a fixed seed.
+
+DEFAULT_TRAJECTORIES = 10000
+DEFAULT_SESSIONS = 200
+CHUNK_TRAJECTORIES = 4096
+CONVERGENCE_TOLERANCE = 10.0
+
+
+class _WindowStorage:
+    # Read-only stand-in storage that seeds a Habit with a score window
+    location = None
+
+    def __init__(self, scores, rating):
+        self.scores = list(scores)
+        self.rating = rating
+
+    def load_window(self, name, window_size):
+        return self.scores[-window_size:], self.rating, len(self.scores)
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        pass
+
+
+def habit_inputs(habit, storage=None):
+    # Starting state and empirical score distribution of a real habit
+    storage = storage if storage is not None else habit.storage
+    history = [row['total_score'] for row in storage.iter_sessions(habit.name)]
+    return {
+        'initial_scores': list(habit.scores),
+        'initial_rating': habit.rating,
+        'params': dict(habit.params),
+        'score_source': np.array(history) if history else None,
+        'window_size': habit.window_size
+    }
+
+
+def _draws(rng, score_source, params, trajectories, sessions):
+    # User scores first, then the uniforms that place each adversary
+    shape = (trajectories, sessions)
+    if score_source is None:
+        base = sum(params.values())
+        score_source = (base, abs(base) * 0.2)
+    if isinstance(score_source, tuple):
+        mean, std = score_source
+        user = np.maximum(rng.normal(mean, std, shape), 0.0)
+    else:
+        user = rng.choice(np.asarray(score_source, dtype=np.float64), size=shape)
+    return user, rng.random(shape)
+
+
+def _run_vectorized(initial_scores, initial_rating, params, difficulty, k_factor, bands,
+                    window_size, user, uniforms):
+    trajectories, sessions = user.shape
+    low_k, high_k = bands.get(difficulty, bands['normal'])
+    base = sum(params.values())
+
+    # Window mean and sum of squared deviations, updated the way
+    # Habit._push_score does (Welford add/evict, resynced once per lap);
+    # raw sums of squares lose the variance to cancellation
+    window = np.zeros((trajectories, window_size))
+    start = [float(score) for score in list(initial_scores)[-window_size:]]
+    count = len(start)
+    window[:, :count] = start
+    head = count % window_size
+    seed_mean = seed_m2 = 0.0
+    for i, score in enumerate(start, 1):
+        delta = score - seed_mean
+        seed_mean += delta / i
+        seed_m2 += delta * (score - seed_mean)
+    if count and head == 0:
+        seed_mean = math.fsum(start) / count
+        seed_m2 = math.fsum((score - seed_mean) ** 2 for score in start)
+    mean = np.full(trajectories, seed_mean)
+    m2 = np.full(trajectories, seed_m2)
+
+    rating = np.full(trajectories, float(initial_rating))
+    ratings = np.empty((trajectories, sessions))
+    wins = draws = 0
+    for s in range(sessions):
+        if count == 0:
+            low = np.full(trajectories, base * 0.8)
+            high = np.full(trajectories, base * 1.2)
+        else:
+            if count > 1:
+                sigma = np.sqrt(np.maximum(m2, 0.0) / (count - 1))
+            else:
+                sigma = mean * 0.2
+            low = mean + low_k * sigma
+            if low_k < 0:
+                low = np.maximum(0, low)
+            high = mean + high_k * sigma
+        adv = low + (high - low) * uniforms[:, s]
+        score = user[:, s]
+
+        expected = 1 / (1 + 10 ** ((adv - rating) / 400))
+        won = score > adv
+        tied = score == adv
+        rating += k_factor * (np.where(won, 1.0, np.where(tied, 0.5, 0.0)) - expected)
+        ratings[:, s] = rating
+        wins += int(won.sum())
+        draws += int(tied.sum())
+
+        if count == window_size:
+            if window_size == 1:
+                mean = np.zeros(trajectories)
+                m2 = np.zeros(trajectories)
+            else:
+                evicted = window[:, head]
+                delta = evicted - mean
+                mean = mean - delta / (window_size - 1)
+                m2 = m2 - delta * (evicted - mean)
+        else:
+            count += 1
+        window[:, head] = score
+        delta = score - mean
+        mean = mean + delta / count
+        m2 = m2 + delta * (score - mean)
+        head = (head + 1) % window_size
+        if head == 0:
+            # Add/evict accumulates rounding error; resync once per lap
+            mean = window.mean(axis=1)
+            m2 = ((window - mean[:, None]) ** 2).sum(axis=1)
+    return ratings, wins, draws
+
+
+def simulate(initial_scores, initial_rating, params, score_source=None, difficulty='normal', k_factor=20,
+             bands=None, window_size=30, trajectories=DEFAULT_TRAJECTORIES, sessions=DEFAULT_SESSIONS,
+             seed=0, tolerance=CONVERGENCE_TOLERANCE, chunk=CHUNK_TRAJECTORIES, return_ratings=False):
+    _check_window(window_size)
+    bands = bands or DIFFICULTY_BANDS
+    rng = np.random.default_rng(seed)
+    finals = []
+    convergence = []
+    all_ratings = []
+    wins = draws = 0
+    for offset in range(0, trajectories, chunk):
+        size = min(chunk, trajectories - offset)
+        user, uniforms = _draws(rng, score_source, params, size, sessions)
+        ratings, chunk_wins, chunk_draws = _run_vectorized(
+            initial_scores, initial_rating, params, difficulty, k_factor, bands, window_size, user, uniforms)
+        wins += chunk_wins
+        draws += chunk_draws
+        finals.append(ratings[:, -1])
+        convergence.append(_convergence(ratings, tolerance))
+        if return_ratings:
+            all_ratings.append(ratings)
+
+    finals = np.concatenate(finals)
+    convergence = np.concatenate(convergence)
+    drift = finals - initial_rating
+    games = trajectories * sessions
+    result = {
+        'difficulty': difficulty,
+        'k_factor': k_factor,
+        'bands': dict(bands),
+        'trajectories': trajectories,
+        'sessions': sessions,
+        'win_rate': (wins + 0.5 * draws) / games,
+        'draw_rate': draws / games,
+        'mean_final_rating': float(finals.mean()),
+        'rating_drift': float(drift.mean()),
+        'rating_drift_std': float(drift.std()),
+        'median_convergence': float(np.median(convergence)),
+        'p90_convergence': float(np.percentile(convergence, 90)),
+        # Settled with at least the last tenth of the run inside the tolerance
+        'converged_fraction': float((convergence <= 0.9 * sessions).mean())
+    }
+    if return_ratings:
+        result['ratings'] = np.concatenate(all_ratings)
+    return result
+
+
+def _check_window(window_size):
+    if not isinstance(window_size, int) or window_size < 1:
+        raise ValueError(f"window_size must be a positive integer, got {window_size!r}")
+
+
+def _convergence(ratings, tolerance):
+    # Sessions until a trajectory stays within `tolerance` of where it ends
+    outside = np.abs(ratings - ratings[:, -1:]) > tolerance
+    last_outside = ratings.shape[1] - 1 - np.argmax(outside[:, ::-1], axis=1)
+    return np.where(outside.any(axis=1), last_outside + 1, 0)
+
+
+def simulate_reference(initial_scores, initial_rating, params, score_source=None, difficulty='normal',
+                       k_factor=20, bands=None, window_size=30, trajectories=16, sessions=DEFAULT_SESSIONS,
+                       seed=0, chunk=CHUNK_TRAJECTORIES):
+    # Scalar path through Habit.adversary_bounds / update_rating, consuming
+    # exactly the draws simulate() uses for the same seed
+    _check_window(window_size)
+    habit_class = type('SimulatedHabit', (Habit,), {'__slots__': (), 'difficulty_bands': bands or DIFFICULTY_BANDS})
+    rng = np.random.default_rng(seed)
+    ratings = np.empty((trajectories, sessions))
+    for offset in range(0, trajectories, chunk):
+        size = min(chunk, trajectories - offset)
+        user, uniforms = _draws(rng, score_source, params, size, sessions)
+        for t in range(size):
+            habit = habit_class('simulated', dict(params), initial_rating, window_size, k_factor,
+                                storage=_WindowStorage(initial_scores, initial_rating))
+            for s in range(sessions):
+                low, high = habit.adversary_bounds(difficulty)
+                adv = low + (high - low) * uniforms[t, s]
+                habit.update_rating(float(user[t, s]), adv)
+                habit.scores.append(user[t, s])
+                ratings[offset + t, s] = habit.rating
+    return ratings
+
+
+def _simulate_point(kwargs):
+    return simulate(**kwargs)
+
+
+def simulate_grid(inputs, difficulties=('easy', 'normal', 'hard'), k_factors=(20,), band_sets=None,
+                  workers=None, seed=0, **kwargs):
+    # One task per (difficulty, k_factor, bands) point, fanned out over
+    # processes; each point gets its own seed from a SeedSequence so the
+    # results do not depend on scheduling.
+    band_sets = band_sets or [DIFFICULTY_BANDS]
+    points = [(difficulty, k_factor, bands)
+              for bands in band_sets for difficulty in difficulties for k_factor in k_factors]
+    seeds = np.random.SeedSequence(seed).spawn(len(points))
+    tasks = [dict(inputs, difficulty=difficulty, k_factor=k_factor, bands=bands, seed=point_seed, **kwargs)
+             for (difficulty, k_factor, bands), point_seed in zip(points, seeds)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) == 1:
+        return [simulate(**task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_simulate_point, tasks))
+
+
+if __name__ == "__main__":
+    from habit_model import HabitManager
+    from habit_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Simulate difficulty bands and k_factor for a habit")
+    parser.add_argument('habit')
+    parser.add_argument('--data', default=None, help="Data directory or .db file")
+    parser.add_argument('--difficulty', nargs='+', default=['easy', 'normal', 'hard'])
+    parser.add_argument('--k', nargs='+', type=float, default=[20.0], help="k_factor values to try")
+    parser.add_argument('--trajectories', type=int, default=DEFAULT_TRAJECTORIES)
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    manager = HabitManager(storage=open_storage(args.data))
+    if args.habit not in manager.habits:
+        parser.error(f"Unknown habit: {args.habit}")
+    inputs = habit_inputs(manager.habits[args.habit].ensure_loaded())
+    results = simulate_grid(inputs, args.difficulty, args.k, workers=args.workers, seed=args.seed,
+                            trajectories=args.trajectories, sessions=args.sessions)
+    print(f"{'difficulty':<10} {'k':>6} {'win rate':>9} {'drift':>9} {'drift sd':>9} {'converge':>9}")
+    for result in results:
+        print(f"{result['difficulty']:<10} {result['k_factor']:>6g} {result['win_rate']:>9.3f} "
+              f"{result['rating_drift']:>+9.1f} {result['rating_drift_std']:>9.1f} "
+              f"{result['median_convergence']:>9.0f}")
@@ -0,0 +1,892 @@
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from operator import itemgetter
+
+import habit_metrics as metrics
+from habit_segments import (CODECS, DEFAULT_CODEC, SEGMENT_SESSIONS, add_value, merge_stats, read_footer, read_lines,
+                            session_value, write_segment)
+
+TAIL_BLOCK_SIZE = 8192
+# A habits.json.lock older than this was left by a writer that died
+INDEX_LOCK_STALE_SECONDS = 10.0
+
+BASE_COLUMNS = ['session', 'total_score', 'adv_score', 'delta', 'rating']
+# When the session was played (Unix seconds) and at which difficulty.
+# Histories written before these were recorded leave them blank (None).
+SESSION_COLUMNS = ['timestamp', 'difficulty']
+
+
+def make_session(session, total_score, adv_score, delta, rating, values, timestamp=None, difficulty=None):
+    return {
+        'session': session,
+        'total_score': total_score,
+        'adv_score': adv_score,
+        'delta': delta,
+        'rating': rating,
+        'values': values,
+        'timestamp': timestamp,
+        'difficulty': difficulty
+    }
+
+
+def param_columns(header):
+    # Every column that holds a parameter value
+    return [column for column in header if column not in BASE_COLUMNS and column not in SESSION_COLUMNS]
+
+
+def session_header(rows, header=None):
+    # header (or the base and session columns) plus any parameter the rows
+    # bring that it lacks; session columns are only added once a row has one
+    header = list(header) if header is not None else BASE_COLUMNS + SESSION_COLUMNS
+    if SESSION_COLUMNS[0] not in header and any(
+            row.get(column) is not None for row in rows for column in SESSION_COLUMNS):
+        header[len(BASE_COLUMNS):len(BASE_COLUMNS)] = SESSION_COLUMNS
+    params = dict.fromkeys(itertools.chain.from_iterable(map(itemgetter('values'), rows)))
+    header.extend(param for param in params if param not in header)
+    return header
+
+
+def parse_row(row, param_names):
+    timestamp = row.get('timestamp')
+    session = make_session(
+        int(float(row['session'])),
+        float(row['total_score']),
+        float(row['adv_score']),
+        float(row['delta']),
+        float(row['rating']),
+        {},
+        float(timestamp) if timestamp not in (None, '') else None,
+        row.get('difficulty') or None
+    )
+    for param in param_names:
+        cell = row.get(param)
+        if cell not in (None, ''):
+            session['values'][param] = float(cell)
+    return session
+
+
+class LegacyStorage:
+    # habits.json index plus one habit_{name}.csv per habit, with a
+    # habit_{name}.ckpt.json sidecar so loading a habit only reads the tail.
+    # compact() moves old sessions into habit_{name}.<first session>.seg
+    # files (see habit_segments), listed in habit_{name}.segments.json; the
+    # CSV then only holds the recent tail.
+    def __init__(self, data_dir=''):
+        self.location = data_dir
+        self.data_dir = data_dir
+        self.index_file = os.path.join(data_dir, 'habits.json')
+        self._headers = {}
+        self._unsynced = set()
+        self._segments = {}  # name -> (manifest and CSV identity, live segment footers)
+        self._segment_cache = None  # (footer, lines) of the last segment decompressed
+
+    def history_path(self, name):
+        return os.path.join(self.data_dir, f"habit_{name}.csv")
+
+    def checkpoint_path(self, name):
+        return os.path.join(self.data_dir, f"habit_{name}.ckpt.json")
+
+    def rollups_path(self, name):
+        return os.path.join(self.data_dir, f"habit_{name}.rollups.json")
+
+    def segment_path(self, name, first_session):
+        return os.path.join(self.data_dir, f"habit_{name}.{first_session:010d}.seg")
+
+    def manifest_path(self, name):
+        return os.path.join(self.data_dir, f"habit_{name}.segments.json")
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def sync(self):
+        # fsync every history file appended to since the last sync
+        while self._unsynced:
+            path = self._unsynced.pop()
+            if os.path.exists(path):
+                with open(path, 'ab') as f:
+                    os.fsync(f.fileno())
+                metrics.count('storage.fsyncs')
+
+    def close(self):
+        pass
+
+    # Index
+
+    def load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file, 'r') as f:
+            text = f.read()
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', len(text))
+        return json.loads(text)
+
+    @contextlib.contextmanager
+    def _index_lock(self):
+        # habits.json.lock, held only while the index is read and rewritten.
+        # A lock left behind by a crashed writer is broken once it is stale.
+        lock_file = self.index_file + '.lock'
+        while True:
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > INDEX_LOCK_STALE_SECONDS:
+                        os.remove(lock_file)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.005)
+        os.close(fd)
+        try:
+            yield
+        finally:
+            os.remove(lock_file)
+
+    def _update_index(self, entries, removed=None):
+        # The server, habit_import and the GUI each hold their own copy of
+        # the index, so the file is re-read under the lock and the entries
+        # merged into it: a stale copy never drops a habit another process
+        # created. Like the SQLite upsert, only delete_habit removes one.
+        with self._index_lock():
+            index = self.load_index()
+            index.update(entries)
+            if removed is not None:
+                index.pop(removed, None)
+            # Write a temp file and rename it over habits.json, so a crash
+            # mid-write (or a reader in another process) never sees a
+            # truncated index.
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(index, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+                metrics.count('storage.bytes_written', f.tell())
+            os.replace(tmp_file, self.index_file)
+            metrics.count('storage.file_opens')
+            metrics.count('storage.fsyncs')
+
+    def save_index(self, habit_data):
+        self._update_index(habit_data)
+
+    def save_habit(self, name, meta):
+        # The JSON index can only be rewritten as a whole
+        self._update_index({name: meta})
+
+    def delete_habit(self, name):
+        self._headers.pop(name, None)
+        for path in (self.history_path(name), self.checkpoint_path(name), self.rollups_path(name)):
+            if os.path.exists(path):
+                os.remove(path)
+        self._drop_segments(name)
+        self._update_index({}, removed=name)
+
+    # Sessions
+
+    def load_window(self, name, window_size):
+        # Returns (scores, rating, session_count); rating is None when the
+        # habit has no recorded sessions.
+        history_file = self.history_path(name)
+        if not os.path.exists(history_file):
+            return [], None, 0
+        window = self._load_checkpoint(name, window_size)
+        if window is None:
+            window = self._load_tail(name, window_size)
+        return window
+
+    def _load_checkpoint(self, name, window_size):
+        # The checkpoint is only trusted while the CSV is exactly the size it
+        # was when the checkpoint was written.
+        try:
+            with open(self.checkpoint_path(name), 'r') as f:
+                text = f.read()
+            metrics.count('storage.file_opens')
+            metrics.count('storage.bytes_read', len(text))
+            data = json.loads(text)
+            if data['csv_size'] != os.path.getsize(self.history_path(name)):
+                return None
+            scores = [float(score) for score in data['scores']]
+            rating = data['rating']
+            rating = None if rating is None else float(rating)
+            session_count = int(data['sessions'])
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+        if len(scores) < min(session_count, window_size):
+            return None  # written with a smaller window than we need now
+        return (scores[-window_size:] if window_size else []), rating, session_count
+
+    def _load_tail(self, name, window_size):
+        # Read blocks backwards from the end of the CSV until we hold enough
+        # lines to fill the score window, instead of parsing the whole file.
+        wanted = window_size + 1
+        with open(self.history_path(name), 'rb') as f:
+            header = f.readline()
+            start = f.tell()
+            pos = f.seek(0, os.SEEK_END)
+            chunk = b''
+            while pos > start and chunk.count(b'\n') <= wanted:
+                step = min(TAIL_BLOCK_SIZE, pos - start)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + chunk
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', len(header) + len(chunk))
+        if SESSION_COLUMNS[0] not in next(csv.reader([header.decode('utf-8', 'replace')]), []):
+            return self._renumber(name, window_size)
+        lines = chunk.decode('utf-8', 'replace').splitlines()
+        if pos > start:
+            lines = lines[1:]  # first line may start mid-row
+        scores = []
+        rating = None
+        session_count = 0
+        reader = csv.DictReader([header.decode('utf-8', 'replace')] + lines[-wanted:])
+        for row in reader:
+            try:
+                score = float(row['total_score'])
+                row_rating = float(row['rating'])
+                row_session = int(float(row['session']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            scores.append(score)
+            rating = row_rating
+            session_count = row_session
+        if len(scores) < window_size:
+            # Compacted with a smaller window than this one
+            older = []
+            for footer in reversed(self.segments(name)):
+                older[:0] = [row['total_score'] for row in self._segment_sessions(footer)]
+                if len(older) + len(scores) >= window_size:
+                    break
+            scores = older + scores
+        return (scores[-window_size:] if window_size else []), rating, session_count
+
+    def _renumber(self, name, window_size):
+        # Histories from before the session columns numbered every session
+        # past the score window the same. They are rewritten once with
+        # consecutive numbers (and the session columns, which marks them as
+        # done) and checkpointed, so later loads read the tail again.
+        segments = self.segments(name)
+        first = segments[-1]['last'] + 1 if segments else 1
+        rows = list(self._iter_csv(name))
+        for i, row in enumerate(rows):
+            row['session'] = first + i
+        self._write_csv(name, rows, None, BASE_COLUMNS + SESSION_COLUMNS + param_columns(self._header(name) or []))
+        scores = [row['total_score'] for row in rows]
+        for footer in reversed(segments):
+            if len(scores) >= window_size:
+                break
+            scores[:0] = [row['total_score'] for row in self._segment_sessions(footer)]
+        scores = scores[-window_size:] if window_size else []
+        if rows:
+            rating = rows[-1]['rating']
+        else:
+            rating = segments[-1]['rating_end'] if segments else None
+        session_count = first - 1 + len(rows)
+        self._save_checkpoint(name, {'rating': rating, 'sessions': session_count, 'scores': scores})
+        return scores, rating, session_count
+
+    def _save_checkpoint(self, name, checkpoint):
+        data = dict(checkpoint)
+        data['csv_size'] = os.path.getsize(self.history_path(name))
+        path = self.checkpoint_path(name)
+        tmp_file = path + '.tmp'
+        text = json.dumps(data)
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_written', len(text))
+
+    def load_rollups(self, name):
+        # Serialized analytics rollups (see habit_rollups), or None
+        try:
+            with open(self.rollups_path(name), 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', len(text))
+        return text
+
+    def save_rollups(self, name, text):
+        path = self.rollups_path(name)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_written', len(text))
+
+    def _header(self, name):
+        header = self._headers.get(name)
+        if header is None and os.path.exists(self.history_path(name)):
+            with open(self.history_path(name), 'r', newline='') as f:
+                header = next(csv.reader(f), None)
+            metrics.count('storage.file_opens')
+            self._headers[name] = header
+        return header
+
+    def _widen_header(self, name, header, rows):
+        # A parameter added after the first write gets its own column, as do
+        # the session columns in a history from before they were recorded;
+        # older rows are rewritten with those cells left blank.
+        wider = session_header(rows, header)
+        if wider == header:
+            return header
+        self._write_csv(name, list(self._iter_csv(name)), None, wider)  # segments keep their own header
+        return wider
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        if not rows:
+            return
+        history_file = self.history_path(name)
+        header = self._header(name)
+        if header is None:
+            header = session_header(rows)
+            with open(history_file, 'w', newline='') as f:
+                csv.writer(f).writerow(header)
+            self._headers[name] = header
+        header = self._widen_header(name, header, rows)
+        with open(history_file, 'a', newline='') as f:
+            start = f.tell()
+            writer = csv.writer(f)
+            writer.writerows(self._csv_rows(header, rows))
+            metrics.count('storage.bytes_written', f.tell() - start)
+        metrics.count('storage.file_opens')
+        self._unsynced.add(history_file)
+        if checkpoint is not None:
+            self._save_checkpoint(name, checkpoint)
+
+    def _csv_rows(self, header, rows):
+        params = header[len(BASE_COLUMNS) + len(SESSION_COLUMNS):]
+        if header == BASE_COLUMNS + SESSION_COLUMNS + params:
+            # The layout session_header() writes: no per-cell lookups
+            base = itemgetter(*BASE_COLUMNS)
+            for row in rows:
+                timestamp = row.get('timestamp')
+                difficulty = row.get('difficulty')
+                yield [*base(row), '' if timestamp is None else timestamp, '' if difficulty is None else difficulty,
+                       *map(row['values'].get, params, itertools.repeat(''))]
+            return
+        kinds = [(column, 0 if column in BASE_COLUMNS else 1 if column in SESSION_COLUMNS else 2)
+                 for column in header]
+        for row in rows:
+            values = row['values']
+            yield [row[column] if kind == 0
+                   else ('' if row.get(column) is None else row[column]) if kind == 1
+                   else values.get(column, '') for column, kind in kinds]
+
+    def iter_sessions(self, name):
+        for footer in self.segments(name):
+            yield from self._segment_sessions(footer)
+        yield from self._iter_csv(name)
+
+    def _iter_csv(self, name):
+        history_file = self.history_path(name)
+        if not os.path.exists(history_file):
+            return
+        with open(history_file, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            param_names = param_columns(reader.fieldnames or [])
+            for row in reader:
+                try:
+                    yield parse_row(row, param_names)
+                except (KeyError, TypeError, ValueError):
+                    continue
+            metrics.count('storage.file_opens')
+            metrics.count('storage.bytes_read', os.path.getsize(history_file))
+
+    def read_sessions(self, name, first_session, count):
+        # Up to count sessions from first_session on, oldest first; only
+        # the segments holding them are decompressed
+        rows = []
+        for footer in self.segments(name):
+            if footer['last'] >= first_session:
+                rows.extend(row for row in self._segment_sessions(footer) if row['session'] >= first_session)
+                if len(rows) >= count:
+                    return rows[:count]
+        for row in self._iter_csv(name):
+            if row['session'] >= first_session:
+                rows.append(row)
+                if len(rows) >= count:
+                    break
+        return rows
+
+    def read_ratings(self, name, after_session=0):
+        # (session, rating) pairs after after_session, oldest first
+        return [(row['session'], row['rating']) for row in self.read_sessions(name, after_session + 1, sys.maxsize)]
+
+    def aggregate(self, name, column, first_session=None, last_session=None):
+        # [count, sum, sum of squares, min, max] of one column over a range
+        # of sessions (None when empty). Segments wholly inside the range
+        # contribute their footer statistics without being decompressed.
+        low = first_session if first_session is not None else 0
+        high = last_session if last_session is not None else sys.maxsize
+        entry = None
+        rows = []
+        for footer in self.segments(name):
+            if footer['last'] < low or footer['first'] > high:
+                continue
+            if low <= footer['first'] and footer['last'] <= high:
+                entry = merge_stats(entry, footer['stats'].get(column))
+            else:
+                rows.append(self._segment_sessions(footer))
+        rows.append(self._iter_csv(name))
+        for row in itertools.chain.from_iterable(rows):
+            if low <= row['session'] <= high:
+                value = session_value(row, column)
+                if value is not None:
+                    entry = add_value(entry, value)
+        return entry
+
+    # Segments
+
+    def segments(self, name):
+        # Footers of the compacted segments in front of the CSV, oldest
+        # first: those in the habit's manifest that end before the CSV's
+        # first session. Compaction writes the segments and then the
+        # manifest before cutting the CSV, and a rewrite replaces the CSV
+        # before dropping both, so a crash in between leaves segments whose
+        # sessions are still in the CSV, never a gap or a duplicated session.
+        # Another process may compact or rewrite the history at any time, so
+        # the list is only reused while both files are the ones it came from.
+        identity = self._segment_identity(name)
+        cached = self._segments.get(name)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        footers = []
+        listed = self._load_manifest(name) if identity is not None else []
+        first = self._first_csv_session(name) if listed else None
+        if first is not None:
+            for path in listed:
+                footer = read_footer(path)
+                if footer is None or footer['last'] >= first or (footers and footer['first'] <= footers[-1]['last']):
+                    break  # the manifest of a compaction that never cut the CSV
+                footers.append(footer)
+        self._segments[name] = (identity, footers)
+        return footers
+
+    def _segment_identity(self, name):
+        # The manifest as last written and the CSV file (appends keep it,
+        # compaction and rewrites replace it); None without a manifest
+        try:
+            manifest = os.stat(self.manifest_path(name))
+            history = os.stat(self.history_path(name))
+        except FileNotFoundError:
+            return None
+        return manifest.st_ino, manifest.st_mtime_ns, manifest.st_size, history.st_dev, history.st_ino
+
+    def _load_manifest(self, name):
+        # Paths of the segments the last compaction listed, oldest first
+        try:
+            with open(self.manifest_path(name), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return []
+        metrics.count('storage.file_opens')
+        return [os.path.join(self.data_dir, entry) for entry in manifest.get('segments', [])]
+
+    def _save_manifest(self, name, footers):
+        path = self.manifest_path(name)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'segments': [os.path.basename(footer['path']) for footer in footers]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.fsyncs')
+
+    def _list_segments(self, name):
+        # Every segment file of the habit on disk, live or not; listed afresh
+        # since another process may have compacted it
+        try:
+            entries = os.listdir(self.data_dir or '.')
+        except FileNotFoundError:
+            return []
+        # habit_{name}.{first session:010d}.seg
+        return sorted(os.path.join(self.data_dir, entry) for entry in entries
+                      if entry.endswith('.seg') and entry[-15:-14] == '.' and entry[-14:-4].isdigit()
+                      and entry[6:-15] == name and entry.startswith('habit_'))
+
+    def _first_csv_session(self, name):
+        for row in self._iter_csv(name):
+            return row['session']
+        return None
+
+    def _segment_sessions(self, footer):
+        cached = self._segment_cache
+        if cached is not None and cached[0] is footer:
+            lines = cached[1]
+        else:
+            lines = read_lines(footer)
+            self._segment_cache = (footer, lines)
+        header = footer['header']
+        param_names = param_columns(header)
+        for cells in csv.reader(lines):
+            try:
+                yield parse_row(dict(zip(header, cells)), param_names)
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    def _drop_segments(self, name):
+        # The manifest goes first, so a crash never leaves it listing
+        # segments that are gone
+        if os.path.exists(self.manifest_path(name)):
+            os.remove(self.manifest_path(name))
+        for path in self._list_segments(name):
+            os.remove(path)
+        self._segments.pop(name, None)
+        self._segment_cache = None
+
+    @metrics.timed('storage.compact')
+    def compact(self, name, keep, segment_size=SEGMENT_SESSIONS, codec=DEFAULT_CODEC):
+        # Moves the oldest sessions out of the CSV into immutable compressed
+        # segments of segment_size sessions each, leaving at least `keep`
+        # (the score window) in the CSV. Returns how many were moved. Raises
+        # ValueError, and moves nothing, unless the sessions are numbered
+        # consecutively on from the last segment's.
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        header = self._header(name)
+        if header is None:
+            return 0
+        if SESSION_COLUMNS[0] not in header:
+            self._renumber(name, keep)  # the original tracker's numbering; see _renumber
+            header = self._header(name)
+        history_file = self.history_path(name)
+        size = os.path.getsize(history_file)
+        param_names = param_columns(header)
+        rows = []
+        cells_list = []
+        with open(history_file, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for cells in reader:
+                try:
+                    rows.append(parse_row(dict(zip(header, cells)), param_names))
+                except (KeyError, TypeError, ValueError):
+                    continue  # unreadable rows are skipped by every reader anyway
+                cells_list.append(cells)
+        metrics.count('storage.file_opens')
+        metrics.count('storage.bytes_read', size)
+        moved = max(0, len(rows) - max(keep, 1)) // segment_size * segment_size
+        if not moved:
+            return 0
+        live = list(self.segments(name))
+        first = live[-1]['last'] + 1 if live else rows[0]['session']
+        if any(row['session'] != first + i for i, row in enumerate(rows)):
+            raise ValueError(f"Sessions of {name} are not numbered consecutively from {first}; not compacted")
+        last = rows[-1]['session']
+        for path in self._list_segments(name):
+            if all(footer['path'] != path for footer in live):
+                # Only strays of an interrupted compaction, whose sessions
+                # are all still in the CSV, are removed; anything else stays
+                footer = read_footer(path)
+                if footer is not None and first <= footer['first'] and footer['last'] <= last:
+                    os.remove(path)
+        self._segments.pop(name, None)
+        self._segment_cache = None
+        segments = []
+        for start in range(0, moved, segment_size):
+            chunk = rows[start:start + segment_size]
+            path = self.segment_path(name, chunk[0]['session'])
+            if os.path.exists(path):
+                raise ValueError(f"{path} is not a segment of the current history; not compacted")
+            segments.append((path, chunk, _csv_text(cells_list[start:start + segment_size])))
+        for path, chunk, lines in segments:
+            live.append(write_segment(path, header, lines, chunk, codec))
+        self._save_manifest(name, live)
+        # Cut the CSV down to the tail; the checkpoint still describes it
+        try:
+            with open(self.checkpoint_path(name), 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            checkpoint = None
+        tmp_file = history_file + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(cells_list[moved:])
+            f.flush()
+            os.fsync(f.fileno())
+            metrics.count('storage.bytes_written', f.tell())
+        os.replace(tmp_file, history_file)
+        metrics.count('storage.file_opens')
+        self._segments[name] = (self._segment_identity(name), live)
+        if isinstance(checkpoint, dict) and checkpoint.get('csv_size') == size:
+            self._save_checkpoint(name, checkpoint)
+        return moved
+
+    def replace_sessions(self, name, rows, checkpoint=None, header=None):
+        # The rows are the whole history, so compacted segments go; the CSV
+        # is replaced first (see segments)
+        self._write_csv(name, rows, checkpoint, header)
+        self._drop_segments(name)
+
+    def _write_csv(self, name, rows, checkpoint=None, header=None):
+        history_file = self.history_path(name)
+        if header is None:
+            header = session_header(rows)
+        tmp_file = history_file + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(self._csv_rows(header, rows))
+            metrics.count('storage.bytes_written', f.tell())
+        metrics.count('storage.file_opens')
+        os.replace(tmp_file, history_file)
+        self._unsynced.add(history_file)
+        self._headers[name] = header
+        if checkpoint is not None:
+            self._save_checkpoint(name, checkpoint)
+        elif os.path.exists(self.checkpoint_path(name)):
+            os.remove(self.checkpoint_path(name))
+
+
+def _csv_text(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+class SQLiteStorage:
+    # One database in WAL mode. Sessions are keyed on (habit, session), so
+    # a habit's tail and single-habit updates never touch other habits.
+    def __init__(self, path='habits.db', busy_timeout=5000):
+        self.location = path
+        self.path = path
+        self._depth = 0
+        import sqlite3  # only paid for when the SQLite backend is used
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS habits (
+                name TEXT PRIMARY KEY,
+                rating REAL NOT NULL,
+                k_factor REAL NOT NULL,
+                sessions INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS parameters (
+                habit TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                weight REAL NOT NULL,
+                PRIMARY KEY (habit, name)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                habit TEXT NOT NULL,
+                session INTEGER NOT NULL,
+                total_score REAL NOT NULL,
+                adv_score REAL NOT NULL,
+                delta REAL NOT NULL,
+                rating REAL NOT NULL,
+                param_values TEXT NOT NULL,
+                timestamp REAL,
+                difficulty TEXT,
+                PRIMARY KEY (habit, session)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rollups (
+                habit TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+        ''')
+        # Databases from before sessions recorded when and at which difficulty
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(sessions)')}
+        for column, kind in (('timestamp', 'REAL'), ('difficulty', 'TEXT')):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE sessions ADD COLUMN {column} {kind}')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Nested transactions join the outermost one, so callers can batch
+        # many sessions (or whole habits) into a single commit.
+        if self._depth == 0:
+            self.conn.execute('BEGIN IMMEDIATE')
+        self._depth += 1
+        try:
+            yield self.conn
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self.conn.execute('COMMIT')
+
+    def sync(self):
+        pass  # every transaction() is already a single WAL commit
+
+    def close(self):
+        self.conn.close()
+
+    # Index
+
+    def load_index(self):
+        habit_data = {}
+        for name, rating, k_factor in self.conn.execute(
+                'SELECT name, rating, k_factor FROM habits ORDER BY rowid'):
+            habit_data[name] = {'params': {}, 'rating': rating, 'k_factor': k_factor}
+        for habit, param, weight in self.conn.execute(
+                'SELECT habit, name, weight FROM parameters ORDER BY habit, position'):
+            if habit in habit_data:
+                habit_data[habit]['params'][param] = weight
+        return habit_data
+
+    def save_index(self, habit_data):
+        with self.transaction():
+            for name, meta in habit_data.items():
+                self.save_habit(name, meta)
+
+    def save_habit(self, name, meta):
+        with self.transaction():
+            self.conn.execute(
+                'INSERT INTO habits (name, rating, k_factor) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET rating = excluded.rating, k_factor = excluded.k_factor',
+                (name, meta['rating'], meta['k_factor'])
+            )
+            self.conn.execute('DELETE FROM parameters WHERE habit = ?', (name,))
+            self.conn.executemany(
+                'INSERT INTO parameters (habit, position, name, weight) VALUES (?, ?, ?, ?)',
+                [(name, i, param, weight) for i, (param, weight) in enumerate(meta['params'].items())]
+            )
+
+    def delete_habit(self, name):
+        with self.transaction():
+            for table, column in (('sessions', 'habit'), ('parameters', 'habit'), ('rollups', 'habit'),
+                                  ('habits', 'name')):
+                self.conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (name,))
+
+    # Sessions
+
+    def load_window(self, name, window_size):
+        rows = self.conn.execute(
+            'SELECT session, total_score, rating FROM sessions WHERE habit = ? '
+            'ORDER BY session DESC LIMIT ?',
+            (name, max(window_size, 1))  # the latest row has the rating and count
+        ).fetchall()
+        metrics.count('storage.rows_read', len(rows))
+        if not rows:
+            return [], None, 0
+        scores = [row[1] for row in reversed(rows)] if window_size else []
+        return scores, rows[0][2], rows[0][0]
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        with self.transaction():
+            self.conn.executemany(
+                'INSERT INTO sessions (habit, session, total_score, adv_score, delta, rating, param_values, '
+                'timestamp, difficulty) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._sql_row(name, row) for row in rows]
+            )
+            metrics.count('storage.rows_written', len(rows))
+            # Keep the index rating current so it never goes stale
+            if checkpoint is None and rows:
+                checkpoint = {'rating': rows[-1]['rating'], 'sessions': rows[-1]['session']}
+            if checkpoint is not None:
+                self.conn.execute(
+                    'UPDATE habits SET rating = ?, sessions = ? WHERE name = ?',
+                    (checkpoint['rating'], checkpoint['sessions'], name)
+                )
+
+    def _sql_row(self, name, row):
+        return (name, row['session'], row['total_score'], row['adv_score'], row['delta'],
+                row['rating'], json.dumps(row['values']), row.get('timestamp'), row.get('difficulty'))
+
+    def iter_sessions(self, name):
+        cursor = self.conn.execute(
+            'SELECT session, total_score, adv_score, delta, rating, param_values, timestamp, difficulty '
+            'FROM sessions WHERE habit = ? ORDER BY session',
+            (name,)
+        )
+        for session, total_score, adv_score, delta, rating, param_values, timestamp, difficulty in cursor:
+            metrics.count('storage.rows_read')
+            yield make_session(session, total_score, adv_score, delta, rating, json.loads(param_values),
+                               timestamp, difficulty)
+
+    def read_sessions(self, name, first_session, count):
+        # Up to count sessions from first_session on, oldest first
+        cursor = self.conn.execute(
+            'SELECT session, total_score, adv_score, delta, rating, param_values, timestamp, difficulty '
+            'FROM sessions WHERE habit = ? AND session >= ? ORDER BY session LIMIT ?',
+            (name, first_session, count)
+        )
+        rows = [make_session(session, total_score, adv_score, delta, rating, json.loads(param_values),
+                             timestamp, difficulty)
+                for session, total_score, adv_score, delta, rating, param_values, timestamp, difficulty in cursor]
+        metrics.count('storage.rows_read', len(rows))
+        return rows
+
+    def read_ratings(self, name, after_session=0):
+        # (session, rating) pairs after after_session, oldest first, without
+        # decoding any parameter values
+        rows = self.conn.execute(
+            'SELECT session, rating FROM sessions WHERE habit = ? AND session > ? ORDER BY session',
+            (name, after_session)
+        ).fetchall()
+        metrics.count('storage.rows_read', len(rows))
+        return rows
+
+    def load_rollups(self, name):
+        row = self.conn.execute('SELECT data FROM rollups WHERE habit = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def save_rollups(self, name, text):
+        with self.transaction():
+            self.conn.execute('INSERT OR REPLACE INTO rollups (habit, data) VALUES (?, ?)', (name, text))
+
+    def replace_sessions(self, name, rows, checkpoint=None):
+        with self.transaction():
+            self.conn.execute('DELETE FROM sessions WHERE habit = ?', (name,))
+            self.append_sessions(name, rows, checkpoint)
+
+
+def open_storage(location=None, busy_timeout=5000):
+    # ELOHABITS_DB=path/to/habits.db switches everything to SQLite, and a
+    # directory named *.columnar holds binary session files; by default the
+    # JSON + CSV files in the working directory are used.
+    if location is None:
+        location = os.environ.get('ELOHABITS_DB', '')
+    if location.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SQLiteStorage(location, busy_timeout)
+    if location.rstrip('/\\').endswith('.columnar'):
+        from habit_columnar import ColumnarStorage
+        return ColumnarStorage(location)
+    return LegacyStorage(location)
+
+
+def migrate(source, target):
+    # One-shot copy of every habit, its parameters and its full history
+    count = 0
+    habit_data = source.load_index()
+    with target.transaction():
+        for name, meta in habit_data.items():
+            rows = list(source.iter_sessions(name))
+            # A legacy CSV nobody has loaded since still repeats its numbers
+            for session, row in enumerate(rows, 1):
+                row['session'] = session
+            if rows:
+                meta = dict(meta, rating=rows[-1]['rating'])
+            target.save_habit(name, meta)
+            target.replace_sessions(name, rows)
+            count += len(rows)
+    return len(habit_data), count
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Copy habit data between storage backends")
+    parser.add_argument('source', help="Data directory (JSON + CSV) or .db file to read")
+    parser.add_argument('target', help="Data directory (JSON + CSV) or .db file to write")
+    args = parser.parse_args()
+    habits, sessions = migrate(open_storage(args.source), open_storage(args.target))
+    print(f"Migrated {habits} habits and {sessions} sessions")
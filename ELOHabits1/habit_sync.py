@@ -0,0 +1,329 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+from habit_storage import make_session
+
+# Two-way sync of habit histories between devices, through a shared
+# directory (itself an ELOHabits data directory or .db, the "hub") or a
+# habit_server. Nothing but digests crosses over for habits that match:
+#
+# - Every session has a stable ID, a hash of what was played: timestamp,
+#   difficulty, adversary score and parameter values. Scores, deltas and
+#   ratings are derived, so rescoring a history keeps its IDs.
+# - A habit's IDs are digested in chunks of SYNC_CHUNK sessions, and the
+#   chunk digests into one habit digest. Equal digests: nothing to do.
+#   Otherwise the chunk lists give the first chunk that differs, and only
+#   sessions from there on are exchanged.
+# - Each side merges the sessions it lacks by timestamp and recomputes
+#   ratings from the first session that moved, with its own k_factor.
+#
+# Both sides end with the same sessions in the same order. Digests are
+# cached per store (sync_state.json) and extended from the sessions added
+# since, so a sync of unchanged habits reads no history at all.
+
+SYNC_CHUNK = 256
+SYNC_BATCH = 2000  # sessions per request to a server
+STATE_VERSION = 1
+STATE_FILE = 'sync_state.json'
+LOCK_FILE = 'sync.lock'
+
+
+def _hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def session_id(row):
+    # Sessions from before timestamps were recorded are told apart by
+    # their position instead
+    timestamp = row.get('timestamp')
+    when = repr(float(timestamp)) if timestamp is not None else f"#{row['session']}"
+    values = ','.join(f"{param}={float(value)!r}" for param, value in sorted(row['values'].items()))
+    return _hash(f"{when}|{row.get('difficulty') or ''}|{float(row['adv_score'])!r}|{values}")
+
+
+def _order(row, row_id):
+    # Timestamp order; sessions without one keep their place ahead of them
+    timestamp = row.get('timestamp')
+    if timestamp is None:
+        return (0, row['session'], row_id)
+    return (1, timestamp, row_id)
+
+
+def merge_tail(tail, incoming, first_session, initial_rating, k_factor):
+    # tail plus the incoming sessions it lacks, in timestamp order and
+    # numbered from first_session. Rows before the first one that moved are
+    # kept as they are; from there on deltas and ratings are recomputed.
+    # Returns (rows, index of the first changed row, sessions added).
+    keyed = [(_order(row, row_id), row) for row, row_id in ((row, session_id(row)) for row in tail)]
+    known = {key[2] for key, _ in keyed}
+    added = 0
+    for row in incoming:
+        row_id = session_id(row)
+        if row_id not in known:
+            known.add(row_id)
+            keyed.append((_order(row, row_id), row))
+            added += 1
+    keyed.sort(key=lambda item: item[0])
+    first = 0
+    while first < len(tail) and keyed[first][1] is tail[first]:
+        first += 1
+    merged = tail[:first]
+    rating = merged[-1]['rating'] if merged else initial_rating
+    for i in range(first, len(keyed)):
+        row = keyed[i][1]
+        total_score = row['total_score']
+        adv_score = row['adv_score']
+        # Same recurrence as Habit.update_rating
+        expected = 1 / (1 + 10 ** ((adv_score - rating) / 400))
+        actual = 1 if total_score > adv_score else 0.5 if total_score == adv_score else 0
+        delta = k_factor * (actual - expected)
+        rating += delta
+        merged.append(make_session(first_session + i, total_score, adv_score, delta, rating, dict(row['values']),
+                                   row.get('timestamp'), row.get('difficulty')))
+    return merged, first, added
+
+
+def _first_difference(mine, theirs):
+    for i, (a, b) in enumerate(zip(mine, theirs)):
+        if a != b:
+            return i
+    return min(len(mine), len(theirs))
+
+
+def entry_chunks(entry):
+    return entry['chunks'] + ([_hash(''.join(entry['open']))] if entry['open'] else [])
+
+
+def manifest_entry(habit, entry):
+    return {'digest': _hash(''.join(entry_chunks(entry))), 'sessions': entry['stamp'][0],
+            'params': habit.params, 'k_factor': habit.k_factor}
+
+
+class LocalPeer:
+    # A HabitManager's store as one side of a sync
+    def __init__(self, manager, state_path=None):
+        self.manager = manager
+        self.state_path = state_path if state_path is not None else _state_path(manager.storage.location)
+        self._state = self._load_state()
+        self._dirty = False
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state.get('habits', {}) if state.get('version') == STATE_VERSION else {}
+
+    def save_state(self):
+        if not self._dirty:
+            return
+        tmp_file = self.state_path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'habits': self._state}, f)
+        os.replace(tmp_file, self.state_path)
+        self._dirty = False
+
+    def _digests(self, name):
+        habit = self.manager.habits[name].ensure_loaded()
+        stamp = [habit.session_count, habit.rating]
+        entry = self.cached(name, stamp)
+        if entry is None:
+            entry = self.store(name, self.extend(name, stamp))
+        return entry
+
+    def cached(self, name, stamp):
+        # The digests of a habit at `stamp` ([sessions, rating]), if current
+        entry = self._state.get(name)
+        return entry if entry is not None and entry['stamp'] == stamp else None
+
+    def extend(self, name, stamp):
+        # {'stamp': [sessions, rating], 'chunks': digests of the full chunks,
+        #  'open': IDs of the last partial chunk}, extended from the sessions
+        # saved since the stored stamp or rebuilt when the history was
+        # rewritten. Only reads, so it can run off the thread that owns the
+        # model while the habit is held at `stamp`; store() keeps the result.
+        entry = self._state.get(name)
+        rows = None
+        if entry is not None:
+            if entry['stamp'][0] == 0:
+                rows = self.manager.sessions_from(name, 1)
+            else:
+                rows = self.manager.sessions_since(name, entry['stamp'])
+        if rows is None:
+            entry = {'stamp': stamp, 'chunks': [], 'open': []}
+            rows = self.manager.storage.iter_sessions(name)
+        chunks = list(entry['chunks'])
+        open_ids = list(entry['open'])
+        for row in rows:
+            open_ids.append(session_id(row))
+            if len(open_ids) == SYNC_CHUNK:
+                chunks.append(_hash(''.join(open_ids)))
+                open_ids = []
+        return {'stamp': stamp, 'chunks': chunks, 'open': open_ids}
+
+    def store(self, name, entry):
+        self._state[name] = entry
+        self._dirty = True
+        return entry
+
+    def manifest(self):
+        # {name: {'digest', 'sessions', 'params', 'k_factor'}}
+        return {name: manifest_entry(habit, self._digests(name))
+                for name, habit in self.manager.habits.items()}
+
+    def chunks(self, name):
+        return entry_chunks(self._digests(name))
+
+    def rows(self, name, start, count=None):
+        # Sessions after the first `start`, oldest first
+        if count is None:
+            return self.manager.sessions_from(name, start + 1)
+        return self.manager.sessions_from(name, start + 1, count)
+
+    def merge(self, name, start, rows, params=None, k_factor=None):
+        return self.manager.merge_sessions(name, start, rows, params, k_factor)
+
+    def close(self):
+        self.save_state()
+
+
+class ServerPeer:
+    # A habit_server on the LAN as the other side, over its /sync routes
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, method, path, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = Request(self.url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def manifest(self):
+        return self._call('GET', '/sync')
+
+    def chunks(self, name):
+        return self._call('GET', f"/habits/{quote(name, safe='')}/chunks")
+
+    def rows(self, name, start, count=None):
+        rows = []
+        while count is None or len(rows) < count:
+            batch = SYNC_BATCH if count is None else min(SYNC_BATCH, count - len(rows))
+            page = self._call('GET', f"/habits/{quote(name, safe='')}/sync?start={start + len(rows)}&count={batch}")
+            rows.extend(page)
+            if len(page) < batch:
+                break
+        return rows
+
+    def merge(self, name, start, rows, params=None, k_factor=None):
+        # In batches: merging is a union, so several merges from the same
+        # start add up to one
+        added = 0
+        for i in range(0, max(len(rows), 1), SYNC_BATCH):
+            result = self._call('POST', f"/habits/{quote(name, safe='')}/sync",
+                                {'start': start, 'rows': rows[i:i + SYNC_BATCH], 'params': params,
+                                 'k_factor': k_factor})
+            added += result['added']
+        return added
+
+    def close(self):
+        pass
+
+
+def _state_path(location):
+    if location and not os.path.isdir(location):
+        return location + '.sync.json'  # next to a .db file
+    return os.path.join(location, STATE_FILE)
+
+
+def sync(local, remote):
+    # Two-way sync; {name: {'pulled': n, 'pushed': n}} for the habits that differed
+    mine = local.manifest()
+    theirs = remote.manifest()
+    report = {}
+    for name in sorted(set(mine) | set(theirs)):
+        a = mine.get(name)
+        b = theirs.get(name)
+        if a is not None and b is not None and a['digest'] == b['digest']:
+            continue
+        start = 0
+        if a is not None and b is not None:
+            start = _first_difference(local.chunks(name), remote.chunks(name)) * SYNC_CHUNK
+        our_rows = local.rows(name, start) if a is not None else []
+        their_rows = remote.rows(name, start) if b is not None else []
+        our_ids = {session_id(row) for row in our_rows}
+        their_ids = {session_id(row) for row in their_rows}
+        pulled = [row for row in their_rows if session_id(row) not in our_ids]
+        pushed = [row for row in our_rows if session_id(row) not in their_ids]
+        # Both sides merge even with nothing new, to put a tail that was
+        # out of timestamp order into the agreed order
+        if b is not None:
+            local.merge(name, start, pulled, b['params'], b['k_factor'])
+        if a is not None:
+            remote.merge(name, start, pushed, a['params'], a['k_factor'])
+        report[name] = {'pulled': len(pulled), 'pushed': len(pushed)}
+    return report
+
+
+class _DirectoryLock:
+    # One device at a time writes a shared hub directory
+    def __init__(self, directory):
+        self.path = os.path.join(directory, LOCK_FILE)
+
+    def __enter__(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            raise RuntimeError(f"{self.path} exists: another device is syncing (delete it if that sync died)")
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+        return self
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+def sync_with(manager, target):
+    # Sync a manager's store with a hub (directory or .db) or a server URL
+    local = LocalPeer(manager)
+    try:
+        if target.startswith(('http://', 'https://')):
+            report = sync(local, ServerPeer(target))
+        else:
+            from habit_model import HabitManager
+            from habit_storage import open_storage
+            hub_dir = target if os.path.isdir(target) or not target.endswith(('.db', '.sqlite', '.sqlite3')) \
+                else os.path.dirname(os.path.abspath(target))
+            if os.path.abspath(target) == os.path.abspath(manager.storage.location or '.'):
+                raise ValueError("The hub must be another directory than the local data")
+            os.makedirs(hub_dir, exist_ok=True)
+            with _DirectoryLock(hub_dir):
+                hub = HabitManager(storage=open_storage(target))
+                remote = LocalPeer(hub)
+                try:
+                    report = sync(local, remote)
+                    hub.save_habits()
+                finally:
+                    remote.close()
+                    hub.storage.close()
+        manager.save_habits()
+    finally:
+        local.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync habit histories with a shared directory or a habit_server")
+    parser.add_argument('target', help="Shared data directory, .db file or http://host:port of a habit_server")
+    parser.add_argument('--data', default=None, help="Local data directory or .db file (default: ELOHABITS_DB)")
+    args = parser.parse_args()
+    from habit_model import HabitManager
+    from habit_storage import open_storage
+    for name, counts in sync_with(HabitManager(storage=open_storage(args.data)), args.target).items():
+        print(f"{name}\tpulled {counts['pulled']}\tpushed {counts['pushed']}")
@@ -1,18 +1,33 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import os
+import random
+import habit_metrics as metrics
+from habit_history import HistoryPager
+from habit_leaderboard import tier
 from habit_model import HabitManager
+from habit_storage import open_storage
+from habit_writer import WriteBehindStorage
+
+WRITER_POLL_MS = 100
+INDEX_SAVE_MS = 5000
+LEADERBOARD_ROWS = 10
+HISTORY_ROWS = 20
+HISTORY_POLL_MS = 50
+CHART_HEIGHT = 140
 
 class HabitTrackerGUI:
     def __init__(self, master):
         self.master = master
         master.title("Habit Game Tracker")
-        master.geometry("700x500")
+        master.geometry("900x500")
 
-        self.manager = HabitManager()
+        # Saves go through a background writer so disk latency never blocks the UI
+        self.manager = HabitManager(storage=WriteBehindStorage(open_storage()))
         self.current_values = {}
         self.weight_vars = {}
         self.difficulty = tk.StringVar(value="normal")
+        self.history_window = None
 
         # Configure style
         self.style = ttk.Style()
@@ -22,6 +37,9 @@ class HabitTrackerGUI:
 
         self.create_widgets()
         self.refresh_habit_list()
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
+        master.after(WRITER_POLL_MS, self.poll_writer)
+        master.after(INDEX_SAVE_MS, self.save_periodically)
 
     def create_widgets(self):
         # Top frame for habit selection and management
@@ -36,6 +54,7 @@ class HabitTrackerGUI:
         ttk.Button(top_frame, text="New Habit", command=self.show_new_habit_dialog).pack(side=tk.LEFT, padx=5)
         ttk.Button(top_frame, text="Edit Habit", command=self.edit_current_habit).pack(side=tk.LEFT, padx=5)
         ttk.Button(top_frame, text="Delete Habit", command=self.delete_current_habit).pack(side=tk.LEFT)
+        ttk.Button(top_frame, text="History", command=self.show_history).pack(side=tk.LEFT, padx=5)
 
         # Middle frame for parameters and difficulty
         middle_frame = ttk.Frame(self.master)
@@ -63,10 +82,26 @@ class HabitTrackerGUI:
 
         ttk.Button(right_frame, text="Generate Adversary", command=self.generate_adversary).pack(fill=tk.X, pady=5)
 
+        # Leaderboard across habits, read from the manager's rank index
+        board_frame = ttk.Frame(middle_frame)
+        board_frame.pack(fill=tk.Y, side=tk.RIGHT, padx=10)
+        ttk.Label(board_frame, text="Leaderboard", font=('',10,'bold')).pack(anchor=tk.W)
+        self.leaderboard_tree = ttk.Treeview(board_frame, columns=('rank', 'habit', 'rating', 'tier'),
+                                             show='headings', height=LEADERBOARD_ROWS, selectmode='none')
+        for column, heading, width in (('rank', '#', 30), ('habit', 'Habit', 110),
+                                       ('rating', 'Rating', 60), ('tier', 'Tier', 90)):
+            self.leaderboard_tree.heading(column, text=heading)
+            self.leaderboard_tree.column(column, width=width, anchor=tk.W)
+        self.leaderboard_tree.pack(fill=tk.Y, expand=True)
+        self.standing_var = tk.StringVar(value="")
+        ttk.Label(board_frame, textvariable=self.standing_var).pack(anchor=tk.W)
+
         # Bottom frame for session submit
         bottom_frame = ttk.Frame(self.master)
         bottom_frame.pack(fill=tk.X, padx=10, pady=10)
         ttk.Button(bottom_frame, text="Submit Session", command=self.submit_session).pack(side=tk.RIGHT)
+        self.save_status_var = tk.StringVar(value="")
+        ttk.Label(bottom_frame, textvariable=self.save_status_var).pack(side=tk.LEFT)
 
         # Results display
         self.results_frame = ttk.Frame(self.master)
@@ -89,11 +124,13 @@ class HabitTrackerGUI:
             self.clear_param_fields()
             self.rating_var.set("N/A")
             self.adv_range_var.set("No habits available")
+            self.refresh_leaderboard()
 
     def clear_param_fields(self):
         for widget in self.param_frame.winfo_children():
             widget.destroy()
 
+    @metrics.timed('gui.on_habit_select')
     def on_habit_select(self, event=None):
         name = self.habit_combobox.get()
         if not name:
@@ -103,6 +140,7 @@ class HabitTrackerGUI:
 
         # Update rating
         self.rating_var.set(f"{habit.rating:.1f}")
+        self.refresh_leaderboard()
 
         # Display parameters
         self.clear_param_fields()
@@ -139,6 +177,7 @@ class HabitTrackerGUI:
         self.results_text.config(state=tk.DISABLED)
         self.try_again_button.config(state=tk.DISABLED)
 
+    @metrics.timed('gui.submit_session')
     def submit_session(self):
         habit = self.manager.current_habit
         if not hasattr(self, 'adv_range'):
@@ -147,15 +186,20 @@ class HabitTrackerGUI:
 
         values = {param: var.get() for param, var in self.current_values.items()}
         user_score = habit.calculate_score(values)
+        # The adversary faced is drawn from the range shown, once
         low, high = self.adv_range
-        _, _, adv_actual = habit.generate_adversary(self.difficulty.get())
+        adv_actual = random.uniform(low, high)
 
         delta = habit.update_rating(user_score, adv_actual)
         habit.scores.append(user_score)
-        habit.save_session(values, user_score, adv_actual, delta)
+        habit.save_session(values, user_score, adv_actual, delta, self.difficulty.get())
+        self.save_status_var.set("Saving...")
+        self.manager.storage.when_written(lambda: self.save_status_var.set("Saved"))
 
         # Update UI
         self.rating_var.set(f"{habit.rating:.1f}")
+        self.refresh_leaderboard()
+        self.refresh_history(habit.name)
         result = 'Victory' if user_score > adv_actual else 'Draw' if user_score == adv_actual else 'Defeat'
         text = (
             f"Adversary Range: {low:.1f} - {high:.1f}\n"
@@ -171,6 +215,59 @@ class HabitTrackerGUI:
         self.try_again_button.config(state=tk.NORMAL)
         delattr(self, 'adv_range')
 
+    def refresh_leaderboard(self):
+        # Top rows plus the current habit's standing; O(k + log n), no rescan
+        leaderboard = self.manager.leaderboard
+        self.leaderboard_tree.delete(*self.leaderboard_tree.get_children())
+        current = self.manager.current_habit
+        for rank, name, rating in leaderboard.top(LEADERBOARD_ROWS):
+            tags = ('current',) if current is not None and name == current.name else ()
+            self.leaderboard_tree.insert('', tk.END, values=(rank, name, f"{rating:.1f}", tier(rating)), tags=tags)
+        self.leaderboard_tree.tag_configure('current', font=('',9,'bold'))
+        if current is not None and current.name in leaderboard:
+            rank = leaderboard.rank_of(current.name)
+            self.standing_var.set(f"{current.name}: #{rank} of {len(leaderboard)}, "
+                                  f"{leaderboard.tier_of(current.name)} (top {100 * rank / len(leaderboard):.0f}%)")
+        else:
+            self.standing_var.set("")
+
+    def show_history(self):
+        habit = self.manager.current_habit
+        if habit is None:
+            return
+        if self.history_window is not None and self.history_window.alive:
+            if self.history_window.name == habit.name:
+                self.history_window.top.lift()
+                return
+            self.history_window.close()
+        self.history_window = HistoryWindow(self.master, self.manager, habit.name)
+
+    def refresh_history(self, name=None):
+        window = self.history_window
+        if window is not None and window.alive and (name is None or window.name == name):
+            window.reload()
+
+    def poll_writer(self):
+        # Completion callbacks from the writer thread run here, on the Tk thread
+        errors = self.manager.storage.drain_completed()
+        if errors:
+            self.save_status_var.set("Save failed")
+            messagebox.showerror("Save Failed", str(errors[-1]))
+        self.master.after(WRITER_POLL_MS, self.poll_writer)
+
+    def save_periodically(self):
+        # Ratings reach the index every few seconds, not once per session
+        self.manager.save_changes()
+        self.master.after(INDEX_SAVE_MS, self.save_periodically)
+
+    def on_close(self):
+        # Persist current ratings to the index and wait for pending writes
+        if self.history_window is not None and self.history_window.alive:
+            self.history_window.close(wait=True)
+        self.manager.save_habits()
+        self.manager.storage.close()
+        self.master.destroy()
+
     def reset_form(self):
         self.results_text.config(state=tk.NORMAL)
         self.results_text.delete(1.0, tk.END)
@@ -267,8 +364,11 @@ class HabitTrackerGUI:
             if not new_params:
                 messagebox.showerror("Error", "At least one parameter required")
                 return
-            self.manager.update_habit_params(name, new_params)
+            recompute = messagebox.askyesno(
+                "Recompute History", "Rescore past sessions with the new weights?", parent=dialog)
+            self.manager.update_habit_params(name, new_params, recompute=recompute)
             self.refresh_habit_list()
+            self.refresh_history(name)
             dialog.destroy()
         ttk.Button(dialog, text="Save", command=save_edits).pack(side=tk.LEFT, padx=5)
         ttk.Button(dialog, text="Cancel", command=dialog.destroy).pack(side=tk.LEFT)
@@ -278,9 +378,180 @@ class HabitTrackerGUI:
         if not name:
             return
         if messagebox.askyesno("Confirm Delete", f"Delete habit '{name}'?"):
+            if self.history_window is not None and self.history_window.alive and self.history_window.name == name:
+                self.history_window.close()
             self.manager.delete_habit(name)
             self.refresh_habit_list()
 
+class HistoryWindow:
+    # Virtualized view of one habit's sessions: the table only ever holds
+    # the visible rows, read through a paged reader that loads (and
+    # prefetches) pages off the Tk thread, plus a min/max rating chart.
+    # The window opens empty; poll() fills it once the first indexing pass,
+    # which also finds the habit's segments, is done on the pager's thread.
+    def __init__(self, master, manager, name):
+        self.name = name
+        self.alive = True
+        self.first = 0
+        self.pager = HistoryPager(manager.storage, name)
+        habit = manager.habits[name]
+        self.params = list(habit.params)
+
+        self.top = tk.Toplevel(master)
+        self.top.title(f"History: {name}")
+        self.top.geometry("760x600")
+        self.top.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.chart = tk.Canvas(self.top, height=CHART_HEIGHT, background='white', highlightthickness=0)
+        self.chart.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.chart.bind('<Configure>', lambda event: self.draw_chart())
+        self.chart.bind('<Button-1>', self.on_chart_click)
+
+        table_frame = ttk.Frame(self.top)
+        table_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.columns = ['session', 'total_score', 'adv_score', 'delta', 'rating'] + self.params
+        headings = ['#', 'Score', 'Adversary', 'Delta', 'Rating'] + [param.capitalize() for param in self.params]
+        self.tree = ttk.Treeview(table_frame, columns=self.columns, show='headings', height=HISTORY_ROWS,
+                                 selectmode='none')
+        for column, heading in zip(self.columns, headings):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=70, anchor=tk.E)
+        self.items = [self.tree.insert('', tk.END, values=()) for _ in range(HISTORY_ROWS)]
+        self.scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(sequence, self.on_wheel)
+        self.top.bind('<Prior>', lambda event: self.scroll_to(self.first - HISTORY_ROWS))
+        self.top.bind('<Next>', lambda event: self.scroll_to(self.first + HISTORY_ROWS))
+        self.top.bind('<Home>', lambda event: self.scroll_to(0))
+        self.top.bind('<End>', lambda event: self.scroll_to(len(self.pager)))
+
+        self.status_var = tk.StringVar(value="Indexing...")
+        ttk.Label(self.top, textvariable=self.status_var).pack(anchor=tk.W, padx=10, pady=(0, 10))
+
+        self.indexing = None
+        self.polling = False
+        self.reload(follow=True)
+
+    def reload(self, follow=False):
+        # Re-index in the background (only new rows unless the file was
+        # rewritten); follow jumps to the newest sessions afterwards
+        self.follow = follow or self.first + HISTORY_ROWS >= len(self.pager)
+        self.indexing = self.pager.refresh_async()
+        self.schedule_poll()
+
+    def schedule_poll(self):
+        if not self.polling and self.alive:
+            self.polling = True
+            self.top.after(HISTORY_POLL_MS, self.poll)
+
+    def poll(self):
+        self.polling = False
+        if not self.alive:
+            return
+        if self.indexing is not None:
+            if not self.indexing.done():
+                self.schedule_poll()
+                return
+            self.indexing = None
+            if self.follow:
+                self.first = max(0, len(self.pager) - HISTORY_ROWS)
+            self.status_var.set(f"{len(self.pager)} sessions")
+            self.draw_chart()
+        if not self.render():
+            self.schedule_poll()  # some visible pages are still loading
+
+    def scroll_to(self, first):
+        self.first = max(0, min(first, len(self.pager) - HISTORY_ROWS))
+        if not self.render():
+            self.schedule_poll()
+        self.draw_viewport()
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * len(self.pager)))
+        elif unit == 'pages':
+            self.scroll_to(self.first + int(amount) * HISTORY_ROWS)
+        else:
+            self.scroll_to(self.first + int(amount))
+
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.first - 3)
+        else:
+            self.scroll_to(self.first + 3)
+        return 'break'
+
+    def render(self):
+        # Fills the fixed set of table rows; False while any is still loading
+        total = len(self.pager)
+        rows = self.pager.rows(self.first, HISTORY_ROWS, wait=False)
+        complete = True
+        for i, item in enumerate(self.items):
+            row = rows[i] if i < len(rows) else None
+            if row is None:
+                complete = complete and i >= len(rows)
+                self.tree.item(item, values=('...',) if i < len(rows) else ())
+                continue
+            values = row['values']
+            self.tree.item(item, values=(
+                row['session'], f"{row['total_score']:.1f}", f"{row['adv_score']:.1f}", f"{row['delta']:+.1f}",
+                f"{row['rating']:.1f}", *(f"{values[param]:g}" if param in values else '' for param in self.params)
+            ))
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + HISTORY_ROWS) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        return complete
+
+    def chart_columns(self):
+        return max(1, self.chart.winfo_width())
+
+    def draw_chart(self):
+        self.chart.delete('all')
+        width = self.chart_columns()
+        envelope = self.pager.rating_envelope(width)
+        if not envelope:
+            return
+        low = min(lo for lo, hi in envelope)
+        high = max(hi for lo, hi in envelope)
+        span = (high - low) or 1.0
+        scale = (CHART_HEIGHT - 10) / span
+        step = width / len(envelope)
+        for i, (lo, hi) in enumerate(envelope):
+            x = i * step
+            y_hi = 5 + (high - hi) * scale
+            y_lo = 5 + (high - lo) * scale
+            self.chart.create_line(x, y_hi, x, y_lo + 1, fill='steelblue')
+        self.chart.create_text(4, 4, anchor=tk.NW, text=f"{high:.0f}", fill='gray')
+        self.chart.create_text(4, CHART_HEIGHT - 4, anchor=tk.SW, text=f"{low:.0f}", fill='gray')
+        self.draw_viewport()
+
+    def draw_viewport(self):
+        # Shades the part of the chart the table is showing
+        self.chart.delete('viewport')
+        total = len(self.pager)
+        if not total:
+            return
+        width = self.chart_columns()
+        x0 = self.first / total * width
+        x1 = max(x0 + 2, (self.first + HISTORY_ROWS) / total * width)
+        self.chart.create_rectangle(x0, 0, x1, CHART_HEIGHT, outline='orange', tags='viewport')
+
+    def on_chart_click(self, event):
+        total = len(self.pager)
+        self.scroll_to(int(event.x / self.chart_columns() * total) - HISTORY_ROWS // 2)
+
+    def close(self, wait=False):
+        # Closing must not wait for a long index scan, unless the storage
+        # is about to be closed under it
+        if self.alive:
+            self.alive = False
+            self.pager.close(wait)
+            self.top.destroy()
+
+
 if __name__ == "__main__":
     root = tk.Tk()
     icon_path = "habit_icon3.ico"
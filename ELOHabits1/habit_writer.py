@@ -0,0 +1,250 @@
+import atexit
+import contextlib
+import queue
+import threading
+
+import habit_metrics as metrics
+
+MAX_PENDING_WRITES = 1024
+MAX_BATCH = 256
+
+
+class WriteBehindStorage:
+    # Wraps a storage backend so writes return immediately. A background
+    # thread drains a bounded queue, merges consecutive appends per habit,
+    # commits each batch in one transaction and syncs it to disk once.
+    # Reads wait only for the pending writes they could observe.
+    def __init__(self, storage, max_pending=MAX_PENDING_WRITES, max_batch=MAX_BATCH):
+        self.storage = storage
+        self.location = storage.location
+        self.max_batch = max_batch
+        self._queue = queue.Queue(max_pending)
+        self._completed = queue.SimpleQueue()
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        if hasattr(storage, 'history_path'):
+            self.history_path = self._flushed_history_path
+        if hasattr(storage, 'read_sessions'):
+            self.read_sessions = self._flushed_read_sessions
+            self.read_ratings = self._flushed_read_ratings
+        if hasattr(storage, 'session_table'):
+            self.session_table = self._flushed_session_table
+        if hasattr(storage, 'compact'):
+            self.segments = self._flushed_segments
+            self.aggregate = self._flushed_aggregate
+            self.compact = self._queued_compact
+        self._thread = threading.Thread(target=self._run, name='habit-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Writes
+
+    def _submit(self, kind, name, args=()):
+        if self._closed:
+            raise RuntimeError("Write-behind storage is closed")
+        with self._cond:
+            self._pending[name] = self._pending.get(name, 0) + 1
+        self._queue.put((kind, name, args))  # blocks when the queue is full
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        if rows:
+            self._submit('append', name, (list(rows), checkpoint))
+
+    def replace_sessions(self, name, rows, checkpoint=None):
+        self._submit('replace', name, (list(rows), checkpoint))
+
+    def save_habit(self, name, meta):
+        self._submit('save_habit', name, (dict(meta),))
+
+    def delete_habit(self, name):
+        self._submit('delete', name)
+
+    def save_index(self, habit_data):
+        self._submit('save_index', None, (dict(habit_data),))
+
+    def save_rollups(self, name, text):
+        self._submit('save_rollups', name, (text,))
+
+    def _queued_compact(self, name, keep, *args):
+        # Runs on the writer thread, in order with the habit's other writes,
+        # and waits for it; returns how many sessions were moved
+        moved = []
+        self._submit('compact', name, (keep, *args, moved))
+        self._wait(name)
+        if moved and isinstance(moved[0], ValueError):
+            raise moved[0]
+        return moved[0] if moved else 0
+
+    def when_written(self, callback):
+        # callback runs (via drain_completed) once everything queued before
+        # it is on disk
+        self._submit('marker', None, (callback,))
+
+    def transaction(self):
+        return contextlib.nullcontext()  # batching happens in the writer
+
+    def drain_completed(self):
+        # Called from the owning thread (e.g. the Tk loop via after()); runs
+        # completion callbacks and returns write errors.
+        errors = []
+        while True:
+            try:
+                kind, payload = self._completed.get_nowait()
+            except queue.Empty:
+                return errors
+            if kind == 'error':
+                errors.append(payload)
+            else:
+                payload()
+
+    # Reads
+
+    def _wait(self, name=None):
+        with self._cond:
+            if name is None:
+                self._cond.wait_for(lambda: not any(self._pending.values()))
+            else:
+                self._cond.wait_for(lambda: not self._pending.get(name) and not self._pending.get(None))
+
+    def load_index(self):
+        self._wait()
+        return self.storage.load_index()
+
+    def load_window(self, name, window_size):
+        self._wait(name)
+        return self.storage.load_window(name, window_size)
+
+    def iter_sessions(self, name):
+        self._wait(name)
+        return self.storage.iter_sessions(name)
+
+    def load_rollups(self, name):
+        self._wait(name)
+        return self.storage.load_rollups(name)
+
+    def _flushed_history_path(self, name):
+        self._wait(name)
+        return self.storage.history_path(name)
+
+    def _flushed_read_sessions(self, name, first_session, count):
+        self._wait(name)
+        return self.storage.read_sessions(name, first_session, count)
+
+    def _flushed_read_ratings(self, name, after_session=0):
+        self._wait(name)
+        return self.storage.read_ratings(name, after_session)
+
+    def _flushed_session_table(self, name):
+        self._wait(name)
+        return self.storage.session_table(name)
+
+    def _flushed_segments(self, name):
+        self._wait(name)
+        return self.storage.segments(name)
+
+    def _flushed_aggregate(self, name, *args):
+        self._wait(name)
+        return self.storage.aggregate(name, *args)
+
+    def flush(self):
+        if not self._closed:
+            self._wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(('stop', None, ()))
+        self._thread.join()
+        self.storage.close()
+
+    # Writer thread
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1][0] == 'stop'
+            if stop:
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+            if stop:
+                return
+
+    @metrics.timed('writer.batch')
+    def _write_batch(self, batch):
+        try:
+            with self.storage.transaction():
+                for kind, name, args in self._coalesce(batch):
+                    if kind == 'append':
+                        self.storage.append_sessions(name, *args)
+                    elif kind == 'replace':
+                        self.storage.replace_sessions(name, *args)
+                    elif kind == 'save_habit':
+                        self.storage.save_habit(name, *args)
+                    elif kind == 'delete':
+                        self.storage.delete_habit(name)
+                    elif kind == 'save_index':
+                        self.storage.save_index(*args)
+                    elif kind == 'save_rollups':
+                        self.storage.save_rollups(name, *args)
+                    elif kind == 'compact':
+                        try:
+                            args[-1].append(self.storage.compact(name, *args[:-1]))
+                        except ValueError as exc:  # refused; raised again for the caller
+                            args[-1].append(exc)
+            self.storage.sync()
+        except Exception as exc:
+            self._completed.put(('error', exc))
+        metrics.count('writer.ops', len(batch))
+        for kind, name, args in batch:
+            if kind == 'marker':
+                self._completed.put(('done', args[0]))
+        with self._cond:
+            for _, name, _ in batch:
+                self._pending[name] -= 1
+            self._cond.notify_all()
+
+    def _coalesce(self, batch):
+        # Consecutive appends to a habit become one append (rows in order,
+        # newest checkpoint). Any other write to that habit closes the run,
+        # except its index entry, and only the newest index snapshot and the
+        # newest index entry and rollups of each habit in a batch are written.
+        ops = []
+        open_appends = {}
+        last_index = None
+        last_meta = {}
+        last_rollups = {}
+        for kind, name, args in batch:
+            if kind == 'marker':
+                continue
+            if kind == 'append':
+                i = open_appends.get(name)
+                if i is not None:
+                    rows, checkpoint = ops[i][2]
+                    ops[i] = (kind, name, (rows + args[0], args[1] if args[1] is not None else checkpoint))
+                    continue
+                open_appends[name] = len(ops)
+            elif kind == 'save_index':
+                if last_index is not None:
+                    ops[last_index] = None
+                last_index = len(ops)
+            elif kind == 'save_habit':
+                if name in last_meta:
+                    ops[last_meta[name]] = None
+                last_meta[name] = len(ops)
+            elif kind == 'save_rollups':
+                if name in last_rollups:
+                    ops[last_rollups[name]] = None
+                last_rollups[name] = len(ops)
+            else:
+                open_appends.pop(name, None)
+            ops.append((kind, name, args))
+        return [op for op in ops if op is not None]
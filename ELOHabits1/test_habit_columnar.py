@@ -0,0 +1,74 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+from habit_columnar import ColumnarStorage, export_csv, import_csv
+from habit_storage import LegacyStorage, make_session
+
+
+def sessions(first, count, params=('reps',)):
+    # Some rows without a timestamp or difficulty, some missing a parameter
+    rows = []
+    for i in range(first, first + count):
+        values = {param: float(i % (n + 3)) for n, param in enumerate(params) if (i + n) % 5}
+        rows.append(make_session(i, i * 1.5, 3.0, 0.25 * (i % 7) - 0.5, 500.0 + i / 8, values,
+                                 None if i % 9 == 0 else 1.7e9 + i, ('easy', 'normal', None)[i % 3]))
+    return rows
+
+
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.legacy = LegacyStorage(self.data_dir)
+        self.columnar = ColumnarStorage(os.path.join(self.data_dir, 'columnar'))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_csv_round_trip(self):
+        rows = sessions(1, 300, ('reps', 'sets'))
+        self.legacy.append_sessions('pushups', rows)
+        path = self.columnar.session_path('pushups')
+        self.assertEqual(import_csv(self.legacy.history_path('pushups'), path), 300)
+        self.assertEqual(list(self.columnar.iter_sessions('pushups')), rows)
+        back = LegacyStorage(os.path.join(self.data_dir, 'back'))
+        os.makedirs(back.data_dir)
+        self.assertEqual(export_csv(path, back.history_path('pushups')), 300)
+        self.assertEqual(list(back.iter_sessions('pushups')), rows)
+
+    def test_new_parameter_widens_every_record(self):
+        self.columnar.append_sessions('pushups', sessions(1, 50))
+        columns, _ = self.columnar.session_table('pushups')
+        wider = sessions(51, 10, ('reps', 'sets'))
+        self.columnar.append_sessions('pushups', wider)
+        columns_after, table = self.columnar.session_table('pushups')
+        self.assertEqual(columns_after, columns + ['sets'])
+        self.assertEqual(table.shape, (60, len(columns) + 1))
+        rows = list(ColumnarStorage(self.columnar.data_dir).iter_sessions('pushups'))
+        self.assertEqual(rows, sessions(1, 50) + wider)
+        self.assertTrue(all('sets' not in row['values'] for row in rows[:50]))
+        self.assertEqual(self.columnar.load_window('pushups', 3)[1:], (wider[-1]['rating'], 60))
+
+    def test_reopen_after_the_mapping_is_released(self):
+        self.columnar.append_sessions('pushups', sessions(1, 40))
+        columns, table = self.columnar.session_table('pushups')
+        ratings = table[:, columns.index('rating')].tolist()
+        # A table taken earlier keeps the sessions it was taken with
+        self.columnar.append_sessions('pushups', sessions(41, 5))
+        self.assertEqual(len(table), 40)
+        del table
+        gc.collect()
+        # With the mapping gone the file can be replaced, and is read afresh
+        self.columnar.replace_sessions('pushups', sessions(1, 20, ('reps', 'sets')))
+        reopened = ColumnarStorage(self.columnar.data_dir)
+        columns, table = reopened.session_table('pushups')
+        self.assertEqual(len(table), 20)
+        self.assertIn('sets', columns)
+        self.assertEqual(table[:, columns.index('rating')].tolist(), ratings[:20])
+        self.assertEqual(reopened.read_sessions('pushups', 18, 10), sessions(18, 3, ('reps', 'sets')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from habit_history import HistoryPager, minmax_decimate
+from habit_storage import LegacyStorage, SQLiteStorage, make_session
+
+
+def sessions(first, count):
+    return [make_session(i, float(i % 17), 3.0, 1.0, 500.0 + (i % 50) - 25, {'reps': float(i)}, 1.7e9 + i, 'normal')
+            for i in range(first, first + count)]
+
+
+class HistoryPagerTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.storage = LegacyStorage(self.data_dir)
+        self.storage.append_sessions('pushups', sessions(1, 1000))
+        self.pagers = []
+
+    def tearDown(self):
+        for pager in self.pagers:
+            pager.close()
+        shutil.rmtree(self.data_dir)
+
+    def pager(self, storage=None, **kwargs):
+        pager = HistoryPager(storage or self.storage, 'pushups', **kwargs)
+        self.pagers.append(pager)
+        return pager
+
+    def test_pages_start_at_indexed_byte_offsets(self):
+        pager = self.pager(page_size=64)
+        self.assertEqual(len(pager), 0)  # nothing is read before the first refresh
+        self.assertEqual(pager.refresh(), 1000)
+        source = pager._source
+        self.assertEqual(len(source.offsets), 16)
+        with open(self.storage.history_path('pushups'), 'rb') as f:
+            data = f.read()
+        for page, offset in enumerate(source.offsets):
+            # Every offset is the start of that page's first row
+            self.assertEqual(data[offset:].split(b',', 1)[0], str(page * 64 + 1).encode())
+        self.assertEqual(pager.rows(0, 1000), list(self.storage.iter_sessions('pushups')))
+        self.assertEqual([row['session'] for row in pager.rows(60, 10)], list(range(61, 71)))
+        self.assertEqual(pager.rows(995, 50), sessions(996, 5))
+
+    def test_refresh_scans_only_what_was_appended(self):
+        pager = self.pager(page_size=64)
+        pager.refresh()
+        offsets = pager._source.offsets.tolist()
+        end = pager._source.end
+        self.storage.append_sessions('pushups', sessions(1001, 100))
+        self.assertEqual(pager.refresh(), 1100)
+        self.assertEqual(pager._source.offsets.tolist()[:len(offsets)], offsets)
+        self.assertEqual(pager._source.end, os.path.getsize(self.storage.history_path('pushups')))
+        self.assertGreater(pager._source.end, end)
+        self.assertEqual(pager.rows(1090, 20), sessions(1091, 10))
+        # A rewritten history is indexed from scratch
+        self.storage.replace_sessions('pushups', sessions(1, 10))
+        self.assertEqual(pager.refresh(), 10)
+        self.assertEqual(pager.rows(0, 20), sessions(1, 10))
+
+    def test_rows_without_waiting_come_back_as_they_load(self):
+        pager = self.pager(page_size=64, cache_pages=4)
+        pager.refresh()
+        rows = pager.rows(500, 10, wait=False)
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(pager.rows(500, 10), sessions(501, 10))
+        self.assertLessEqual(len(pager._pages), 4)
+
+    def test_compacted_and_sqlite_histories_page_by_session(self):
+        self.storage.compact('pushups', 30, segment_size=256)
+        sqlite = SQLiteStorage(os.path.join(self.data_dir, 'habits.db'))
+        sqlite.append_sessions('pushups', sessions(1, 1000))
+        for storage in (self.storage, sqlite):
+            pager = HistoryPager(storage, 'pushups', page_size=100)
+            try:
+                self.assertEqual(pager.refresh(), 1000)
+                self.assertEqual(pager.rows(250, 100), sessions(251, 100))
+            finally:
+                pager.close()  # before the storage, as the GUI does
+        sqlite.close()
+
+    def test_rating_envelope_is_the_min_max_per_column(self):
+        pager = self.pager()
+        self.assertEqual(pager.rating_envelope(10), [])
+        pager.refresh()
+        ratings = [row['rating'] for row in sessions(1, 1000)]
+        envelope = pager.rating_envelope(10)
+        self.assertEqual(envelope, [(min(ratings[i * 100:(i + 1) * 100]), max(ratings[i * 100:(i + 1) * 100]))
+                                    for i in range(10)])
+
+
+class MinMaxDecimateTest(unittest.TestCase):
+    def test_every_spike_survives(self):
+        values = [0.0] * 1000
+        values[137] = 9.0
+        values[862] = -4.0
+        envelope = minmax_decimate(values, 50)
+        self.assertEqual(len(envelope), 50)
+        self.assertEqual(envelope[6], (0.0, 9.0))
+        self.assertEqual(envelope[43], (-4.0, 0.0))
+        self.assertEqual(sum(1 for low, high in envelope if (low, high) != (0.0, 0.0)), 2)
+
+    def test_uneven_buckets_cover_every_value(self):
+        values = list(range(103))
+        envelope = minmax_decimate(values, 10)
+        self.assertEqual(envelope[0][0], 0)
+        self.assertEqual(envelope[-1][1], 102)
+        for (low, high), (next_low, _) in zip(envelope, envelope[1:]):
+            self.assertEqual(next_low, high + 1)
+
+    def test_short_and_empty_inputs(self):
+        self.assertEqual(minmax_decimate([3.0, 1.0], 10), [(3.0, 3.0), (1.0, 1.0)])
+        self.assertEqual(minmax_decimate([], 10), [])
+        self.assertEqual(minmax_decimate([1.0], 0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
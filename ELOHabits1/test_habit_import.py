@@ -0,0 +1,51 @@
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from habit_import import _adversary_bounds, _value_matrix
+from habit_model import Habit
+from habit_storage import LegacyStorage
+
+
+class ImportScoringTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_value_matrix_fills_missing_params(self):
+        records = [({'a': 1.0, 'b': 2.0}, None, None, None), ({'b': 3.0}, None, None, None)]
+        self.assertEqual(_value_matrix(records, ['a', 'b']).tolist(), [[1.0, 2.0], [0.0, 3.0]])
+        self.assertEqual(_value_matrix(records, ['b']).tolist(), [[2.0], [3.0]])
+        self.assertEqual(_value_matrix(records, []).shape, (2, 0))
+
+    def test_bounds_match_habit_session_by_session(self):
+        rnd = random.Random(7)
+        habit = Habit('run', {'km': 2.0, 'min': 0.5}, window_size=10, storage=LegacyStorage(self.data_dir))
+        habit.ensure_loaded()
+        for _ in range(4):
+            habit.scores.append(rnd.uniform(10, 40))
+        prior = list(habit.scores)
+        totals = np.array([rnd.uniform(0, 60) for _ in range(200)])
+        difficulties = [rnd.choice(['easy', 'normal', 'hard', 'unknown']) for _ in totals]
+        low, high = _adversary_bounds(habit, prior, totals, np.arange(len(totals)), difficulties)
+        for i, total in enumerate(totals.tolist()):
+            expected = habit.adversary_bounds(difficulties[i])
+            self.assertAlmostEqual(low[i], expected[0], places=9)
+            self.assertAlmostEqual(high[i], expected[1], places=9)
+            habit.scores.append(total)
+
+    def test_bounds_without_scores(self):
+        habit = Habit('run', {'km': 2.0, 'min': 0.5}, storage=LegacyStorage(self.data_dir))
+        habit.ensure_loaded()
+        low, high = _adversary_bounds(habit, [], np.array([5.0, 7.0]), np.array([0, 1]), ['hard', 'hard'])
+        self.assertEqual((low[0], high[0]), habit.adversary_bounds('hard'))
+        self.assertAlmostEqual(high[1], 5.0 * 0.2 * 1.5 + 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import bisect
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+from habit_leaderboard import Leaderboard, SkipList
+from habit_model import HabitManager
+from habit_storage import LegacyStorage
+
+
+class SkipListTest(unittest.TestCase):
+    def test_matches_sorted_list_over_20k_operations(self):
+        rnd = random.Random(13)
+        skip = SkipList(seed=13)
+        expected = []
+        for step in range(20000):
+            key = rnd.randrange(5000)
+            i = bisect.bisect_left(expected, key)
+            present = i < len(expected) and expected[i] == key
+            if present and rnd.random() < 0.5:
+                skip.remove(key)
+                del expected[i]
+            else:
+                self.assertEqual(skip.add(key), not present)
+                if not present:
+                    expected.insert(i, key)
+            probe = rnd.randrange(5000)
+            self.assertEqual(skip.bisect_left(probe), bisect.bisect_left(expected, probe))
+            if expected:
+                position = rnd.randrange(len(expected))
+                self.assertEqual(skip[position], expected[position])
+                self.assertEqual(skip.index(expected[position]), position)
+                self.assertEqual(list(skip.islice(position, position + 5)), expected[position:position + 5])
+            if step % 1000 == 0:
+                self.assertEqual(list(skip), expected)
+        self.assertEqual(len(skip), len(expected))
+        self.assertEqual(list(skip), expected)
+
+
+class LeaderboardTest(unittest.TestCase):
+    def test_matches_full_sort(self):
+        rnd = random.Random(5)
+        board = Leaderboard()
+        ratings = {}
+        for _ in range(5000):
+            name = f"h{rnd.randrange(300)}"
+            if name in ratings and rnd.random() < 0.2:
+                board.remove(name)
+                del ratings[name]
+            else:
+                ratings[name] = round(rnd.uniform(200, 1600), 1)
+                board.update(name, ratings[name])
+        order = sorted(ratings, key=lambda name: (-ratings[name], name))
+        self.assertEqual([name for _, name, _ in board.standings(0, len(order))], order)
+        for rank, name in enumerate(order, 1):
+            self.assertEqual(board.rank_of(name), rank)
+        self.assertEqual(sum(count for _, count in board.tier_counts()), len(order))
+        self.assertEqual([name for _, name, _ in board.between(700, 1000)],
+                         [name for name in order if 700 <= ratings[name] <= 1000])
+
+
+class StaleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_loaded_rating_replaces_a_stale_index(self):
+        manager = HabitManager(storage=LegacyStorage(self.data_dir))
+        for name in ('a', 'b'):
+            manager.create_habit(name, {'reps': 1.0})
+        rating = manager.record_session('a', {'reps': 40.0}, adv_score=10.0)['rating']
+        # An index written the way sessions used to leave it
+        storage = LegacyStorage(self.data_dir)
+        index = storage.load_index()
+        index['a']['rating'] = 500
+        with open(storage.index_file, 'w') as f:
+            json.dump(index, f)
+        reopened = HabitManager(storage=LegacyStorage(self.data_dir))
+        reopened.habits['a'].ensure_loaded()
+        self.assertEqual(reopened.leaderboard.rating('a'), rating)
+        self.assertEqual(reopened.leaderboard.rank_of('a'), 1)
+        reopened.save_changes()
+        self.assertEqual(LegacyStorage(self.data_dir).load_index()['a']['rating'], rating)
+
+    def test_repairs_are_written_once(self):
+        manager = HabitManager(storage=LegacyStorage(self.data_dir))
+        for i in range(20):
+            manager.create_habit(f"h{i}", {'reps': 1.0})
+            manager.record_session(f"h{i}", {'reps': 40.0}, adv_score=10.0)
+        storage = LegacyStorage(self.data_dir)
+        writes = []
+        storage.save_index = lambda habit_data: writes.append(dict(habit_data))
+        storage.save_habit = lambda name, meta: writes.append({name: meta})
+        reopened = HabitManager(storage=storage)
+        for habit in reopened.habits.values():
+            habit.ensure_loaded()
+        self.assertEqual(writes, [])
+        reopened.save_changes()
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(all(meta['rating'] > 500 for meta in writes[0].values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
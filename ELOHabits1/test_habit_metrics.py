@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import habit_metrics as metrics
+
+
+class MetricsOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.registry = metrics.MetricsRegistry()
+        for seconds in (0.00002, 0.0003, 0.0003, 2.0, 7.0):
+            self.registry.observe('habit.save_session', seconds)
+        self.registry.count('storage.fsyncs')
+        self.registry.count('storage.bytes_written', 4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_json_dump(self):
+        path = os.path.join(self.data_dir, 'metrics.json')
+        self.registry.dump(path)
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(data['counters'], {'storage.fsyncs': 1, 'storage.bytes_written': 4096})
+        timer = data['timers']['habit.save_session']
+        self.assertEqual(timer['count'], 5)
+        self.assertAlmostEqual(timer['total'], 9.00062)
+        self.assertAlmostEqual(timer['mean'], 9.00062 / 5)
+        self.assertEqual((timer['min'], timer['max']), (0.00002, 7.0))
+        # 7 s is past the last bucket and only shows in the count
+        self.assertEqual(timer['buckets'], [0, 1, 2, 0, 0, 0, 0, 0, 0, 0, 1])
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_prometheus_dump(self):
+        path = os.path.join(self.data_dir, 'metrics.prom')
+        self.registry.dump(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        metric = 'elohabits_habit_save_session_seconds'
+        self.assertEqual(lines[0], f"# TYPE {metric} histogram")
+        buckets = [line for line in lines if line.startswith(f"{metric}_bucket")]
+        self.assertEqual(buckets[0], f'{metric}_bucket{{le="1e-05"}} 0')
+        self.assertEqual(buckets[2], f'{metric}_bucket{{le="0.0005"}} 3')
+        self.assertEqual(buckets[-2], f'{metric}_bucket{{le="5"}} 4')
+        self.assertEqual(buckets[-1], f'{metric}_bucket{{le="+Inf"}} 5')
+        counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+        self.assertEqual(counts, sorted(counts))  # cumulative
+        self.assertIn(f"{metric}_sum 9.000620000", lines)
+        self.assertIn(f"{metric}_count 5", lines)
+        self.assertIn("# TYPE elohabits_storage_bytes_written_total counter", lines)
+        self.assertIn("elohabits_storage_bytes_written_total 4096", lines)
+        self.assertIn("elohabits_storage_fsyncs_total 1", lines)
+
+
+class TimedTest(unittest.TestCase):
+    def tearDown(self):
+        metrics.disable()
+        metrics.REGISTRY.reset()
+
+    def test_nothing_is_recorded_while_disabled(self):
+        work = metrics.timed('test.work')(lambda: 42)
+        self.assertEqual(work(), 42)
+        metrics.count('test.calls')
+        self.assertEqual(metrics.REGISTRY.snapshot(), {'timers': {}, 'counters': {}})
+
+    def test_functions_and_coroutines_are_timed(self):
+        @metrics.timed('test.sync')
+        def work():
+            return 1
+
+        @metrics.timed('test.async')
+        async def wait():
+            await asyncio.sleep(0.01)
+            return 2
+
+        metrics.enable()
+        self.assertEqual(work(), 1)
+        self.assertEqual(asyncio.run(wait()), 2)
+        metrics.count('test.calls', 3)
+        snapshot = metrics.REGISTRY.snapshot()
+        self.assertEqual(snapshot['timers']['test.sync']['count'], 1)
+        # Timed until the coroutine finished, not until it was created
+        self.assertGreaterEqual(snapshot['timers']['test.async']['min'], 0.009)
+        self.assertEqual(snapshot['counters'], {'test.calls': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import random
+import shutil
+import statistics
+import tempfile
+import unittest
+from collections import deque
+
+from habit_model import DIFFICULTY_BANDS, Habit, HabitManager
+from habit_storage import LegacyStorage
+
+
+class ScalarHabit:
+    # The plain implementation Habit's packed state replaced: a dict of
+    # weights, a deque window and statistics over it on every call
+    def __init__(self, params, rating=500, window_size=30, k_factor=20):
+        self.params = dict(params)
+        self.rating = rating
+        self.k_factor = k_factor
+        self.scores = deque(maxlen=window_size)
+
+    def calculate_score(self, values):
+        return sum(values.get(param, 0) * weight for param, weight in self.params.items())
+
+    def adversary_bounds(self, difficulty):
+        if not self.scores:
+            base = sum(self.params.values())
+            return base * 0.8, base * 1.2
+        mu = statistics.fmean(self.scores)
+        sigma = statistics.stdev(self.scores) if len(self.scores) > 1 else mu * 0.2
+        low_k, high_k = DIFFICULTY_BANDS.get(difficulty, DIFFICULTY_BANDS['normal'])
+        low = mu + low_k * sigma
+        if low_k < 0:
+            low = max(0, low)
+        return low, mu + high_k * sigma
+
+    def update_rating(self, user_score, adv_score):
+        expected = 1 / (1 + 10 ** ((adv_score - self.rating) / 400))
+        actual = 1 if user_score > adv_score else 0.5 if user_score == adv_score else 0
+        delta = self.k_factor * (actual - expected)
+        self.rating += delta
+        return delta
+
+
+class ScalarEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_packed_state_matches_scalar_over_3000_sessions(self):
+        rnd = random.Random(12)
+        params = {'pushups': 1.5, 'squats': 1.0, 'plank': 0.25}
+        habit = Habit('mixed', dict(params), window_size=30, storage=LegacyStorage(self.data_dir))
+        scalar = ScalarHabit(params)
+        for _ in range(3000):
+            values = {param: rnd.uniform(0, 50) for param in params if rnd.random() > 0.1}
+            difficulty = rnd.choice(['easy', 'normal', 'hard'])
+            score = habit.calculate_score(values)
+            self.assertAlmostEqual(score, scalar.calculate_score(values), places=9)
+            low, high = habit.adversary_bounds(difficulty)
+            expected_low, expected_high = scalar.adversary_bounds(difficulty)
+            self.assertAlmostEqual(low, expected_low, delta=1e-9 * max(1.0, abs(expected_low)))
+            self.assertAlmostEqual(high, expected_high, delta=1e-9 * max(1.0, abs(expected_high)))
+            adv_score = rnd.uniform(expected_low, expected_high)
+            self.assertEqual(habit.update_rating(score, adv_score), scalar.update_rating(score, adv_score))
+            self.assertEqual(habit.rating, scalar.rating)
+            habit.scores.append(score)
+            scalar.scores.append(score)
+            self.assertEqual(list(habit.scores), list(scalar.scores))
+        self.assertAlmostEqual(habit.scores.mean, statistics.fmean(scalar.scores), places=9)
+        self.assertAlmostEqual(habit.scores.stdev(), statistics.stdev(scalar.scores), places=9)
+
+
+class ResidentHabitsTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def manager(self, max_resident):
+        manager = HabitManager(storage=LegacyStorage(self.data_dir), max_resident=max_resident)
+        for name in ('a', 'b', 'c'):
+            manager.create_habit(name, {'reps': 1.0})
+        return manager
+
+    def test_zero_keeps_the_habit_loaded(self):
+        manager = self.manager(0)
+        for name in ('a', 'b', 'c'):
+            self.assertTrue(manager.habits[name].ensure_loaded().loaded)
+        self.assertEqual(list(manager._resident), ['c'])
+
+    def test_current_and_loaded_habit_both_stay(self):
+        manager = self.manager(1)
+        manager.set_current_habit('a')
+        habit = manager.habits['b'].ensure_loaded()
+        self.assertTrue(habit.loaded)
+        self.assertTrue(manager.habits['a'].loaded)
+        manager.habits['c'].ensure_loaded()
+        self.assertFalse(habit.loaded)
+        self.assertEqual(list(manager._resident), ['a', 'c'])
+
+
+class IndexRatingTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_sessions_leave_the_index_to_save_changes(self):
+        manager = HabitManager(storage=LegacyStorage(self.data_dir))
+        manager.create_habit('a', {'reps': 1.0})
+        with open(manager.storage.index_file, 'rb') as f:
+            before = f.read()
+        for _ in range(5):
+            result = manager.record_session('a', {'reps': 40.0}, adv_score=10.0)
+        with open(manager.storage.index_file, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        manager.save_changes()
+        index = LegacyStorage(self.data_dir).load_index()
+        self.assertEqual(index['a']['rating'], result['rating'])
+        self.assertNotEqual(result['rating'], 500)
+        # The next run ranks the habit by that rating without loading it
+        reopened = HabitManager(storage=LegacyStorage(self.data_dir))
+        self.assertEqual(reopened.leaderboard.rating('a'), result['rating'])
+
+
+class CountingStorage(LegacyStorage):
+    def __init__(self, data_dir):
+        super().__init__(data_dir)
+        self.rollup_loads = 0
+
+    def load_rollups(self, name):
+        self.rollup_loads += 1
+        return super().load_rollups(name)
+
+
+class RollupsTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        manager = HabitManager(storage=LegacyStorage(self.data_dir))
+        manager.create_habit('a', {'reps': 1.0})
+        for i in range(20):
+            manager.record_session('a', {'reps': float(i % 7)}, adv_score=3.0)
+        manager.save_habits()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_sessions_never_read_rollups(self):
+        from habit_rollups import Rollups
+        storage = CountingStorage(self.data_dir)
+        manager = HabitManager(storage=storage)
+        manager.set_current_habit('a')
+        for i in range(10):
+            manager.record_session('a', {'reps': float(i)}, adv_score=3.0)
+        self.assertEqual(storage.rollup_loads, 0)
+        # The first query reads them once and catches up the new sessions
+        self.assertEqual(manager.rollups('a').dumps(), Rollups.from_sessions(storage.iter_sessions('a')).dumps())
+        manager.record_session('a', {'reps': 2.0}, adv_score=3.0)
+        self.assertEqual(manager.rollups('a').dumps(), Rollups.from_sessions(storage.iter_sessions('a')).dumps())
+        self.assertEqual(storage.rollup_loads, 1)
+
+    def test_evicted_habit_drops_its_rollups(self):
+        from habit_rollups import Rollups
+        manager = HabitManager(storage=LegacyStorage(self.data_dir), max_resident=1)
+        manager.create_habit('b', {'reps': 1.0})
+        manager.rollups('a')
+        manager.record_session('a', {'reps': 4.0}, adv_score=3.0)
+        manager.habits['b'].ensure_loaded()
+        self.assertNotIn('a', manager._rollups)
+        # Saved on the way out, including the session folded in
+        stored = Rollups.loads(manager.storage.load_rollups('a'))
+        self.assertEqual(stored.dumps(), Rollups.from_sessions(manager.storage.iter_sessions('a')).dumps())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import habit_replay
+from habit_model import HabitManager
+from habit_storage import open_storage
+
+PARAMS = {'reps': 1.0, 'sets': 2.5}
+
+
+class ReplayTest(unittest.TestCase):
+    # A fixed history recorded through the model, on each backend
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.locations = [os.path.join(self.data_dir, 'csv'), os.path.join(self.data_dir, 'habits.db'),
+                          os.path.join(self.data_dir, 'habits.columnar')]
+        for location in self.locations:
+            if not location.endswith('.db'):
+                os.makedirs(location)
+            manager = HabitManager(storage=open_storage(location))
+            manager.create_habit('pushups', PARAMS, k_factor=24)
+            for i in range(150):
+                values = {'reps': float(i % 11)} if i % 13 == 0 else {'reps': float(i % 11), 'sets': float(i % 4)}
+                manager.record_session('pushups', values, adv_score=float((i * 7) % 19))
+            manager.storage.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def recorded(self, location):
+        storage = open_storage(location)
+        rows = list(storage.iter_sessions('pushups'))
+        storage.close()
+        return rows
+
+    def test_replay_reproduces_recorded_ratings(self):
+        for location in self.locations:
+            rows = self.recorded(location)
+            storage = open_storage(location)
+            result = habit_replay.HistoryReplay(storage, 'pushups').replay(PARAMS, 24)
+            storage.close()
+            np.testing.assert_allclose(result.totals, [row['total_score'] for row in rows], atol=1e-9)
+            np.testing.assert_allclose(result.deltas, [row['delta'] for row in rows], atol=1e-9)
+            np.testing.assert_allclose(result.ratings, [row['rating'] for row in rows], atol=1e-9)
+
+    def test_numba_kernel_matches_the_pure_path(self):
+        # _elo_loop is what numba compiles; run as plain Python here it must
+        # agree with the path taken without numba
+        rows = self.recorded(self.locations[0])
+        totals = np.array([row['total_score'] for row in rows])
+        adv_scores = np.array([row['adv_score'] for row in rows])
+        deltas, ratings = np.empty_like(totals), np.empty_like(totals)
+        getattr(habit_replay._elo_loop, 'py_func', habit_replay._elo_loop)(
+            totals, adv_scores, 500.0, 24.0, deltas, ratings)
+        njit, habit_replay.njit = habit_replay.njit, None
+        try:
+            pure = habit_replay.elo_trajectory(totals, adv_scores, 500, 24)
+        finally:
+            habit_replay.njit = njit
+        np.testing.assert_allclose(deltas, pure[0], atol=1e-9)
+        np.testing.assert_allclose(ratings, pure[1], atol=1e-9)
+        np.testing.assert_allclose(ratings, [row['rating'] for row in rows], atol=1e-9)
+
+    def test_apply_with_unchanged_settings_rewrites_identically(self):
+        for location in self.locations:
+            before = self.recorded(location)
+            manager = HabitManager(storage=open_storage(location))
+            rating = manager.habits['pushups'].ensure_loaded().rating
+            manager.replay_habit('pushups', apply=True)
+            self.assertAlmostEqual(manager.habits['pushups'].rating, rating, places=9)
+            manager.save_habits()
+            manager.storage.close()
+            after = self.recorded(location)
+            self.assertEqual(len(after), len(before))
+            for old, new in zip(before, after):
+                for key in ('total_score', 'delta', 'rating'):
+                    self.assertAlmostEqual(new[key], old[key], places=9)
+                for key in ('session', 'adv_score', 'values', 'timestamp', 'difficulty'):
+                    self.assertEqual(new[key], old[key], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
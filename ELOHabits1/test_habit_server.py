@@ -0,0 +1,98 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import unittest
+
+from habit_server import HabitServer, _request
+from habit_storage import open_storage
+from habit_writer import WriteBehindStorage
+
+
+class HabitServerTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def run_server(self, scenario):
+        # Runs scenario(server, port) against a server on an ephemeral port
+        async def main():
+            server = HabitServer(WriteBehindStorage(open_storage(self.data_dir)))
+            listener = await server.start('127.0.0.1', 0)
+            try:
+                return await scenario(server, listener.sockets[0].getsockname()[1])
+            finally:
+                await server.close()
+        return asyncio.run(main())
+
+    def test_concurrent_submits_to_one_habit_are_serialized(self):
+        async def scenario(server, port):
+            await server.dispatch('POST', '/habits', json.dumps({'name': 'pushups', 'params': {'reps': 1.0}}).encode())
+
+            async def client(index):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                results = []
+                for i in range(index, 200, 10):
+                    results.append(await _request(reader, writer, 'POST', '/habits/pushups/sessions',
+                                                  {'values': {'reps': i % 7}, 'adv_score': 3.0}))
+                writer.close()
+                return results
+
+            replies = [reply for replies in await asyncio.gather(*(client(i) for i in range(10)))
+                       for reply in replies]
+            status, history = await server.dispatch('GET', '/habits/pushups/history?count=1000', b'')
+            return replies, history
+
+        replies, history = self.run_server(scenario)
+        self.assertEqual({status for status, result in replies}, {201})
+        sessions = history['sessions']
+        self.assertEqual(history['total'], 200)
+        # Each submit saw the rating the previous one left: one chain, no gaps
+        self.assertEqual(sorted(result['session'] for status, result in replies), list(range(1, 201)))
+        self.assertEqual([row['session'] for row in sessions], list(range(1, 201)))
+        for before, row in zip(sessions, sessions[1:]):
+            self.assertAlmostEqual(before['rating'] + row['delta'], row['rating'])
+
+    def test_malformed_requests_are_rejected(self):
+        async def scenario(server, port):
+            await server.dispatch('POST', '/habits', json.dumps({'name': 'pushups', 'params': {'reps': 1.0}}).encode())
+            statuses = []
+            for method, target, body in (
+                    ('POST', '/habits', b'{not json'),
+                    ('POST', '/habits', b'[1, 2]'),
+                    ('POST', '/habits', b'{"name": "squats"}'),
+                    ('POST', '/habits', b'{"name": "squats", "params": {"reps": "many"}}'),
+                    ('POST', '/habits/pushups/sessions', b'{"values": 3}'),
+                    ('POST', '/habits/pushups/sessions', b'{"values": {"sets": 3}}'),
+                    ('POST', '/habits/pushups/sessions', b'{"values": {"reps": "x"}}'),
+                    ('GET', '/habits/pushups/adversary?difficulty=brutal', b''),
+                    ('GET', '/habits/pushups/history?count=-1', b''),
+                    ('GET', '/leaderboard?count=ten', b''),
+                    ('POST', '/habits/pushups/sync', b'{"start": -1, "rows": []}'),
+                    ('POST', '/habits/pushups/sync', b'{"start": 0, "rows": [{"session": 1}]}')):
+                statuses.append((target, (await server.dispatch(method, target, body))[0]))
+            missing = []
+            for method, target in (('GET', '/habits/nope/adversary'), ('POST', '/habits/nope/sessions'),
+                                   ('GET', '/habits/nope/history'), ('GET', '/habits/nope/chunks'),
+                                   ('GET', '/habits/nope/sync'), ('GET', '/nowhere'),
+                                   ('GET', '/habits/pushups/nowhere')):
+                body = b'{"values": {"reps": 1}}' if method == 'POST' else b''
+                missing.append((target, (await server.dispatch(method, target, body))[0]))
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b"POST /habits HTTP/1.1\r\nContent-Length: lots\r\n\r\n")
+            bad_length = int((await reader.readline()).split()[1])
+            writer.close()
+            status, history = await server.dispatch('GET', '/habits/pushups/history', b'')
+            return statuses, missing, bad_length, history['total']
+
+        statuses, missing, bad_length, total = self.run_server(scenario)
+        self.assertEqual([status for target, status in statuses], [400] * len(statuses), statuses)
+        self.assertEqual([status for target, status in missing], [404] * len(missing), missing)
+        self.assertEqual(bad_length, 400)
+        self.assertEqual(total, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
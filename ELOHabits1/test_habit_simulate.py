@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+from habit_simulate import simulate, simulate_reference
+
+
+class SimulateTest(unittest.TestCase):
+    def assertMatchesReference(self, **kwargs):
+        kwargs = dict(dict(initial_rating=500, params={'reps': 1.0}, trajectories=8, sessions=120, seed=7),
+                      **kwargs)
+        vectorized = simulate(return_ratings=True, **kwargs)['ratings']
+        reference = simulate_reference(**kwargs)
+        np.testing.assert_allclose(vectorized, reference, rtol=0, atol=1e-6)
+
+    def test_matches_reference_for_a_fixed_seed(self):
+        self.assertMatchesReference(initial_scores=[10.0, 12.0, 9.0, 11.0], score_source=(11.0, 2.0),
+                                    window_size=7)
+
+    def test_matches_reference_for_large_scores_with_little_spread(self):
+        # Sums of squares would cancel away most of this variance
+        scores = np.array([20000.0 + i % 5 for i in range(40)])
+        self.assertMatchesReference(initial_scores=list(scores[:30]), initial_rating=19990.0,
+                                    score_source=scores, difficulty='hard')
+
+    def test_matches_reference_for_a_new_habit_and_window_of_one(self):
+        self.assertMatchesReference(initial_scores=[], window_size=1, score_source=(5.0, 1.0))
+
+    def test_window_size_must_be_positive(self):
+        for function in (simulate, simulate_reference):
+            with self.assertRaises(ValueError):
+                function([1.0], 500, {'reps': 1.0}, window_size=0, trajectories=2, sessions=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
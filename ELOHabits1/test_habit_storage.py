@@ -0,0 +1,263 @@
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from habit_storage import LegacyStorage, SQLiteStorage, make_session, migrate
+
+
+def write_legacy_csv(path, count, window=30):
+    # The CSV as the original tracker wrote it: the session column was the
+    # length of the score window, so it stops at 30
+    rating = 500.0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['session', 'total_score', 'adv_score', 'delta', 'rating', 'reps'])
+        for i in range(1, count + 1):
+            delta = 4.0 if i % 3 else -4.0
+            rating += delta
+            writer.writerow([min(i, window), float(i % 7), 3.0, delta, rating, float(i % 5)])
+    return rating
+
+
+class LegacyNumberingTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.storage = LegacyStorage(self.data_dir)
+        self.rating = write_legacy_csv(self.storage.history_path('pushups'), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_load_counts_every_row(self):
+        scores, rating, session_count = self.storage.load_window('pushups', 30)
+        self.assertEqual(session_count, 100)
+        self.assertEqual(rating, self.rating)
+        self.assertEqual(scores, [float(i % 7) for i in range(71, 101)])
+
+    def test_load_renumbers_once_and_checkpoints(self):
+        self.storage.load_window('pushups', 30)
+        rows = list(self.storage.iter_sessions('pushups'))
+        self.assertEqual([row['session'] for row in rows], list(range(1, 101)))
+        self.assertEqual(rows[-1]['values'], {'reps': 0.0})
+        self.assertTrue(os.path.exists(self.storage.checkpoint_path('pushups')))
+        # Without the checkpoint the tail read trusts the renumbered file
+        os.remove(self.storage.checkpoint_path('pushups'))
+        fresh = LegacyStorage(self.data_dir)
+        self.assertEqual(fresh.load_window('pushups', 30)[2], 100)
+
+    def test_next_session_does_not_collide(self):
+        from habit_model import Habit
+        habit = Habit('pushups', {'reps': 1.0}, storage=self.storage)
+        habit.ensure_loaded()
+        habit.save_session({'reps': 2.0}, 5.0, 3.0, 4.0)
+        numbers = [row['session'] for row in self.storage.iter_sessions('pushups')]
+        self.assertEqual(numbers, list(range(1, 102)))
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.source = LegacyStorage(self.data_dir)
+        with open(self.source.index_file, 'w') as f:
+            json.dump({'pushups': {'params': {'reps': 1.0}, 'rating': 500, 'k_factor': 20}}, f)
+        self.rating = write_legacy_csv(self.source.history_path('pushups'), 100)
+        self.target = SQLiteStorage(os.path.join(self.data_dir, 'habits.db'))
+
+    def tearDown(self):
+        self.target.close()
+        shutil.rmtree(self.data_dir)
+
+    def test_legacy_history_migrates_whole(self):
+        self.assertEqual(migrate(self.source, self.target), (1, 100))
+        rows = list(self.target.iter_sessions('pushups'))
+        self.assertEqual([row['session'] for row in rows], list(range(1, 101)))
+        self.assertEqual(self.target.load_window('pushups', 30)[1:], (self.rating, 100))
+
+    def test_duplicate_session_raises(self):
+        row = make_session(1, 5.0, 3.0, 4.0, 504.0, {'reps': 1.0})
+        self.target.append_sessions('pushups', [row])
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.target.append_sessions('pushups', [row])
+
+
+class EmptyWindowTest(unittest.TestCase):
+    def setUp(self):
+        from habit_columnar import ColumnarStorage
+        self.data_dir = tempfile.mkdtemp()
+        for directory in ('legacy', 'habits.columnar'):
+            os.makedirs(os.path.join(self.data_dir, directory))
+        self.stores = [LegacyStorage(os.path.join(self.data_dir, 'legacy')),
+                       SQLiteStorage(os.path.join(self.data_dir, 'habits.db')),
+                       ColumnarStorage(os.path.join(self.data_dir, 'habits.columnar'))]
+        rows = [make_session(i, float(i), 1.0, 1.0, 500.0 + i, {'reps': float(i)}, float(i), 'normal')
+                for i in range(1, 41)]
+        for storage in self.stores:
+            storage.save_habit('pushups', {'params': {'reps': 1.0}, 'rating': 500, 'k_factor': 20})
+            storage.append_sessions('pushups', rows)
+
+    def tearDown(self):
+        self.stores[1].close()
+        shutil.rmtree(self.data_dir)
+
+    def test_zero_window_keeps_rating_and_count(self):
+        for storage in self.stores:
+            self.assertEqual(storage.load_window('pushups', 0), ([], 540.0, 40), type(storage).__name__)
+            self.assertEqual(storage.load_window('pushups', 3), ([38.0, 39.0, 40.0], 540.0, 40))
+
+    def test_replay_rewrite_releases_mapped_history(self):
+        import numpy as np
+        from habit_replay import HistoryReplay
+        history = HistoryReplay(self.stores[2], 'pushups')
+        self.assertIsInstance(history.values.base, np.memmap)
+        history.rewrite(history.replay({'reps': 2.0}, 20))
+        self.assertEqual(len(history), 0)
+        self.assertEqual(self.stores[2].load_window('pushups', 1)[0], [80.0])
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.storage = LegacyStorage(self.data_dir)
+        rng = random.Random(7)
+        rating = 500.0
+        self.rows = []
+        for i in range(1, 2001):
+            delta = rng.uniform(-10, 10)
+            rating += delta
+            self.rows.append(make_session(i, rng.uniform(0, 20), rng.uniform(0, 20), delta, rating,
+                                          {'reps': float(rng.randrange(30)), 'sets': rng.uniform(1, 5)},
+                                          1.6e9 + 3600 * i, rng.choice(['easy', 'normal', 'hard'])))
+        self.storage.replace_sessions('pushups', self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def segment_files(self):
+        return sorted(entry for entry in os.listdir(self.data_dir) if entry.endswith('.seg'))
+
+    def test_compacted_summary_matches_brute_force(self):
+        from habit_segments import session_value
+        self.assertEqual(self.storage.compact('pushups', 30, 256), 1792)
+        self.assertEqual(len(self.segment_files()), 7)
+        storage = LegacyStorage(self.data_dir)
+        self.assertEqual(list(storage.iter_sessions('pushups')), self.rows)
+        for column in ('total_score', 'rating', 'sets'):
+            for first, last in ((None, None), (1, 256), (100, 1900), (257, 512), (1793, 2000), (1500, 1400)):
+                values = [session_value(row, column) for row in self.rows
+                          if (first is None or row['session'] >= first) and (last is None or row['session'] <= last)]
+                entry = storage.aggregate('pushups', column, first, last)
+                if not values:
+                    self.assertIsNone(entry)
+                    continue
+                count, total, squares, low, high = entry
+                self.assertEqual((count, low, high), (len(values), min(values), max(values)))
+                self.assertAlmostEqual(total, math.fsum(values), delta=1e-9 * abs(total))
+                self.assertAlmostEqual(squares, math.fsum(v * v for v in values), delta=1e-9 * squares)
+
+    def test_legacy_numbering_is_repaired_before_compacting(self):
+        rating = write_legacy_csv(self.storage.history_path('legacy'), 1000)
+        self.assertEqual(self.storage.compact('legacy', 30, 256), 768)
+        storage = LegacyStorage(self.data_dir)
+        rows = list(storage.iter_sessions('legacy'))
+        self.assertEqual([row['session'] for row in rows], list(range(1, 1001)))
+        self.assertEqual(rows[-1]['rating'], rating)
+        self.assertEqual(storage.aggregate('legacy', 'total_score')[0], 1000)
+
+    def test_repeated_numbers_are_refused(self):
+        self.rows[600]['session'] = 600
+        self.storage.replace_sessions('pushups', self.rows)
+        with open(self.storage.history_path('pushups'), 'rb') as f:
+            before = f.read()
+        with self.assertRaises(ValueError):
+            self.storage.compact('pushups', 30, 256)
+        with open(self.storage.history_path('pushups'), 'rb') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(self.segment_files(), [])
+
+    def test_rewrite_after_another_process_compacted(self):
+        from habit_model import HabitManager
+        with open(self.storage.index_file, 'w') as f:
+            json.dump({'pushups': {'params': {'reps': 1.0, 'sets': 2.0}, 'rating': 500, 'k_factor': 20}}, f)
+        # A long-running process reads the history before and after a CLI
+        # compaction in another process, then rewrites it
+        manager = HabitManager(storage=LegacyStorage(self.data_dir))
+        self.assertEqual(len(list(manager.storage.iter_sessions('pushups'))), 2000)
+        self.assertEqual(LegacyStorage(self.data_dir).compact('pushups', 30, 256), 1792)
+        self.assertEqual(len(list(manager.storage.iter_sessions('pushups'))), 2000)
+        manager.update_habit_params('pushups', {'reps': 2.0, 'sets': 1.0}, recompute=True)
+        rows = list(LegacyStorage(self.data_dir).iter_sessions('pushups'))
+        self.assertEqual([row['session'] for row in rows], list(range(1, 2001)))
+        self.assertEqual([row['values'] for row in rows], [row['values'] for row in self.rows])
+        self.assertEqual(self.segment_files(), [])
+        self.assertFalse(os.path.exists(self.storage.manifest_path('pushups')))
+
+    def test_only_strays_whose_rows_are_in_the_csv_are_removed(self):
+        from habit_segments import write_segment
+        # From a compaction that died before cutting the CSV, and a file the
+        # manifest does not know of whose sessions are nowhere else
+        write_segment(self.storage.segment_path('pushups', 1), ['session'], [], self.rows[:10])
+        foreign = self.storage.segment_path('pushups', 5000)
+        write_segment(foreign, ['session'], [], [dict(row, session=5000 + i) for i, row in enumerate(self.rows[:3])])
+        storage = LegacyStorage(self.data_dir)
+        self.assertEqual(storage.segments('pushups'), [])
+        self.assertEqual(storage.compact('pushups', 30, 1000), 1000)
+        self.assertEqual(self.segment_files(), ['habit_pushups.0000000001.seg', os.path.basename(foreign)])
+        self.assertEqual(list(LegacyStorage(self.data_dir).iter_sessions('pushups')), self.rows)
+
+
+class IndexMergeTest(unittest.TestCase):
+    # Two processes (the server and the GUI, say) each with their own
+    # storage over one data directory
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.first = LegacyStorage(self.data_dir)
+        self.second = LegacyStorage(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def meta(self, rating):
+        return {'params': {'reps': 1.0}, 'rating': rating, 'k_factor': 20}
+
+    def test_stale_index_keeps_habits_created_elsewhere(self):
+        self.first.save_index({'a': self.meta(500)})
+        stale = self.second.load_index()
+        self.first.save_habit('b', self.meta(510))
+        stale['a'] = self.meta(520)
+        self.second.save_index(stale)
+        self.assertEqual(LegacyStorage(self.data_dir).load_index(), {'a': self.meta(520), 'b': self.meta(510)})
+        self.first.delete_habit('a')
+        self.assertEqual(self.second.load_index(), {'b': self.meta(510)})
+
+    def test_concurrent_writers_lose_no_habit(self):
+        import threading
+
+        def create(storage, prefix):
+            for i in range(50):
+                storage.save_habit(f"{prefix}{i}", self.meta(500 + i))
+
+        threads = [threading.Thread(target=create, args=(storage, prefix))
+                   for storage, prefix in ((self.first, 'a'), (self.second, 'b'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(LegacyStorage(self.data_dir).load_index()), 100)
+        self.assertFalse(os.path.exists(self.first.index_file + '.lock'))
+
+    def test_stale_lock_is_broken(self):
+        lock_file = self.first.index_file + '.lock'
+        open(lock_file, 'w').close()
+        os.utime(lock_file, (0, 0))
+        self.first.save_habit('a', self.meta(500))
+        self.assertEqual(list(self.second.load_index()), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from habit_model import HabitManager
+from habit_storage import open_storage
+from habit_sync import session_id, sync_with
+
+
+def manager(location):
+    return HabitManager(storage=open_storage(location))
+
+
+class SyncConvergenceTest(unittest.TestCase):
+    # A CSV store and a SQLite store, each with sessions the other lacks,
+    # synced through a third store until all three hold the same history
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.csv_dir = os.path.join(self.data_dir, 'a')
+        self.db_path = os.path.join(self.data_dir, 'b.db')
+        os.makedirs(self.csv_dir)
+        a = manager(self.csv_dir)
+        a.create_habit('pushups', {'reps': 1.0})
+        for i in range(300):
+            a.record_session('pushups', {'reps': float(i % 7)}, 'hard')
+        a.save_habits()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def diverge(self, target):
+        # Both sides play after a first sync: two sessions on one, one
+        # session and a new habit on the other
+        sync_with(manager(self.csv_dir), target)
+        b = manager(self.db_path)
+        sync_with(b, target)
+        a = manager(self.csv_dir)
+        a.record_session('pushups', {'reps': 3.0}, 'easy')
+        a.record_session('pushups', {'reps': 4.0}, 'easy')
+        a.save_habits()
+        b.record_session('pushups', {'reps': 5.0}, 'normal')
+        b.create_habit('squats', {'reps': 2.0})
+        b.record_session('squats', {'reps': 1.0})
+        b.save_habits()
+        b.storage.close()
+
+    def assertConsistent(self, location):
+        # Consecutive numbers, timestamp order, ratings that follow from the
+        # deltas, and an index rating that matches the history
+        m = manager(location)
+        rows = list(m.storage.iter_sessions('pushups'))
+        self.assertEqual([row['session'] for row in rows], list(range(1, len(rows) + 1)))
+        for before, row in zip(rows, rows[1:]):
+            self.assertLessEqual(before['timestamp'], row['timestamp'])
+            self.assertAlmostEqual(before['rating'] + row['delta'], row['rating'])
+        self.assertAlmostEqual(m.habits['pushups'].rating, rows[-1]['rating'])
+        self.assertIn('squats', m.habits)
+        ids = {name: [session_id(row) for row in m.storage.iter_sessions(name)] for name in m.habits}
+        m.storage.close()
+        return ids
+
+    def test_stores_converge_through_a_hub(self):
+        hub = os.path.join(self.data_dir, 'hub')
+        self.diverge(hub)
+        for location in (self.db_path, self.csv_dir, self.db_path):
+            m = manager(location)
+            sync_with(m, hub)
+            m.storage.close()
+        ids = self.assertConsistent(self.csv_dir)
+        self.assertEqual(len(ids['pushups']), 303)
+        self.assertEqual(self.assertConsistent(self.db_path), ids)
+        self.assertEqual(self.assertConsistent(hub), ids)
+        # A second round finds nothing to exchange
+        self.assertEqual(sync_with(manager(self.csv_dir), hub), {})
+
+    def test_stores_converge_through_a_server(self):
+        from habit_server import HabitServer
+        from habit_writer import WriteBehindStorage
+        server_dir = os.path.join(self.data_dir, 'server')
+        os.makedirs(server_dir)
+        loop = asyncio.new_event_loop()
+        server = HabitServer(WriteBehindStorage(open_storage(server_dir)))
+        listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+        url = f"http://127.0.0.1:{listener.sockets[0].getsockname()[1]}"
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            self.diverge(url)
+            for location in (self.db_path, self.csv_dir, self.db_path):
+                m = manager(location)
+                sync_with(m, url)
+                m.storage.close()
+            self.assertEqual(sync_with(manager(self.csv_dir), url), {})
+        finally:
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        ids = self.assertConsistent(self.csv_dir)
+        self.assertEqual(len(ids['pushups']), 303)
+        self.assertEqual(self.assertConsistent(self.db_path), ids)
+        self.assertEqual(self.assertConsistent(server_dir), ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import contextlib
+import threading
+import time
+import unittest
+
+from habit_writer import WriteBehindStorage
+
+
+class RecordingStorage:
+    # Records every write the writer thread makes; `gate`, while cleared,
+    # holds the writer inside its first write so later ones queue up
+    location = None
+
+    def __init__(self, delay=0.0, fail_on=None):
+        self.writes = []
+        self.delay = delay
+        self.fail_on = fail_on
+        self.gate = threading.Event()
+        self.gate.set()
+        self.waiting = threading.Event()
+        self.syncs = 0
+        self.closed = False
+
+    def _write(self, *write):
+        self.waiting.set()
+        self.gate.wait()
+        time.sleep(self.delay)
+        if write[0] == self.fail_on:
+            raise OSError(f"disk full during {write[0]}")
+        self.writes.append(write)
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def sync(self):
+        self.syncs += 1
+
+    def close(self):
+        self.closed = True
+
+    def append_sessions(self, name, rows, checkpoint=None):
+        self._write('append', name, [row['session'] for row in rows], checkpoint)
+
+    def save_habit(self, name, meta):
+        self._write('save_habit', name, meta['rating'])
+
+    def save_index(self, habit_data):
+        self._write('save_index', sorted(habit_data.items()))
+
+    def save_rollups(self, name, text):
+        self._write('save_rollups', name, text)
+
+    def load_index(self):
+        return {}
+
+
+def rows(*sessions):
+    return [{'session': session} for session in sessions]
+
+
+class WriteBehindTest(unittest.TestCase):
+    def test_batch_keeps_the_last_write_per_key(self):
+        storage = RecordingStorage()
+        writer = WriteBehindStorage(storage)
+        storage.gate.clear()
+        writer.save_rollups('warmup', 'x')  # holds the writer while the rest queue
+        storage.waiting.wait()
+        writer.save_habit('a', {'rating': 501})
+        writer.append_sessions('a', rows(1), {'n': 1})
+        writer.save_index({'a': 1})
+        writer.save_rollups('a', 'one')
+        writer.append_sessions('a', rows(2, 3), {'n': 3})
+        writer.save_habit('b', {'rating': 490})
+        writer.save_habit('a', {'rating': 502})
+        writer.save_rollups('a', 'two')
+        writer.save_index({'a': 2, 'b': 1})
+        storage.gate.set()
+        writer.close()
+        self.assertEqual(storage.writes[0], ('save_rollups', 'warmup', 'x'))
+        self.assertEqual(storage.writes[1:], [
+            ('append', 'a', [1, 2, 3], {'n': 3}),
+            ('save_habit', 'b', 490),
+            ('save_habit', 'a', 502),
+            ('save_rollups', 'a', 'two'),
+            ('save_index', [('a', 2), ('b', 1)]),
+        ])
+
+    def test_flush_and_close_drain_the_queue(self):
+        storage = RecordingStorage(delay=0.001)
+        writer = WriteBehindStorage(storage, max_batch=4)
+        for session in range(1, 41):
+            writer.save_rollups(f"h{session}", str(session))
+        writer.flush()
+        self.assertEqual(len(storage.writes), 40)
+        for session in range(41, 61):
+            writer.save_rollups(f"h{session}", str(session))
+        writer.close()
+        self.assertEqual([write[2] for write in storage.writes], [str(i) for i in range(1, 61)])
+        self.assertTrue(storage.closed)
+        self.assertFalse(writer._thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            writer.save_rollups('late', 'x')
+
+    def test_worker_exception_is_reported(self):
+        storage = RecordingStorage(fail_on='save_habit')
+        writer = WriteBehindStorage(storage)
+        done = []
+        writer.save_habit('a', {'rating': 501})
+        writer.when_written(lambda: done.append(True))
+        writer.flush()
+        errors = writer.drain_completed()
+        self.assertEqual([str(error) for error in errors], ["disk full during save_habit"])
+        self.assertEqual(done, [True])
+        # The writer carries on with the next batch
+        writer.save_rollups('a', 'text')
+        writer.close()
+        self.assertEqual(storage.writes, [('save_rollups', 'a', 'text')])
+        self.assertEqual(writer.drain_completed(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()